@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Benchmark do cálculo de pedidos (/gestao/pedidos/calcular)
+
+Popula produtos_gestao/insumos num banco descartável, chama calcular_pedido com
+moldura, vidro, MDF, papel, passe-partout e acessórios e reporta latência por
+chamada e consultas ao MongoDB por chamada (o cálculo lê o catálogo de preços em
+memória). Para comparação, mede também o padrão anterior (dois find_one sequenciais
+por item) sobre os mesmos ids.
+
+Uso:
+    MONGO_URL=mongodb://localhost:27017 python3 benchmark_calcular_pedido.py --calls 300 --acessorios 3
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from pymongo import monitoring
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+class ContadorConsultas(monitoring.CommandListener):
+    """Conta comandos find enviados ao MongoDB (registrado antes de criar o client)"""
+
+    def __init__(self):
+        self.finds = 0
+
+    def started(self, event):
+        if event.command_name == 'find':
+            self.finds += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark do cálculo de pedidos")
+    parser.add_argument('--calls', type=int, default=200, help="Quantidade de cálculos medidos")
+    parser.add_argument('--acessorios', type=int, default=3, help="Acessórios por pedido")
+    parser.add_argument('--db-name', default='calcular_pedido_benchmark', help="Banco usado no benchmark (descartado ao final)")
+    parser.add_argument('--keep-db', action='store_true', help="Não descarta o banco do benchmark ao final")
+    return parser.parse_args()
+
+
+def print_report(title: str, latencias: list, consultas: int):
+    latencias_ms = sorted(l * 1000 for l in latencias)
+    p95 = latencias_ms[int(len(latencias_ms) * 0.95) - 1] if latencias_ms else 0
+
+    print("\n" + "=" * 60)
+    print(f"📊 {title}")
+    print("=" * 60)
+    print(f"Chamadas:                {len(latencias_ms)}")
+    print(f"Latência média:          {statistics.mean(latencias_ms):.2f} ms")
+    print(f"Latência p50:            {statistics.median(latencias_ms):.2f} ms")
+    print(f"Latência p95:            {p95:.2f} ms")
+    print(f"Consultas/chamada:       {consultas / len(latencias_ms):.1f}")
+
+
+async def seed(db, acessorios: int) -> dict:
+    tipos = ['moldura', 'vidro', 'mdf', 'papel', 'passepartout'] + [f'acessorio{i}' for i in range(acessorios)]
+    ids = {tipo: f'bench-{tipo}' for tipo in tipos}
+
+    await db.produtos_gestao.insert_many([
+        {
+            'id': produto_id,
+            'descricao': f'Produto benchmark {tipo}',
+            'prazo_selecionado': '120dias',
+            'custo_120dias': 12.5,
+            'preco_manufatura': 40.0,
+            'markup_manufatura': 220,
+            'largura': 3 if tipo == 'moldura' else 0
+        }
+        for tipo, produto_id in ids.items()
+    ])
+    await db.insumos.insert_many([
+        {'id': produto_id, 'descricao': f'Insumo benchmark {tipo}', 'custo_unitario': 10.0}
+        for tipo, produto_id in ids.items()
+    ])
+    await db.produtos_gestao.create_index('id')
+    await db.insumos.create_index('id')
+    return ids
+
+
+async def run(args):
+    os.environ['DB_NAME'] = args.db_name
+    contador = ContadorConsultas()
+    monitoring.register(contador)
+
+    from server import db, calcular_pedido, PedidoCalculoRequest
+
+    try:
+        await db.client.drop_database(args.db_name)
+        ids = await seed(db, args.acessorios)
+        acessorios_ids = [ids[f'acessorio{i}'] for i in range(args.acessorios)]
+        pedido = PedidoCalculoRequest(
+            altura=50, largura=70, quantidade=2,
+            moldura_id=ids['moldura'],
+            usar_vidro=True, vidro_id=ids['vidro'],
+            usar_mdf=True, mdf_id=ids['mdf'],
+            usar_papel=True, papel_id=ids['papel'],
+            usar_passepartout=True, passepartout_id=ids['passepartout'],
+            usar_acessorios=bool(acessorios_ids), acessorios_ids=acessorios_ids
+        )
+
+        # Aquecimento (carga do catálogo em memória, conexões do pool)
+        for _ in range(10):
+            await calcular_pedido(pedido, current_user={})
+
+        # Cálculo atual: catálogo em memória, sem consultas
+        latencias = []
+        finds_antes = contador.finds
+        for _ in range(args.calls):
+            started = time.perf_counter()
+            await calcular_pedido(pedido, current_user={})
+            latencias.append(time.perf_counter() - started)
+        print_report("CALCULAR PEDIDO (CATÁLOGO EM MEMÓRIA)", latencias, contador.finds - finds_antes)
+
+        # Referência: busca item a item, como o cálculo fazia antes do prefetch
+        ids_pedido = list(ids.values())
+        latencias = []
+        finds_antes = contador.finds
+        for _ in range(args.calls):
+            started = time.perf_counter()
+            for produto_id in ids_pedido:
+                await db.produtos_gestao.find_one({"id": produto_id})
+                await db.insumos.find_one({"id": produto_id})
+            latencias.append(time.perf_counter() - started)
+        print_report("REFERÊNCIA: FIND_ONE POR ITEM (SÓ AS BUSCAS)", latencias, contador.finds - finds_antes)
+
+    finally:
+        if not args.keep_db:
+            await db.client.drop_database(args.db_name)
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Benchmark da sincronização Mercado Livre contra a API fake local (fake_marketplace_api)
+
+Mede ponta a ponta fetch_orders_since + mapeamento + persistência em lote e
+reporta pedidos/segundo e chamadas HTTP por pedido. Uma segunda rodada usa o
+sync incremental (watermark) para medir o custo em regime permanente, e uma
+terceira rebusca os detalhes de todos os pedidos (como webhooks e reprocessamentos
+fazem) com parte dos envios alterados, para medir o cache de shipments.
+
+Uso:
+    MONGO_URL=mongodb://localhost:27017 python3 benchmark_ml_sync.py --orders 1000 --latency-ms 80
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark da sincronização Mercado Livre (API fake local)")
+    parser.add_argument('--orders', type=int, default=500, help="Quantidade de pedidos gerados")
+    parser.add_argument('--page-size', type=int, default=50, help="Tamanho máximo de página do /orders/search")
+    parser.add_argument('--latency-ms', type=float, default=50.0, help="Latência simulada por requisição")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="Probabilidade de responder 429 (0-1)")
+    parser.add_argument('--token-ttl', type=int, default=21600, help="Validade dos tokens emitidos (segundos)")
+    parser.add_argument('--concurrency', type=int, default=8, help="ML_MAX_CONCURRENCY do integrador")
+    parser.add_argument('--rate-limit', type=float, default=100.0, help="ML_RATE_LIMIT_PER_SEC do integrador (0 = sem limite)")
+    parser.add_argument('--changed-shipments', type=float, default=0.1, help="Fração de envios com status alterado antes da 3ª rodada")
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--db-name', default='ml_sync_benchmark', help="Banco usado na persistência (descartado ao final)")
+    parser.add_argument('--keep-db', action='store_true', help="Não descarta o banco do benchmark ao final")
+    return parser.parse_args()
+
+
+def print_report(title: str, orders: int, elapsed_fetch: float, elapsed_total: float, stats_before, stats_after, cache_stats=None):
+    calls = {key: stats_after[key] - stats_before.get(key, 0) for key in stats_after}
+    total_calls = calls.get('total', 0)
+
+    print("\n" + "=" * 60)
+    print(f"📊 {title}")
+    print("=" * 60)
+    print(f"Pedidos processados:     {orders}")
+    print(f"Tempo de busca (HTTP):   {elapsed_fetch:.2f}s")
+    print(f"Tempo total:             {elapsed_total:.2f}s")
+    print(f"Pedidos/segundo:         {orders / elapsed_total:.1f}" if elapsed_total and orders else "Pedidos/segundo:         -")
+    print(f"Chamadas HTTP:           {total_calls}")
+    print(f"Chamadas HTTP/pedido:    {total_calls / orders:.2f}" if orders else "Chamadas HTTP/pedido:    -")
+    print(f"  /orders/search:        {calls.get('/orders/search', 0)}")
+    print(f"  /orders/{{id}}:          {calls.get('/orders', 0)}")
+    print(f"  /shipments/{{id}}:       {calls.get('/shipments', 0)}")
+    print(f"  /oauth/token:          {calls.get('/oauth', 0)}")
+    print(f"  304 (shipment cache):  {calls.get('304', 0)}")
+    print(f"429 injetados:           {calls.get('429', 0)}")
+    print(f"401 (token expirado):    {calls.get('401', 0)}")
+    if cache_stats and cache_stats.get('lookups'):
+        print(f"Cache de shipments:      {cache_stats['hit_ratio']:.0%} de acerto "
+              f"({cache_stats.get('hit', 0)} hits, {cache_stats.get('revalidated', 0)} 304, "
+              f"{cache_stats.get('bypass', 0)} status alterado, {cache_stats.get('miss', 0)} misses)")
+
+
+async def run(args):
+    # Configuração lida na importação do integrador
+    base_url = f"http://127.0.0.1:{args.port}"
+    os.environ['ML_API_BASE_URL'] = base_url
+    os.environ['ML_MAX_CONCURRENCY'] = str(args.concurrency)
+    os.environ['ML_RATE_LIMIT_PER_SEC'] = str(args.rate_limit)
+    os.environ['DB_NAME'] = args.db_name
+
+    import uvicorn
+    from fake_marketplace_api import create_fake_ml_app
+    from marketplace_integrator import (
+        MercadoLivreIntegrator,
+        ingest_ml_orders,
+        ensure_marketplace_indexes,
+        close_http_clients,
+        db
+    )
+    from sync_marketplaces_cron import MercadoLivreSync
+
+    app = create_fake_ml_app(
+        orders_count=args.orders,
+        page_size=args.page_size,
+        latency_ms=args.latency_ms,
+        rate_429=args.rate_429,
+        token_ttl=args.token_ttl
+    )
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=args.port, log_level='warning'))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    try:
+        await db.client.drop_database(args.db_name)
+        await ensure_marketplace_indexes()
+
+        integrator = MercadoLivreIntegrator()
+        token_data = app.state.issue_token()
+        await integrator.save_credentials(token_data)
+
+        # Rodada 1: carga completa (janela de 3 dias, todos os pedidos são novos)
+        stats_before = dict(app.state.stats)
+        started = time.monotonic()
+        ml_orders = await integrator.fetch_orders_since(datetime.now(timezone.utc) - timedelta(days=3))
+        elapsed_fetch = time.monotonic() - started
+        result = await ingest_ml_orders(integrator, ml_orders)
+        elapsed_total = time.monotonic() - started
+        print_report("CARGA COMPLETA", result['processed'], elapsed_fetch, elapsed_total, stats_before, dict(app.state.stats),
+                     integrator.last_fetch_stats.get('shipment_cache'))
+
+        # Rodada 2: sync incremental sem alterações (regime permanente)
+        ml_sync = MercadoLivreSync(integrator)
+        await ml_sync.run()  # grava o watermark inicial
+        stats_before = dict(app.state.stats)
+        started = time.monotonic()
+        stats = await ml_sync.run()
+        elapsed_total = time.monotonic() - started
+        print_report("SYNC INCREMENTAL (SEM ALTERAÇÕES)", stats['orders_fetched'], elapsed_total, elapsed_total, stats_before, dict(app.state.stats))
+
+        # Rodada 3: rebusca de detalhes com parte dos envios alterados (cache de shipments)
+        changed = app.state.orders[:int(len(app.state.orders) * args.changed_shipments)]
+        for order in changed:
+            app.state.set_shipping_status(order['id'], 'shipped')
+        stats_before = dict(app.state.stats)
+        started = time.monotonic()
+        ml_orders = await integrator.fetch_orders_since(datetime.now(timezone.utc) - timedelta(days=3))
+        elapsed_fetch = time.monotonic() - started
+        result = await ingest_ml_orders(integrator, ml_orders)
+        elapsed_total = time.monotonic() - started
+        print_report(f"REBUSCA DE DETALHES ({len(changed)} ENVIOS ALTERADOS)", result['processed'], elapsed_fetch, elapsed_total,
+                     stats_before, dict(app.state.stats), integrator.last_fetch_stats.get('shipment_cache'))
+
+    finally:
+        if not args.keep_db:
+            await db.client.drop_database(args.db_name)
+        await close_http_clients()
+        server.should_exit = True
+        await server_task
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
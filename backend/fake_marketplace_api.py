@@ -0,0 +1,673 @@
+"""
+API local que imita o Mercado Livre para testes e benchmarks offline
+
+Serve /orders/search, /orders/{id}, /shipments/{id} (com ETag/304) e /oauth/token
+a partir de fixtures geradas, com latência, tamanho de página, 429 e expiração
+de token configuráveis. create_fake_shopee_app faz o mesmo para a Shopee Open Platform v2
+(get_order_list, get_order_detail e access_token/get) e create_fake_tiktok_app para
+o TikTok Shop (orders/search, orders, token/get e token/refresh), ambos validando
+a assinatura.
+
+Uso standalone:
+    FAKE_ML_ORDERS=2000 FAKE_ML_LATENCY_MS=80 uvicorn fake_marketplace_api:app --port 8099
+    ML_API_BASE_URL=http://127.0.0.1:8099 python3 sync_marketplaces_cron.py
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import secrets
+import time
+from collections import Counter
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+SKUS_EXEMPLO = ['MF-30X40-PRETA', 'MM-A4-BRANCA', 'PD-QUADRO-60X90', 'ESPELHO-LED-50', 'CX-20X20', 'SV-A3-MADEIRA']
+
+
+def _ml_date(value: datetime) -> str:
+    """Formato de data usado pela API do ML"""
+    return value.astimezone(timezone(timedelta(hours=-3))).isoformat(timespec='milliseconds')
+
+
+def generate_ml_orders(count: int, seller_id: str = '123456', seed: int = 42, days: int = 2) -> List[Dict]:
+    """Gera pedidos no formato de GET /orders/{id} (com shipment separado)"""
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    orders = []
+
+    for i in range(count):
+        order_id = 2000000000 + i
+        created = now - timedelta(seconds=rnd.randint(0, days * 86400))
+        updated = min(now, created + timedelta(minutes=rnd.randint(0, 600)))
+
+        items = []
+        for j in range(rnd.randint(1, 3)):
+            price = round(rnd.uniform(40, 400), 2)
+            items.append({
+                'item': {
+                    'id': f"MLB{3000000000 + i * 10 + j}",
+                    'title': f"Quadro Decorativo {i}-{j}",
+                    'seller_custom_field': rnd.choice(SKUS_EXEMPLO),
+                    'variation_id': None,
+                    'variation_attributes': [{'name': 'Cor', 'value_name': rnd.choice(['Preta', 'Branca', 'Madeira'])}]
+                },
+                'quantity': rnd.randint(1, 3),
+                'unit_price': price,
+                'full_unit_price': price,
+                'currency_id': 'BRL'
+            })
+        total = round(sum(it['unit_price'] * it['quantity'] for it in items), 2)
+
+        orders.append({
+            'id': order_id,
+            'status': rnd.choice(['paid', 'paid', 'paid', 'confirmed', 'cancelled']),
+            'date_created': _ml_date(created),
+            'last_updated': _ml_date(updated),
+            'currency_id': 'BRL',
+            'total_amount': total,
+            'seller': {'id': int(seller_id)},
+            'buyer': {
+                'id': 500000 + i,
+                'nickname': f"COMPRADOR{i}",
+                'first_name': 'Cliente',
+                'last_name': str(i),
+                'phone': {'area_code': '31', 'number': f"9{rnd.randint(10000000, 99999999)}"},
+                'email': f"cliente{i}@example.com"
+            },
+            'order_items': items,
+            'payments': [{
+                'id': 7000000000 + i,
+                'status': 'approved',
+                'date_approved': _ml_date(created + timedelta(minutes=5)),
+                'installments': rnd.choice([1, 1, 2, 3, 6]),
+                'total_paid_amount': total
+            }],
+            'shipping': {'id': 4000000000 + i, 'cost': round(rnd.uniform(0, 30), 2), 'status': 'ready_to_ship'}
+        })
+
+    return orders
+
+
+def generate_ml_shipment(order: Dict) -> Dict:
+    """Shipment correspondente a um pedido gerado"""
+    i = order['id'] - 2000000000
+    return {
+        'id': order['shipping']['id'],
+        'status': order['shipping']['status'],
+        'tracking_number': f"BR{order['shipping']['id']}",
+        'receiver_address': {
+            'receiver_name': f"Cliente {i}",
+            'receiver_phone': '31999999999',
+            'street_name': 'Rua das Molduras',
+            'street_number': str(100 + i % 900),
+            'comment': '',
+            'neighborhood': {'name': 'Centro'},
+            'city': {'name': 'Belo Horizonte'},
+            'state': {'name': 'Minas Gerais'},
+            'zip_code': '30110000',
+            'country': {'name': 'Brasil'}
+        },
+        'status_history': {'date_shipped': None, 'date_delivered': None}
+    }
+
+
+def create_fake_ml_app(
+    orders_count: int = 500,
+    page_size: int = 50,
+    latency_ms: float = 50.0,
+    rate_429: float = 0.0,
+    token_ttl: int = 21600,
+    seller_id: str = '123456',
+    seed: int = 42
+) -> FastAPI:
+    """
+    Cria o app ASGI fake do Mercado Livre.
+    app.state.stats conta chamadas por rota, 429 injetados, 401 e tokens emitidos.
+    """
+    app = FastAPI(title="Fake Mercado Livre API")
+
+    orders = generate_ml_orders(orders_count, seller_id=seller_id, seed=seed)
+    orders_by_id = {str(o['id']): o for o in orders}
+    shipments_by_id = {str(o['shipping']['id']): generate_ml_shipment(o) for o in orders}
+    # Ordenado como sort=date_desc
+    orders_sorted = sorted(orders, key=lambda o: o['date_created'], reverse=True)
+
+    tokens: Dict[str, datetime] = {}
+    rnd = random.Random(seed)
+
+    app.state.stats = Counter()
+    app.state.orders = orders
+
+    def issue_token() -> Dict:
+        access_token = f"APP_USR-{secrets.token_hex(16)}"
+        tokens[access_token] = datetime.now(timezone.utc) + timedelta(seconds=token_ttl)
+        app.state.stats['tokens_issued'] += 1
+        return {
+            'access_token': access_token,
+            'token_type': 'Bearer',
+            'expires_in': token_ttl,
+            'refresh_token': f"TG-{secrets.token_hex(16)}",
+            'user_id': int(seller_id)
+        }
+
+    # Token inicial para semear marketplace_credentials nos testes
+    app.state.issue_token = issue_token
+
+    def check_auth(request: Request) -> Optional[JSONResponse]:
+        auth = request.headers.get('Authorization', '')
+        token = auth[7:] if auth.startswith('Bearer ') else ''
+        expires_at = tokens.get(token)
+        if not expires_at or datetime.now(timezone.utc) >= expires_at:
+            app.state.stats['401'] += 1
+            return JSONResponse({'message': 'invalid access token', 'status': 401}, status_code=401)
+        return None
+
+    @app.middleware("http")
+    async def simulate_network(request: Request, call_next):
+        path = request.url.path
+        route = '/' + path.strip('/').split('/')[0] if path.count('/') > 1 else path
+        if path == '/orders/search':
+            route = path
+        app.state.stats[route] += 1
+        app.state.stats['total'] += 1
+
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000.0)
+
+        if rate_429 and path != '/oauth/token' and rnd.random() < rate_429:
+            app.state.stats['429'] += 1
+            return JSONResponse({'message': 'too many requests', 'status': 429}, status_code=429, headers={'Retry-After': '0.2'})
+
+        return await call_next(request)
+
+    @app.post("/oauth/token")
+    async def oauth_token(request: Request):
+        form = await request.form()
+        if form.get('grant_type') not in ('refresh_token', 'authorization_code'):
+            return JSONResponse({'error': 'unsupported_grant_type'}, status_code=400)
+        return issue_token()
+
+    @app.get("/orders/search")
+    async def orders_search(request: Request):
+        denied = check_auth(request)
+        if denied:
+            return denied
+
+        params = request.query_params
+        offset = int(params.get('offset', 0))
+        limit = min(int(params.get('limit', page_size)), page_size)
+
+        filtered = orders_sorted
+        for field, key in (('order.date_created', 'date_created'), ('order.date_last_updated', 'last_updated')):
+            if params.get(f'{field}.from'):
+                since = datetime.fromisoformat(params[f'{field}.from'].replace('Z', '+00:00'))
+                filtered = [o for o in filtered if datetime.fromisoformat(o[key]) >= since]
+            if params.get(f'{field}.to'):
+                until = datetime.fromisoformat(params[f'{field}.to'].replace('Z', '+00:00'))
+                filtered = [o for o in filtered if datetime.fromisoformat(o[key]) <= until]
+
+        page = filtered[offset:offset + limit]
+        return {
+            'query': params.get('seller'),
+            'results': page,
+            'paging': {'total': len(filtered), 'offset': offset, 'limit': limit}
+        }
+
+    @app.get("/orders/{order_id}")
+    async def order_detail(order_id: str, request: Request):
+        denied = check_auth(request)
+        if denied:
+            return denied
+        order = orders_by_id.get(order_id)
+        if not order:
+            return JSONResponse({'message': 'order not found', 'status': 404}, status_code=404)
+        return order
+
+    @app.get("/shipments/{shipment_id}")
+    async def shipment_detail(shipment_id: str, request: Request):
+        denied = check_auth(request)
+        if denied:
+            return denied
+        shipment = shipments_by_id.get(shipment_id)
+        if not shipment:
+            return JSONResponse({'message': 'shipment not found', 'status': 404}, status_code=404)
+
+        etag = '"' + hashlib.md5(json.dumps(shipment, sort_keys=True).encode('utf-8')).hexdigest() + '"'
+        if request.headers.get('If-None-Match') == etag:
+            app.state.stats['304'] += 1
+            return Response(status_code=304, headers={'ETag': etag})
+        return JSONResponse(shipment, headers={'ETag': etag})
+
+    def set_shipping_status(order_id: str, status: str):
+        """Altera o status de envio de um pedido (pedido e shipment), como o ML faria"""
+        order = orders_by_id[str(order_id)]
+        order['shipping']['status'] = status
+        order['last_updated'] = _ml_date(datetime.now(timezone.utc))
+        shipments_by_id[str(order['shipping']['id'])]['status'] = status
+
+    app.state.set_shipping_status = set_shipping_status
+
+    return app
+
+
+def generate_shopee_orders(count: int, seed: int = 42, days: int = 2) -> List[Dict]:
+    """Gera pedidos no formato de get_order_detail (Shopee v2)"""
+    rnd = random.Random(seed)
+    now = int(time.time())
+    orders = []
+
+    for i in range(count):
+        created = now - rnd.randint(0, days * 86400)
+        updated = min(now, created + rnd.randint(0, 36000))
+        status = rnd.choice(['READY_TO_SHIP', 'READY_TO_SHIP', 'PROCESSED', 'SHIPPED', 'COMPLETED', 'CANCELLED'])
+
+        items = []
+        for j in range(rnd.randint(1, 3)):
+            price = round(rnd.uniform(40, 400), 2)
+            items.append({
+                'item_id': 800000000 + i * 10 + j,
+                'item_name': f"Quadro Decorativo {i}-{j}",
+                'item_sku': rnd.choice(SKUS_EXEMPLO),
+                'model_id': rnd.choice([0, 900000 + j]),
+                'model_name': rnd.choice(['Preta', 'Branca', 'Madeira']),
+                'model_sku': '',
+                'model_quantity_purchased': rnd.randint(1, 3),
+                'model_original_price': price,
+                'model_discounted_price': price,
+                'weight': 0.8
+            })
+        total = round(sum(it['model_discounted_price'] * it['model_quantity_purchased'] for it in items), 2)
+
+        orders.append({
+            'order_sn': f"2410{i:08d}SHP",
+            'order_status': status,
+            'create_time': created,
+            'update_time': updated,
+            'pay_time': created + 300,
+            'ship_by_date': created + 2 * 86400,
+            'currency': 'BRL',
+            'total_amount': total,
+            'estimated_shipping_fee': round(rnd.uniform(0, 30), 2),
+            'actual_shipping_fee': 0,
+            'buyer_user_id': 600000 + i,
+            'buyer_username': f"comprador_{i}",
+            'payment_method': rnd.choice(['Pix', 'Credit Card', 'Boleto']),
+            'shipping_carrier': 'Shopee Xpress',
+            'message_to_seller': '',
+            'cancel_reason': '',
+            'recipient_address': {
+                'name': f"Cliente {i}",
+                'phone': '5531999999999',
+                'full_address': f"Rua das Molduras, {100 + i % 900}, Centro",
+                'district': 'Centro',
+                'city': 'Belo Horizonte',
+                'state': 'Minas Gerais',
+                'zipcode': '30110000',
+                'region': 'BR'
+            },
+            'item_list': items,
+            'package_list': [{
+                'package_number': f"OFG{700000000 + i}",
+                'logistics_status': 'LOGISTICS_READY' if status in ('READY_TO_SHIP', 'PROCESSED') else 'LOGISTICS_DELIVERY_DONE',
+                'shipping_carrier': 'Shopee Xpress',
+                'logistics_channel_id': 90026
+            }]
+        })
+
+    return orders
+
+
+def create_fake_shopee_app(
+    orders_count: int = 500,
+    latency_ms: float = 50.0,
+    rate_429: float = 0.0,
+    token_ttl: int = 14400,
+    partner_id: int = 1000001,
+    partner_key: str = 'fake-partner-key',
+    shop_id: int = 2000002,
+    seed: int = 42
+) -> FastAPI:
+    """
+    Cria o app ASGI fake da Shopee (Open Platform v2).
+    Valida a assinatura HMAC como a API real e respeita os limites de
+    page_size (100), janela (15 dias) e order_sn_list (50).
+    app.state.stats conta chamadas por endpoint, 429 injetados e erros de auth.
+    """
+    app = FastAPI(title="Fake Shopee API")
+
+    orders = generate_shopee_orders(orders_count, seed=seed)
+    orders_by_sn = {o['order_sn']: o for o in orders}
+    tokens: Dict[str, float] = {}
+    rnd = random.Random(seed)
+
+    app.state.stats = Counter()
+    app.state.orders = orders
+
+    def issue_token() -> Dict:
+        access_token = secrets.token_hex(16)
+        tokens[access_token] = time.time() + token_ttl
+        app.state.stats['tokens_issued'] += 1
+        return {
+            'access_token': access_token,
+            'refresh_token': secrets.token_hex(16),
+            'expire_in': token_ttl,
+            'error': '',
+            'message': ''
+        }
+
+    app.state.issue_token = issue_token
+
+    def error(code: str, message: str, status_code: int = 200) -> JSONResponse:
+        if code.startswith('error_auth') or code == 'error_sign':
+            app.state.stats['auth_errors'] += 1
+        return JSONResponse({'error': code, 'message': message, 'request_id': secrets.token_hex(8)}, status_code=status_code)
+
+    def check_sign(request: Request, shop_level: bool) -> Optional[JSONResponse]:
+        params = request.query_params
+        base = f"{params.get('partner_id')}{request.url.path}{params.get('timestamp')}"
+        if shop_level:
+            base += f"{params.get('access_token', '')}{params.get('shop_id', '')}"
+        expected = hmac.new(partner_key.encode('utf-8'), base.encode('utf-8'), hashlib.sha256).hexdigest()
+        if str(params.get('partner_id')) != str(partner_id) or not hmac.compare_digest(expected, params.get('sign', '')):
+            return error('error_sign', 'Wrong sign.', 403)
+        if shop_level:
+            expires_at = tokens.get(params.get('access_token', ''))
+            if not expires_at or time.time() >= expires_at:
+                return error('error_auth', 'Invalid access_token.', 403)
+        return None
+
+    @app.middleware("http")
+    async def simulate_network(request: Request, call_next):
+        app.state.stats[request.url.path.rsplit('/', 1)[-1]] += 1
+        app.state.stats['total'] += 1
+
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000.0)
+
+        if rate_429 and not request.url.path.startswith('/api/v2/auth') and rnd.random() < rate_429:
+            app.state.stats['429'] += 1
+            return error('error_too_many_request', 'Too many requests.', 429)
+
+        return await call_next(request)
+
+    @app.post("/api/v2/auth/access_token/get")
+    async def refresh_access_token(request: Request):
+        denied = check_sign(request, shop_level=False)
+        if denied:
+            return denied
+        body = await request.json()
+        if int(body.get('shop_id', 0)) != shop_id:
+            return error('error_param', 'Invalid shop_id.')
+        return issue_token()
+
+    @app.get("/api/v2/order/get_order_list")
+    async def get_order_list(request: Request):
+        denied = check_sign(request, shop_level=True)
+        if denied:
+            return denied
+
+        params = request.query_params
+        field = params.get('time_range_field', 'create_time')
+        time_from, time_to = int(params['time_from']), int(params['time_to'])
+        page_size = int(params.get('page_size', 20))
+        if time_to - time_from > 15 * 86400:
+            return error('error_param', 'time_range exceeds 15 days.')
+        if page_size > 100:
+            return error('error_param', 'page_size must be <= 100.')
+
+        filtered = sorted((o for o in orders if time_from <= o[field] <= time_to), key=lambda o: o[field])
+        offset = int(params.get('cursor') or 0)
+        page = filtered[offset:offset + page_size]
+        more = offset + page_size < len(filtered)
+        return {
+            'error': '',
+            'message': '',
+            'response': {
+                'more': more,
+                'next_cursor': str(offset + page_size) if more else '',
+                'order_list': [{'order_sn': o['order_sn'], 'order_status': o['order_status']} for o in page]
+            }
+        }
+
+    @app.get("/api/v2/order/get_order_detail")
+    async def get_order_detail(request: Request):
+        denied = check_sign(request, shop_level=True)
+        if denied:
+            return denied
+
+        order_sns = [sn for sn in request.query_params.get('order_sn_list', '').split(',') if sn]
+        if not order_sns or len(order_sns) > 50:
+            return error('error_param', 'order_sn_list must contain 1-50 items.')
+        return {
+            'error': '',
+            'message': '',
+            'response': {'order_list': [orders_by_sn[sn] for sn in order_sns if sn in orders_by_sn]}
+        }
+
+    return app
+
+
+def generate_tiktok_orders(count: int, seed: int = 42, days: int = 2) -> List[Dict]:
+    """Gera pedidos no formato de orders/search (TikTok Shop 202309)"""
+    rnd = random.Random(seed)
+    now = int(time.time())
+    orders = []
+
+    for i in range(count):
+        created = now - rnd.randint(0, days * 86400)
+        updated = min(now, created + rnd.randint(0, 36000))
+        status = rnd.choice(['AWAITING_SHIPMENT', 'AWAITING_SHIPMENT', 'AWAITING_COLLECTION', 'IN_TRANSIT', 'DELIVERED', 'CANCELLED'])
+
+        line_items = []
+        for j in range(rnd.randint(1, 3)):
+            price = f"{rnd.uniform(40, 400):.2f}"
+            sku_id = str(1729000000000000000 + i * 10 + j)
+            # Uma linha por unidade, como a API real
+            for _ in range(rnd.randint(1, 2)):
+                line_items.append({
+                    'id': str(577000000000000000 + len(line_items) + i * 100),
+                    'sku_id': sku_id,
+                    'product_id': str(1729100000000000000 + i),
+                    'product_name': f"Quadro Decorativo {i}-{j}",
+                    'sku_name': rnd.choice(['Preta', 'Branca', 'Madeira']),
+                    'seller_sku': rnd.choice(SKUS_EXEMPLO),
+                    'sale_price': price,
+                    'original_price': price,
+                    'seller_discount': '0',
+                    'platform_discount': '0',
+                    'currency': 'BRL'
+                })
+        sub_total = sum(float(line['sale_price']) for line in line_items)
+        shipping_fee = rnd.uniform(0, 30)
+
+        orders.append({
+            'id': str(578000000000000000 + i),
+            'status': status,
+            'create_time': created,
+            'update_time': updated,
+            'paid_time': created + 300,
+            'rts_sla_time': created + 2 * 86400,
+            'user_id': str(7000000 + i),
+            'buyer_email': f"cliente{i}@scs.tiktokw.us",
+            'buyer_message': '',
+            'payment_method_name': rnd.choice(['Pix', 'Cartão de crédito', 'Boleto']),
+            'delivery_option_name': 'Padrão',
+            'shipping_provider': 'J&T Express',
+            'tracking_number': f"JT{900000000 + i}" if status in ('IN_TRANSIT', 'DELIVERED') else '',
+            'payment': {
+                'currency': 'BRL',
+                'sub_total': f"{sub_total:.2f}",
+                'shipping_fee': f"{shipping_fee:.2f}",
+                'seller_discount': '0',
+                'platform_discount': '0',
+                'total_amount': f"{sub_total + shipping_fee:.2f}"
+            },
+            'recipient_address': {
+                'name': f"Cliente {i}",
+                'phone_number': '(+55)31999999999',
+                'address_line1': f"Rua das Molduras, {100 + i % 900}",
+                'address_line2': '',
+                'postal_code': '30110000',
+                'region_code': 'BR',
+                'district_info': [
+                    {'address_level_name': 'State', 'address_name': 'Minas Gerais'},
+                    {'address_level_name': 'City', 'address_name': 'Belo Horizonte'},
+                    {'address_level_name': 'District', 'address_name': 'Centro'}
+                ]
+            },
+            'line_items': line_items,
+            'packages': [{'id': str(1153000000000000000 + i)}]
+        })
+
+    return orders
+
+
+def create_fake_tiktok_app(
+    orders_count: int = 500,
+    latency_ms: float = 50.0,
+    rate_429: float = 0.0,
+    token_ttl: int = 604800,
+    app_key: str = 'fakeappkey',
+    app_secret: str = 'fake-app-secret',
+    shop_id: str = '7495000000000000001',
+    shop_cipher: str = 'ROW_fakecipher',
+    seed: int = 42
+) -> FastAPI:
+    """
+    Cria o app ASGI fake do TikTok Shop (Partner API 202309) servindo também o host
+    de autenticação (/api/v2/token/*). Valida a assinatura HMAC, o shop_cipher e
+    os limites de page_size (100) e ids por consulta (50).
+    """
+    app = FastAPI(title="Fake TikTok Shop API")
+
+    orders = generate_tiktok_orders(orders_count, seed=seed)
+    orders_by_id = {o['id']: o for o in orders}
+    tokens: Dict[str, float] = {}
+    rnd = random.Random(seed)
+
+    app.state.stats = Counter()
+    app.state.orders = orders
+
+    def issue_token() -> Dict:
+        access_token = f"TTP_{secrets.token_hex(16)}"
+        tokens[access_token] = time.time() + token_ttl
+        app.state.stats['tokens_issued'] += 1
+        return {
+            'access_token': access_token,
+            'access_token_expire_in': int(time.time()) + token_ttl,
+            'refresh_token': f"TTP_{secrets.token_hex(16)}",
+            'refresh_token_expire_in': int(time.time()) + 30 * 86400,
+            'open_id': 'fake-open-id',
+            'seller_name': 'Lider Molduras'
+        }
+
+    app.state.issue_token = issue_token
+    app.state.shop = {'id': shop_id, 'name': 'Lider Molduras', 'cipher': shop_cipher}
+
+    def reply(data=None, code: int = 0, message: str = 'Success', status_code: int = 200) -> JSONResponse:
+        if code in (105001, 105002, 106001):
+            app.state.stats['auth_errors'] += 1
+        return JSONResponse({'code': code, 'message': message, 'data': data, 'request_id': secrets.token_hex(8)}, status_code=status_code)
+
+    async def check_request(request: Request, needs_shop: bool = True) -> Optional[JSONResponse]:
+        params = dict(request.query_params)
+        body = (await request.body()).decode('utf-8')
+        ordered = ''.join(f"{key}{params[key]}" for key in sorted(params) if key not in ('sign', 'access_token'))
+        base = f"{app_secret}{request.url.path}{ordered}{body}{app_secret}"
+        expected = hmac.new(app_secret.encode('utf-8'), base.encode('utf-8'), hashlib.sha256).hexdigest()
+        if params.get('app_key') != app_key or not hmac.compare_digest(expected, params.get('sign', '')):
+            return reply(code=106001, message='Invalid signature', status_code=401)
+        expires_at = tokens.get(request.headers.get('x-tts-access-token', ''))
+        if not expires_at or time.time() >= expires_at:
+            return reply(code=105002, message='Expired credentials', status_code=401)
+        if needs_shop and params.get('shop_cipher') != shop_cipher:
+            return reply(code=106011, message='Invalid shop_cipher', status_code=400)
+        return None
+
+    @app.middleware("http")
+    async def simulate_network(request: Request, call_next):
+        path = request.url.path
+        route = 'token' if path.startswith('/api/v2/token') else path.rsplit('/', 1)[-1]
+        app.state.stats[route] += 1
+        app.state.stats['total'] += 1
+
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000.0)
+
+        if rate_429 and route != 'token' and rnd.random() < rate_429:
+            app.state.stats['429'] += 1
+            return reply(code=36009003, message='Too many requests', status_code=429)
+
+        return await call_next(request)
+
+    @app.get("/api/v2/token/get")
+    async def token_get(request: Request):
+        params = request.query_params
+        if params.get('app_key') != app_key or params.get('app_secret') != app_secret:
+            return reply(code=36004003, message='Invalid app')
+        return reply(issue_token())
+
+    @app.get("/api/v2/token/refresh")
+    async def token_refresh(request: Request):
+        params = request.query_params
+        if params.get('app_key') != app_key or params.get('app_secret') != app_secret or not params.get('refresh_token'):
+            return reply(code=36004003, message='Invalid refresh_token')
+        return reply(issue_token())
+
+    @app.get("/authorization/202309/shops")
+    async def authorized_shops(request: Request):
+        denied = await check_request(request, needs_shop=False)
+        if denied:
+            return denied
+        return reply({'shops': [{**app.state.shop, 'region': 'BR', 'seller_type': 'LOCAL', 'code': 'BRLCFAKE'}]})
+
+    @app.post("/order/202309/orders/search")
+    async def orders_search(request: Request):
+        denied = await check_request(request)
+        if denied:
+            return denied
+
+        params = request.query_params
+        page_size = int(params.get('page_size', 20))
+        if page_size > 100:
+            return reply(code=36009004, message='page_size must be <= 100')
+        body = await request.json()
+        ge, lt = body.get('update_time_ge', 0), body.get('update_time_lt', int(time.time()) + 1)
+
+        filtered = sorted((o for o in orders if ge <= o['update_time'] < lt), key=lambda o: (o['update_time'], o['id']))
+        offset = int(params.get('page_token') or 0)
+        page = filtered[offset:offset + page_size]
+        more = offset + page_size < len(filtered)
+        return reply({
+            'orders': page,
+            'next_page_token': str(offset + page_size) if more else '',
+            'total_count': len(filtered)
+        })
+
+    @app.get("/order/202309/orders")
+    async def orders_detail(request: Request):
+        denied = await check_request(request)
+        if denied:
+            return denied
+
+        ids = [i for i in request.query_params.get('ids', '').split(',') if i]
+        if not ids or len(ids) > 50:
+            return reply(code=36009004, message='ids must contain 1-50 items')
+        return reply({'orders': [orders_by_id[i] for i in ids if i in orders_by_id]})
+
+    return app
+
+
+app = create_fake_ml_app(
+    orders_count=int(os.environ.get('FAKE_ML_ORDERS', '500')),
+    page_size=int(os.environ.get('FAKE_ML_PAGE_SIZE', '50')),
+    latency_ms=float(os.environ.get('FAKE_ML_LATENCY_MS', '50')),
+    rate_429=float(os.environ.get('FAKE_ML_RATE_429', '0')),
+    token_ttl=int(os.environ.get('FAKE_ML_TOKEN_TTL', '21600'))
+)
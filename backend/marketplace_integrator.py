@@ -1,6 +1,6 @@
 """
 Marketplace Integrator Module
-Integração completa com Mercado Livre e Shopee
+Integração completa com Mercado Livre, Shopee e TikTok Shop
 """
 import os
 import asyncio
@@ -10,28 +10,612 @@ import hmac
 import base64
 import secrets
 import json
+import random
+import time
+import uuid
+from collections import Counter, OrderedDict
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Dict, List
+from typing import AsyncIterator, Optional, Dict, List
 from urllib.parse import urlencode
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 # MongoDB connection
 mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ.get('DB_NAME', 'gestao_manufatura')]
 
+# ============= HTTP: POOL DE CONEXÕES, RATE LIMIT E RETRY =============
+
+# Status que merecem nova tentativa (rate limit e falhas temporárias do servidor)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Falhas em que a requisição certamente não chegou ao servidor (seguras para repetir sempre)
+UNSENT_REQUEST_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# Um AsyncClient por base_url, compartilhado por todas as instâncias do processo
+_http_clients: Dict[str, httpx.AsyncClient] = {}
+
+def _http2_disponivel() -> bool:
+    """HTTP/2 no httpx depende do pacote opcional 'h2' (pip install httpx[http2])"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def get_http_client(base_url: str, http2: bool = False, max_connections: int = 20) -> httpx.AsyncClient:
+    """Retorna o AsyncClient compartilhado (keep-alive) para a base_url informada"""
+    client = _http_clients.get(base_url)
+    if client is None or client.is_closed:
+        if http2 and not _http2_disponivel():
+            print("⚠️  HTTP/2 solicitado mas pacote 'h2' não instalado - usando HTTP/1.1")
+            http2 = False
+        client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=60.0
+            ),
+            http2=http2
+        )
+        _http_clients[base_url] = client
+    return client
+
+async def close_http_clients():
+    """Fecha os clients HTTP compartilhados (chamar no shutdown do processo)"""
+    for client in list(_http_clients.values()):
+        if not client.is_closed:
+            await client.aclose()
+    _http_clients.clear()
+
+class TokenBucket:
+    """Rate limiter token-bucket: `rate` requisições/segundo com rajadas até `capacity`"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Aguarda até existir um token disponível e o consome"""
+        if self.rate <= 0:
+            return
+        
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# Um TokenBucket por marketplace, compartilhado por todas as instâncias (limites são por aplicação)
+_rate_limiters: Dict[str, TokenBucket] = {}
+
+def get_rate_limiter(marketplace: str, rate: float) -> TokenBucket:
+    """Rate limiter compartilhado do marketplace (criado na primeira chamada)"""
+    if marketplace not in _rate_limiters:
+        _rate_limiters[marketplace] = TokenBucket(rate)
+    return _rate_limiters[marketplace]
+
+def backoff_delay(attempt: int, base: float = 0.5, max_delay: float = 30.0, retry_after: Optional[str] = None) -> float:
+    """Backoff exponencial com full jitter; respeita Retry-After quando informado"""
+    if retry_after:
+        try:
+            return min(max_delay, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(max_delay, base * (2 ** attempt)))
+
+async def request_with_retry(
+    client: httpx.AsyncClient,
+    method: str,
+    path: str,
+    rate_limiter: TokenBucket,
+    semaphore: asyncio.Semaphore,
+    max_retries: int = 5,
+    single_use: bool = False,
+    **kwargs
+) -> httpx.Response:
+    """
+    Executa a requisição respeitando rate limit e concorrência.
+    429/5xx e erros de rede são repetidos com backoff exponencial + jitter;
+    esgotadas as tentativas, retorna a última resposta (ou propaga o erro de rede).
+    
+    single_use: requisição que consome um valor de uso único (troca do código de
+    autorização, renovação com refresh_token). Só repete falhas de conexão anteriores
+    ao envio; timeout de leitura ou resposta 429/5xx podem já ter consumido o valor.
+    """
+    attempt = 0
+    while True:
+        await rate_limiter.acquire()
+        try:
+            async with semaphore:
+                response = await client.request(method, path, **kwargs)
+        except httpx.TransportError as e:
+            if attempt >= max_retries or (single_use and not isinstance(e, UNSENT_REQUEST_ERRORS)):
+                raise
+            delay = backoff_delay(attempt)
+            print(f"⚠️  Erro de rede em {path} ({e.__class__.__name__}), nova tentativa em {delay:.1f}s")
+        else:
+            if single_use or response.status_code not in RETRY_STATUS_CODES or attempt >= max_retries:
+                return response
+            delay = backoff_delay(attempt, retry_after=response.headers.get('Retry-After'))
+            print(f"⚠️  {path} retornou {response.status_code}, nova tentativa em {delay:.1f}s")
+        
+        attempt += 1
+        await asyncio.sleep(delay)
+
+def as_utc(value) -> Optional[datetime]:
+    """Normaliza datetime (Mongo devolve naive em UTC) ou string ISO para datetime UTC"""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+class ConnectorTokenHolder:
+    """
+    Credenciais em cache de uma conta (loja) e o lock de renovação, compartilhados por
+    todas as instâncias do conector no processo - a renovação consome o refresh_token.
+    """
+    
+    def __init__(self):
+        self.credentials: Optional[Dict] = None
+        self.lock = asyncio.Lock()
+
+# Um holder por conta (filtro de marketplace_credentials), como _ml_token_holder no ML
+_token_holders: Dict[tuple, ConnectorTokenHolder] = {}
+
+def get_token_holder(credentials_query: Dict) -> ConnectorTokenHolder:
+    """Holder de token compartilhado da conta (criado na primeira chamada)"""
+    key = tuple(sorted(credentials_query.items()))
+    if key not in _token_holders:
+        _token_holders[key] = ConnectorTokenHolder()
+    return _token_holders[key]
+
+# ============= CONECTOR BASE =============
+
+class MarketplaceConnector:
+    """
+    Base dos conectores de marketplace: cliente HTTP compartilhado, rate limit por
+    marketplace, retry, credenciais, watermark e pipeline de ingestão em lote.
+    
+    Um novo marketplace implementa apenas os ganchos:
+        list_order_pages(date_from, date_to) -> páginas de referências (ids) alteradas
+        fetch_order_batch(refs)              -> pedidos completos de até DETAIL_BATCH_SIZE refs
+        map_to_internal_order / map_to_internal_items (+ payments/shipments opcionais)
+    e, se tiver token renovável, refresh_token(creds).
+    
+    Configuração por variáveis de ambiente com o prefixo `env_prefix`:
+    {PREFIX}_API_BASE_URL, {PREFIX}_MAX_CONCURRENCY, {PREFIX}_MAX_RETRIES,
+    {PREFIX}_RATE_LIMIT_PER_SEC e {PREFIX}_HTTP2.
+    """
+    
+    marketplace = ''
+    env_prefix = ''
+    DEFAULT_BASE_URL = ''
+    DEFAULT_CONCURRENCY = 8
+    DEFAULT_RATE_LIMIT = 10.0
+    # Quantas refs o endpoint de detalhe aceita por chamada
+    DETAIL_BATCH_SIZE = 1
+    # Renovação antecipada do access_token
+    REFRESH_AHEAD = timedelta(minutes=5)
+    
+    def __init__(self):
+        prefix = self.env_prefix
+        self.base_url = os.environ.get(f'{prefix}_API_BASE_URL', self.DEFAULT_BASE_URL)
+        self.max_concurrency = int(os.environ.get(f'{prefix}_MAX_CONCURRENCY', str(self.DEFAULT_CONCURRENCY)))
+        self.max_retries = int(os.environ.get(f'{prefix}_MAX_RETRIES', '5'))
+        self.http2 = os.environ.get(f'{prefix}_HTTP2', 'false').lower() == 'true'
+        
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._rate_limiter = get_rate_limiter(
+            self.marketplace,
+            float(os.environ.get(f'{prefix}_RATE_LIMIT_PER_SEC', str(self.DEFAULT_RATE_LIMIT)))
+        )
+        self.last_fetch_stats: Dict = {}
+    
+    # ----- HTTP -----
+    
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """AsyncClient compartilhado com keep-alive (um por processo)"""
+        return get_http_client(self.base_url, http2=self.http2, max_connections=max(self.max_concurrency, 10))
+    
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Requisição com rate limit do marketplace, limite de concorrência e retry"""
+        return await request_with_retry(
+            self.http_client, method, path,
+            rate_limiter=self._rate_limiter,
+            semaphore=self._semaphore,
+            max_retries=self.max_retries,
+            **kwargs
+        )
+    
+    # ----- Credenciais -----
+    
+    @property
+    def _token_holder(self) -> ConnectorTokenHolder:
+        return get_token_holder(self.credentials_query())
+    
+    @property
+    def _credentials(self) -> Optional[Dict]:
+        return self._token_holder.credentials
+    
+    @_credentials.setter
+    def _credentials(self, value: Optional[Dict]):
+        self._token_holder.credentials = value
+    
+    def credentials_query(self) -> Dict:
+        """Filtro da conta em marketplace_credentials"""
+        return {'marketplace': self.marketplace}
+    
+    def account_id(self, creds: Dict) -> Optional[str]:
+        """Identificador da conta (vendedor/loja) usado no watermark"""
+        value = creds.get('shop_id') or creds.get('user_id')
+        return str(value) if value else None
+    
+    async def get_credentials(self) -> Optional[Dict]:
+        """Busca credenciais armazenadas"""
+        return await db.marketplace_credentials.find_one(self.credentials_query())
+    
+    async def _persist_credentials(self, credentials: Dict, key: Optional[Dict] = None):
+        """Grava credenciais (upsert pela conta) e atualiza o cache da instância"""
+        await db.marketplace_credentials.update_one(
+            key or self.credentials_query(),
+            {'$set': credentials},
+            upsert=True
+        )
+        self._credentials = credentials
+    
+    def _token_is_fresh(self, creds: Optional[Dict]) -> bool:
+        if not creds or not creds.get('access_token'):
+            return False
+        expires_at = as_utc(creds.get('token_expires_at'))
+        return expires_at is None or datetime.now(timezone.utc) < expires_at - self.REFRESH_AHEAD
+    
+    def invalidate_token(self):
+        """Força releitura/renovação na próxima chamada"""
+        self._credentials = None
+    
+    async def refresh_token(self, creds: Dict) -> Dict:
+        """Renova o access_token e grava as credenciais (gancho do conector)"""
+        raise NotImplementedError
+    
+    async def ensure_valid_token(self) -> Dict:
+        """Retorna credenciais válidas (cache do processo, renovação única sob lock)"""
+        if self._token_is_fresh(self._credentials):
+            return self._credentials
+        
+        async with self._token_holder.lock:
+            if self._token_is_fresh(self._credentials):
+                return self._credentials
+            
+            creds = await self.get_credentials()
+            if not creds:
+                raise Exception(f"Nenhuma credencial {self.marketplace} encontrada. Execute autorização primeiro.")
+            
+            if self._token_is_fresh(creds):
+                self._credentials = creds
+            else:
+                print(f"🔄 Token {self.marketplace} expirando, renovando...")
+                await self.refresh_token(creds)
+            
+            return self._credentials
+    
+    # ----- Watermark -----
+    
+    async def get_watermark(self, account_id: str) -> Optional[datetime]:
+        state = await get_sync_state(self.marketplace, account_id)
+        return as_utc(state.get('last_updated_watermark')) if state else None
+    
+    async def advance_watermark(self, account_id: str, watermark: datetime, orders_synced: int = 0):
+        await advance_sync_watermark(self.marketplace, account_id, watermark, orders_synced)
+    
+    # ----- Ganchos do marketplace -----
+    
+    async def list_order_pages(self, date_from: datetime, date_to: datetime) -> AsyncIterator[List]:
+        """Gera páginas de referências de pedidos alterados na janela"""
+        raise NotImplementedError
+        yield []
+    
+    async def fetch_order_batch(self, refs: List) -> List[Dict]:
+        """Busca pedidos completos de até DETAIL_BATCH_SIZE referências"""
+        raise NotImplementedError
+    
+    async def expand_orders(self, refs: List) -> List[Dict]:
+        """Converte uma página da listagem em pedidos completos (sobrescrever se a listagem já traz o pedido)"""
+        return await self.fetch_details(refs)
+    
+    async def drop_unchanged(self, refs: List) -> List:
+        """Remove da página os pedidos já persistidos sem alteração (sobrescrever se a listagem traz o last_updated)"""
+        return refs
+    
+    def order_ref(self, order: Dict) -> str:
+        """ID do pedido no payload bruto do marketplace (igual ao marketplace_order_id mapeado)"""
+        return str(order.get('id', ''))
+    
+    def map_to_internal_order(self, order: Dict) -> Dict:
+        raise NotImplementedError
+    
+    def map_to_internal_items(self, order: Dict, internal_order_id: str) -> List[Dict]:
+        raise NotImplementedError
+    
+    def _from_timestamp(self, value) -> Optional[datetime]:
+        """Timestamp Unix (segundos) para datetime UTC"""
+        if not value:
+            return None
+        try:
+            return datetime.fromtimestamp(int(value), tz=timezone.utc)
+        except (TypeError, ValueError):
+            return None
+    
+    # ----- Pipeline -----
+    
+    async def fetch_details(self, refs: List) -> List[Dict]:
+        """Busca detalhes em lotes de DETAIL_BATCH_SIZE, concorrentemente; falhas contam em last_fetch_stats"""
+        async def fetch_batch(batch: List) -> List[Dict]:
+            try:
+                return [order for order in await self.fetch_order_batch(batch) if order]
+            except Exception as e:
+                print(f"❌ Erro ao buscar detalhes {self.marketplace} ({len(batch)} pedidos): {e}")
+                return []
+        
+        size = max(self.DETAIL_BATCH_SIZE, 1)
+        batches = [refs[i:i + size] for i in range(0, len(refs), size)]
+        results = await asyncio.gather(*(fetch_batch(batch) for batch in batches))
+        orders = [order for batch in results for order in batch]
+        self.last_fetch_stats['failed'] = self.last_fetch_stats.get('failed', 0) + len(refs) - len(orders)
+        return orders
+    
+    async def iter_order_batches(
+        self,
+        date_from: datetime,
+        date_to: Optional[datetime] = None,
+        skip_unchanged: bool = False
+    ) -> AsyncIterator[List[Dict]]:
+        """
+        Gera lotes de pedidos completos, uma página da listagem por vez.
+        Com skip_unchanged, pedidos sem alteração não são expandidos; o maior
+        last_updated entre eles fica em last_fetch_stats['unchanged_max_updated'].
+        """
+        self.last_fetch_stats = {'listed': 0, 'failed': 0, 'unchanged': 0, 'unchanged_max_updated': None}
+        date_to = date_to or datetime.now(timezone.utc)
+        
+        async for refs in self.list_order_pages(date_from, date_to):
+            if not refs:
+                continue
+            self.last_fetch_stats['listed'] += len(refs)
+            if skip_unchanged:
+                refs = await self.drop_unchanged(refs)
+                if not refs:
+                    continue
+            yield await self.expand_orders(refs)
+    
+    async def fetch_orders_since(self, date_from: datetime, date_to: Optional[datetime] = None, skip_unchanged: bool = False) -> List[Dict]:
+        """Busca todos os pedidos alterados desde date_from"""
+        orders = []
+        async for batch in self.iter_order_batches(date_from, date_to, skip_unchanged):
+            orders.extend(batch)
+        
+        print(f"✅ {len(orders)} pedidos {self.marketplace} encontrados desde {date_from}")
+        return orders
+    
+    async def sync_since(self, date_from: datetime, date_to: Optional[datetime] = None, skip_unchanged: bool = False) -> Dict:
+        """
+        Ingestão em streaming: cada página é persistida em lote enquanto a próxima é
+        buscada (fila limitada, memória constante). Retorna as contagens somadas.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+        
+        async def produce():
+            try:
+                async for batch in self.iter_order_batches(date_from, date_to, skip_unchanged):
+                    await queue.put(batch)
+            except Exception as e:
+                # Erro da listagem/busca é repassado ao consumidor
+                await queue.put(e)
+                return
+            await queue.put(None)
+        
+        producer = asyncio.create_task(produce())
+        totals = {'fetched': 0, 'created': 0, 'updated': 0, 'failed': 0, 'queued': 0, 'processed': 0, 'max_last_updated': None}
+        
+        try:
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                result = await ingest_marketplace_orders(self, batch)
+                totals['fetched'] += len(batch)
+                for key in ('created', 'updated', 'failed', 'queued', 'processed'):
+                    totals[key] += result[key]
+                if result['max_last_updated'] and (totals['max_last_updated'] is None or result['max_last_updated'] > totals['max_last_updated']):
+                    totals['max_last_updated'] = result['max_last_updated']
+        finally:
+            if not producer.done():
+                producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+        
+        totals['failed'] += self.last_fetch_stats.get('failed', 0)
+        print(f"✅ {self.marketplace}: {totals['fetched']} pedidos ({totals['created']} novos, {totals['updated']} atualizados)")
+        return totals
+
 # ============= MERCADO LIVRE =============
 
-class MercadoLivreIntegrator:
+class MLTokenHolder:
+    """
+    Cache do access_token do Mercado Livre em memória (um por processo).
+    Renova antes de expirar e, com o lock, uma única renovação atende todos
+    os chamadores concorrentes - o ML invalida o refresh_token a cada uso.
+    """
+    
+    REFRESH_AHEAD = timedelta(minutes=5)
+    
+    def __init__(self):
+        self.access_token: Optional[str] = None
+        self.expires_at: Optional[datetime] = None
+        self.user_id: Optional[str] = None
+        # Token recusado com 401: o mesmo valor relido do banco não é reaproveitado
+        self.revoked_token: Optional[str] = None
+        self._lock = asyncio.Lock()
+    
+    def _is_fresh(self) -> bool:
+        if not self.access_token:
+            return False
+        if self.expires_at is None:
+            return True
+        return datetime.now(timezone.utc) < self.expires_at - self.REFRESH_AHEAD
+    
+    def store(self, creds: Dict):
+        """Atualiza o cache a partir de um documento de marketplace_credentials"""
+        self.access_token = creds.get('access_token')
+        self.expires_at = as_utc(creds.get('token_expires_at'))
+        self.user_id = str(creds['user_id']) if creds.get('user_id') else self.user_id
+    
+    def invalidate(self, token: Optional[str] = None):
+        """
+        Força renovação na próxima chamada. token: o access_token recusado; se o cache
+        já tem outro (renovado por um chamador concorrente), nada é descartado.
+        """
+        revoked = token or self.access_token
+        if not revoked or (self.access_token and self.access_token != revoked):
+            return
+        self.revoked_token = revoked
+        self.access_token = None
+        self.expires_at = None
+    
+    async def get_token(self, integrator: 'MercadoLivreIntegrator') -> str:
+        if self._is_fresh():
+            return self.access_token
+        
+        async with self._lock:
+            # Outro chamador pode ter renovado enquanto aguardávamos o lock
+            if self._is_fresh():
+                return self.access_token
+            
+            # Outro processo (API/cron) pode ter renovado e gravado no banco
+            creds = await integrator.get_credentials()
+            if not creds:
+                raise Exception("Nenhuma credencial encontrada. Execute autorização primeiro.")
+            if creds.get('access_token') != self.revoked_token:
+                self.store(creds)
+                if self._is_fresh():
+                    return self.access_token
+            
+            print("🔄 Token expirando, renovando...")
+            token_data = await integrator.refresh_token()
+            return token_data['access_token']
+
+_ml_token_holder = MLTokenHolder()
+
+class ShipmentCache:
+    """
+    Cache em memória de /shipments/{id} (LRU, um por processo) com ETag/Last-Modified.
+    
+    - Mesmo status de envio no pedido e entrada recente: reutiliza sem chamada HTTP (hit)
+    - Mesmo status mas entrada antiga: requisição condicional, 304 reaproveita o corpo (revalidated)
+    - Status do pedido diferente do cacheado: busca completa (bypass)
+    """
+    
+    def __init__(self, max_entries: int = 5000, ttl_seconds: float = 900):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: 'OrderedDict[str, Dict]' = OrderedDict()
+        self.stats = Counter()
+    
+    def lookup(self, shipment_id: str, order_shipping_status: Optional[str]) -> tuple:
+        """Retorna (decisão, entrada): 'hit', 'revalidate', 'bypass' ou 'miss'"""
+        entry = self._entries.get(shipment_id)
+        if entry is None:
+            return 'miss', None
+        
+        if order_shipping_status and entry['status'] and order_shipping_status != entry['status']:
+            del self._entries[shipment_id]
+            return 'bypass', None
+        
+        self._entries.move_to_end(shipment_id)
+        if time.monotonic() - entry['validated_at'] < self.ttl_seconds:
+            return 'hit', entry
+        return 'revalidate', entry
+    
+    def store(self, shipment_id: str, response: httpx.Response, body: Dict):
+        """Guarda corpo e validadores da resposta 200"""
+        self._entries[shipment_id] = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'status': body.get('status'),
+            'body': body,
+            'validated_at': time.monotonic()
+        }
+        self._entries.move_to_end(shipment_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def touch(self, shipment_id: str):
+        """Entrada confirmada por 304"""
+        entry = self._entries.get(shipment_id)
+        if entry:
+            entry['validated_at'] = time.monotonic()
+    
+    def record(self, outcome: str):
+        self.stats[outcome] += 1
+        self.stats['lookups'] += 1
+    
+    def hit_ratio(self, stats: Optional[Dict] = None) -> float:
+        """Fração de consultas atendidas pelo cache (hit + 304)"""
+        stats = self.stats if stats is None else stats
+        lookups = stats.get('lookups', 0)
+        return (stats.get('hit', 0) + stats.get('revalidated', 0)) / lookups if lookups else 0.0
+
+_ml_shipment_cache = ShipmentCache(
+    max_entries=int(os.environ.get('ML_SHIPMENT_CACHE_MAX_ENTRIES', '5000')),
+    ttl_seconds=float(os.environ.get('ML_SHIPMENT_CACHE_TTL_SECONDS', '900'))
+)
+
+class MercadoLivreIntegrator(MarketplaceConnector):
     """Integrador Mercado Livre com OAuth2 + PKCE"""
     
+    marketplace = 'MERCADO_LIVRE'
+    env_prefix = 'ML'
+    DEFAULT_BASE_URL = 'https://api.mercadolibre.com'
+    # Limite máximo de resultados por página em /orders/search
+    SEARCH_PAGE_SIZE = 50
+    
     def __init__(self):
+        super().__init__()
         self.client_id = os.environ.get('ML_CLIENT_ID', '')
         self.client_secret = os.environ.get('ML_CLIENT_SECRET', '')
         self.redirect_uri = os.environ.get('ML_REDIRECT_URI', 'http://localhost:8001/api/integrator/mercadolivre/callback')
-        self.base_url = 'https://api.mercadolibre.com'
         self.auth_url = 'https://auth.mercadolivre.com.br'
-        
+    
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Requisição na API do ML com rate limit, limite de concorrência e retry"""
+        response = await super()._request(method, path, **kwargs)
+        auth = (kwargs.get('headers') or {}).get('Authorization', '')
+        if response.status_code == 401 and auth.startswith('Bearer '):
+            # Token revogado/expirado fora do previsto: próxima chamada renova
+            _ml_token_holder.invalidate(auth[len('Bearer '):])
+        return response
+    
     def generate_pkce_pair(self) -> tuple:
         """Gera code_verifier e code_challenge para PKCE"""
         # Code verifier: string aleatória de 43-128 caracteres
@@ -79,35 +663,32 @@ class MercadoLivreIntegrator:
         """
         Troca o código de autorização por access_token usando PKCE
         """
-        async with httpx.AsyncClient() as client:
-            # URL correta para trocar token
-            token_url = f"{self.base_url}/oauth/token"
-            
-            response = await client.post(
-                token_url,
-                data={
-                    'grant_type': 'authorization_code',
-                    'client_id': self.client_id,
-                    'client_secret': self.client_secret,
-                    'code': code,
-                    'redirect_uri': self.redirect_uri,
-                    'code_verifier': code_verifier
-                },
-                headers={
-                    'Accept': 'application/json',
-                    'Content-Type': 'application/x-www-form-urlencoded'
-                }
-            )
-            
-            if response.status_code != 200:
-                raise Exception(f"Erro ao obter token (status {response.status_code}): {response.text[:500]}")
-            
-            token_data = response.json()
-            
-            # Salvar credenciais no banco
-            await self.save_credentials(token_data)
-            
-            return token_data
+        response = await self._request(
+            'POST', '/oauth/token',
+            data={
+                'grant_type': 'authorization_code',
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+                'code': code,
+                'redirect_uri': self.redirect_uri,
+                'code_verifier': code_verifier
+            },
+            headers={
+                'Accept': 'application/json',
+                'Content-Type': 'application/x-www-form-urlencoded'
+            },
+            single_use=True
+        )
+        
+        if response.status_code != 200:
+            raise Exception(f"Erro ao obter token (status {response.status_code}): {response.text[:500]}")
+        
+        token_data = response.json()
+        
+        # Salvar credenciais no banco
+        await self.save_credentials(token_data)
+        
+        return token_data
     
     async def save_credentials(self, token_data: Dict):
         """Salva ou atualiza credenciais do Mercado Livre"""
@@ -121,180 +702,212 @@ class MercadoLivreIntegrator:
         }
         
         # Atualizar ou inserir
-        await db.marketplace_credentials.update_one(
-            {'marketplace': 'MERCADO_LIVRE'},
-            {'$set': credentials},
-            upsert=True
-        )
+        await self._persist_credentials(credentials)
+        
+        # Write-through: cache em memória acompanha o que foi gravado no banco
+        _ml_token_holder.store(credentials)
         
         print(f"✅ Credenciais Mercado Livre salvas. User ID: {credentials['user_id']}")
     
-    async def get_credentials(self) -> Optional[Dict]:
-        """Busca credenciais armazenadas"""
-        creds = await db.marketplace_credentials.find_one({'marketplace': 'MERCADO_LIVRE'})
-        return creds
-    
-    async def refresh_token(self) -> Dict:
-        """Renova o access_token usando refresh_token"""
+    async def refresh_token(self, creds: Optional[Dict] = None) -> Dict:
+        """Renova o access_token usando refresh_token (relido do banco: o ML invalida o anterior a cada uso)"""
         creds = await self.get_credentials()
         
         if not creds or not creds.get('refresh_token'):
             raise Exception("Nenhuma credencial encontrada. Execute autorização primeiro.")
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/oauth/token",
-                data={
-                    'grant_type': 'refresh_token',
-                    'client_id': self.client_id,
-                    'client_secret': self.client_secret,
-                    'refresh_token': creds['refresh_token']
-                },
-                headers={
-                    'Accept': 'application/json',
-                    'Content-Type': 'application/x-www-form-urlencoded'
-                }
-            )
-            
-            if response.status_code != 200:
-                raise Exception(f"Erro ao renovar token: {response.text[:500]}")
-            
-            token_data = response.json()
-            await self.save_credentials(token_data)
-            
-            return token_data
-    
-    async def ensure_valid_token(self) -> str:
-        """Garante que temos um token válido, renovando se necessário"""
-        creds = await self.get_credentials()
+        response = await self._request(
+            'POST', '/oauth/token',
+            data={
+                'grant_type': 'refresh_token',
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+                'refresh_token': creds['refresh_token']
+            },
+            headers={
+                'Accept': 'application/json',
+                'Content-Type': 'application/x-www-form-urlencoded'
+            },
+            single_use=True
+        )
         
-        if not creds:
-            raise Exception("Nenhuma credencial encontrada. Execute autorização primeiro.")
+        if response.status_code != 200:
+            raise Exception(f"Erro ao renovar token: {response.text[:500]}")
         
-        # Verificar se token está próximo de expirar (menos de 5 minutos)
-        expires_at = creds.get('token_expires_at')
-        if expires_at:
-            # Garantir que expires_at tem timezone
-            if not isinstance(expires_at, datetime):
-                # Se for string, converter
-                if isinstance(expires_at, str):
-                    expires_at = datetime.fromisoformat(expires_at.replace('Z', '+00:00'))
-                else:
-                    expires_at = None
-            elif expires_at.tzinfo is None:
-                # Se não tem timezone, adicionar UTC
-                expires_at = expires_at.replace(tzinfo=timezone.utc)
-            
-            if expires_at and datetime.now(timezone.utc) >= expires_at - timedelta(minutes=5):
-                print("🔄 Token expirando, renovando...")
-                token_data = await self.refresh_token()
-                return token_data['access_token']
-        
-        return creds['access_token']
-    
-    async def fetch_orders_since(self, date_from: datetime, seller_id: str = None) -> List[Dict]:
-        """
-        Busca pedidos do Mercado Livre desde uma data específica
+        token_data = response.json()
+        await self.save_credentials(token_data)
         
-        Args:
-            date_from: Data inicial para buscar pedidos
-            seller_id: ID do vendedor (se não informado, busca das credenciais)
-        """
-        access_token = await self.ensure_valid_token()
+        return token_data
+    
+    async def ensure_valid_token(self) -> Dict:
+        """Garante que temos um token válido, renovando se necessário (cache em memória do processo)"""
+        access_token = await _ml_token_holder.get_token(self)
+        return {'access_token': access_token, 'user_id': _ml_token_holder.user_id}
+    
+    async def _resolve_seller_id(self, seller_id: Optional[str] = None) -> str:
+        """seller_id informado, do cache do token ou das credenciais gravadas"""
+        if not seller_id:
+            seller_id = _ml_token_holder.user_id
         
         if not seller_id:
             creds = await self.get_credentials()
-            seller_id = creds.get('user_id')
+            seller_id = creds.get('user_id') if creds else None
         
         if not seller_id:
             raise Exception("seller_id não encontrado")
+        return seller_id
+    
+    def invalidate_token(self):
+        _ml_token_holder.invalidate()
+    
+    def _format_ml_date(self, value: datetime) -> str:
+        """Data UTC no formato ISO 8601 aceito pelos filtros de /orders/search"""
+        return as_utc(value).isoformat(timespec='milliseconds')
+    
+    async def list_order_pages(self, date_from: datetime, date_to: datetime) -> AsyncIterator[List]:
+        """
+        Gancho do conector: pedidos com date_last_updated na janela, paginados por offset/limit.
+        Cada página é entregue assim que chega, como na Shopee/TikTok.
+        """
+        seller_id = await self._resolve_seller_id()
+        seen = set()
+        offset = 0
         
-        # Formatar data para ISO 8601
-        date_str = date_from.strftime('%Y-%m-%dT%H:%M:%S.000-00:00')
+        while True:
+            access_token = (await self.ensure_valid_token())['access_token']
+            response = await self._request('GET', '/orders/search', params={
+                'seller': seller_id,
+                'order.date_last_updated.from': self._format_ml_date(date_from),
+                'order.date_last_updated.to': self._format_ml_date(date_to),
+                'sort': 'date_asc',
+                'offset': offset,
+                'limit': self.SEARCH_PAGE_SIZE
+            }, headers={'Authorization': f'Bearer {access_token}'})
+            
+            if response.status_code != 200:
+                raise Exception(f"Erro ao buscar pedidos ML (offset {offset}): {response.status_code} - {response.text[:300]}")
+            
+            data = response.json()
+            results = data.get('results', [])
+            
+            # Pedidos atualizados durante a paginação podem reaparecer em outra página
+            page = [o for o in results if str(o.get('id')) not in seen]
+            seen.update(str(o.get('id')) for o in page)
+            yield page
+            
+            offset += len(results)
+            total = int(data.get('paging', {}).get('total', 0))
+            if not results or offset >= total:
+                break
+    
+    async def fetch_order_batch(self, refs: List) -> List[Dict]:
+        """Gancho do conector: um pedido por chamada (/orders/{id} + envio)"""
+        order = refs[0]
+        order_id = str(order.get('id')) if isinstance(order, dict) else str(order)
+        return [await self.fetch_order_detail(order_id)]
+    
+    async def iter_order_batches(
+        self,
+        date_from: datetime,
+        date_to: Optional[datetime] = None,
+        skip_unchanged: bool = False
+    ) -> AsyncIterator[List[Dict]]:
+        """Pipeline do conector; ao final registra os acertos do cache de envios em last_fetch_stats"""
+        cache_before = Counter(_ml_shipment_cache.stats)
+        async for batch in super().iter_order_batches(date_from, date_to, skip_unchanged):
+            yield batch
         
-        all_orders = []
-        offset = 0
-        limit = 50
+        cache_stats = dict(_ml_shipment_cache.stats - cache_before)
+        cache_stats['hit_ratio'] = round(_ml_shipment_cache.hit_ratio(cache_stats), 3)
+        self.last_fetch_stats['shipment_cache'] = cache_stats
+        if cache_stats.get('lookups'):
+            print(f"📦 Cache de envios: {cache_stats['hit_ratio']:.0%} de acerto ({cache_stats.get('hit', 0)} hits, {cache_stats.get('revalidated', 0)} 304, {cache_stats.get('miss', 0) + cache_stats.get('bypass', 0)} buscas)")
+    
+    async def drop_unchanged(self, refs: List) -> List:
+        """Remove da página os pedidos cujo last_updated da busca é igual ao já persistido"""
+        order_ids = [self.order_ref(order) for order in refs]
+        stored = await db.orders.find(
+            {'marketplace': 'MERCADO_LIVRE', 'marketplace_order_id': {'$in': order_ids}},
+            {'_id': 0, 'marketplace_order_id': 1, 'last_updated_at': 1}
+        ).to_list(None)
+        stored_updates = {o['marketplace_order_id']: as_utc(o.get('last_updated_at')) for o in stored}
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            while True:
-                # Buscar lista de pedidos
-                search_url = f"{self.base_url}/orders/search"
-                params = {
-                    'seller': seller_id,
-                    'order.date_created.from': date_str,
-                    'sort': 'date_desc',
-                    'offset': offset,
-                    'limit': limit
-                }
-                
-                headers = {'Authorization': f'Bearer {access_token}'}
-                
-                response = await client.get(search_url, params=params, headers=headers)
-                
-                if response.status_code != 200:
-                    print(f"❌ Erro ao buscar pedidos: {response.status_code} - {response.text}")
-                    break
-                
-                data = response.json()
-                results = data.get('results', [])
-                
-                if not results:
-                    break
-                
-                # Para cada pedido, buscar detalhes completos
-                for order in results:
-                    try:
-                        # Extrair o ID do pedido do objeto
-                        order_id = str(order.get('id')) if isinstance(order, dict) else str(order)
-                        order_detail = await self.fetch_order_detail(order_id, access_token)
-                        if order_detail:
-                            all_orders.append(order_detail)
-                    except Exception as e:
-                        print(f"❌ Erro ao buscar detalhes do pedido: {e}")
-                        continue
-                
-                # Paginação
-                if len(results) < limit:
-                    break
-                
-                offset += limit
+        changed = []
+        unchanged_max = self.last_fetch_stats.get('unchanged_max_updated')
+        for order_id, order in zip(order_ids, refs):
+            remote_update = self._parse_ml_date(order.get('last_updated'))
+            if remote_update is None or stored_updates.get(order_id) != remote_update:
+                changed.append(order)
+            elif unchanged_max is None or remote_update > unchanged_max:
+                unchanged_max = remote_update
         
-        print(f"✅ {len(all_orders)} pedidos encontrados desde {date_from}")
-        return all_orders
+        skipped = len(refs) - len(changed)
+        self.last_fetch_stats['unchanged'] = self.last_fetch_stats.get('unchanged', 0) + skipped
+        self.last_fetch_stats['unchanged_max_updated'] = unchanged_max
+        if skipped:
+            print(f"⏭️  {skipped} pedidos sem alteração desde a última sincronização")
+        return changed
     
     async def fetch_order_detail(self, order_id: str, access_token: str = None) -> Optional[Dict]:
         """Busca detalhes completos de um pedido"""
         if not access_token:
-            access_token = await self.ensure_valid_token()
+            access_token = (await self.ensure_valid_token())['access_token']
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            # Buscar pedido
-            order_url = f"{self.base_url}/orders/{order_id}"
-            headers = {'Authorization': f'Bearer {access_token}'}
-            
-            response = await client.get(order_url, headers=headers)
-            
-            if response.status_code != 200:
-                print(f"❌ Erro ao buscar pedido {order_id}: {response.text}")
-                return None
-            
-            order_data = response.json()
-            
-            # Buscar dados de shipment se existir
-            shipment_data = None
-            if order_data.get('shipping', {}).get('id'):
-                shipment_id = order_data['shipping']['id']
-                shipment_url = f"{self.base_url}/shipments/{shipment_id}"
-                
-                shipment_response = await client.get(shipment_url, headers=headers)
-                if shipment_response.status_code == 200:
-                    shipment_data = shipment_response.json()
-            
-            # Combinar dados
-            order_data['_shipment_detail'] = shipment_data
-            
-            return order_data
+        headers = {'Authorization': f'Bearer {access_token}'}
+        
+        # Buscar pedido
+        response = await self._request('GET', f"/orders/{order_id}", headers=headers)
+        
+        if response.status_code != 200:
+            print(f"❌ Erro ao buscar pedido {order_id}: {response.text}")
+            return None
+        
+        order_data = response.json()
+        
+        # Buscar dados de shipment se existir
+        shipment_data = None
+        if order_data.get('shipping', {}).get('id'):
+            shipment_data = await self.fetch_shipment(
+                str(order_data['shipping']['id']),
+                order_data['shipping'].get('status'),
+                headers
+            )
+        
+        # Combinar dados
+        order_data['_shipment_detail'] = shipment_data
+        
+        return order_data
+    
+    async def fetch_shipment(self, shipment_id: str, order_shipping_status: Optional[str], headers: Dict) -> Optional[Dict]:
+        """Busca /shipments/{id} passando pelo cache condicional (If-None-Match / If-Modified-Since)"""
+        cache = _ml_shipment_cache
+        decision, entry = cache.lookup(shipment_id, order_shipping_status)
+        
+        if decision == 'hit':
+            cache.record('hit')
+            return entry['body']
+        
+        request_headers = dict(headers)
+        if entry:
+            if entry['etag']:
+                request_headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                request_headers['If-Modified-Since'] = entry['last_modified']
+        
+        response = await self._request('GET', f"/shipments/{shipment_id}", headers=request_headers)
+        
+        if response.status_code == 304 and entry:
+            cache.touch(shipment_id)
+            cache.record('revalidated')
+            return entry['body']
+        
+        cache.record(decision)
+        if response.status_code != 200:
+            return None
+        
+        shipment_data = response.json()
+        cache.store(shipment_id, response, shipment_data)
+        return shipment_data
     
     def map_to_internal_order(self, ml_order: Dict) -> Dict:
         """Mapeia pedido do Mercado Livre para formato interno"""
@@ -416,6 +1029,7 @@ class MercadoLivreIntegrator:
         for item in ml_order.get('order_items', []):
             internal_item = {
                 'internal_order_id': internal_order_id,
+                'marketplace': 'MERCADO_LIVRE',
                 'marketplace_order_id': str(ml_order.get('id', '')),
                 'marketplace_item_id': str(item.get('item', {}).get('id', '')),
                 'marketplace_variation_id': str(item.get('item', {}).get('variation_id', '')),
@@ -474,22 +1088,40 @@ class MercadoLivreIntegrator:
         except:
             return None
 
-
 # ============= SHOPEE =============
 
-class ShopeeIntegrator:
+class ShopeeIntegrator(MarketplaceConnector):
     """Integrador Shopee com autenticação HMAC"""
     
-    def __init__(self):
+    marketplace = 'SHOPEE'
+    env_prefix = 'SHOPEE'
+    DEFAULT_BASE_URL = 'https://partner.shopeemobile.com'
+    DEFAULT_CONCURRENCY = 4
+    
+    # Limites da Open Platform v2
+    PAGE_SIZE = 100
+    DETAIL_BATCH_SIZE = 50
+    MAX_WINDOW = timedelta(days=15)
+    DETAIL_FIELDS = (
+        'buyer_user_id,buyer_username,recipient_address,item_list,pay_time,package_list,'
+        'shipping_carrier,payment_method,total_amount,estimated_shipping_fee,actual_shipping_fee,'
+        'cancel_reason,message_to_seller'
+    )
+    
+    def __init__(self, time_range_field: str = 'update_time'):
+        super().__init__()
         self.partner_id = int(os.environ.get('SHOPEE_PARTNER_ID', '0'))
         self.partner_key = os.environ.get('SHOPEE_PARTNER_KEY', '')
         self.shop_id = int(os.environ.get('SHOPEE_SHOP_ID', '0'))
-        self.base_url = 'https://partner.shopeemobile.com'
+        # update_time (sync incremental) ou create_time
+        self.time_range_field = time_range_field
     
     def generate_signature(self, path: str, timestamp: int, access_token: str = '', shop_id: int = 0) -> str:
         """Gera assinatura HMAC SHA256 para Shopee API"""
-        # Base string: partner_id + path + timestamp + access_token + shop_id
-        base_string = f"{self.partner_id}{path}{timestamp}{access_token}{shop_id}"
+        # Base string: partner_id + path + timestamp (+ access_token + shop_id nos endpoints de loja)
+        base_string = f"{self.partner_id}{path}{timestamp}"
+        if shop_id:
+            base_string += f"{access_token}{shop_id}"
         
         # HMAC SHA256
         signature = hmac.new(
@@ -528,34 +1160,32 @@ class ShopeeIntegrator:
         path = '/api/v2/auth/token/get'
         timestamp = int(datetime.now(timezone.utc).timestamp())
         
-        signature = self.generate_signature(path, timestamp, shop_id=shop_id)
+        signature = self.generate_signature(path, timestamp)
         
-        url = f"{self.base_url}{path}"
+        response = await self._request(
+            'POST', path,
+            params={
+                'partner_id': self.partner_id,
+                'timestamp': timestamp,
+                'sign': signature
+            },
+            json={
+                'code': code,
+                'shop_id': shop_id,
+                'partner_id': self.partner_id
+            },
+            single_use=True
+        )
         
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                url,
-                params={
-                    'partner_id': self.partner_id,
-                    'timestamp': timestamp,
-                    'sign': signature
-                },
-                json={
-                    'code': code,
-                    'shop_id': shop_id,
-                    'partner_id': self.partner_id
-                }
-            )
-            
-            if response.status_code != 200:
-                raise Exception(f"Erro ao obter token Shopee: {response.text}")
-            
-            token_data = response.json()
-            
-            # Salvar credenciais
-            await self.save_credentials(token_data, shop_id)
-            
-            return token_data
+        if response.status_code != 200:
+            raise Exception(f"Erro ao obter token Shopee: {response.text}")
+        
+        token_data = response.json()
+        
+        # Salvar credenciais
+        await self.save_credentials(token_data, shop_id)
+        
+        return token_data
     
     async def save_credentials(self, token_data: Dict, shop_id: int):
         """Salva credenciais Shopee"""
@@ -568,109 +1198,1081 @@ class ShopeeIntegrator:
             'updated_at': datetime.now(timezone.utc)
         }
         
-        await db.marketplace_credentials.update_one(
-            {'marketplace': 'SHOPEE', 'shop_id': str(shop_id)},
-            {'$set': credentials},
-            upsert=True
-        )
+        await self._persist_credentials(credentials, {'marketplace': 'SHOPEE', 'shop_id': str(shop_id)})
         
         print(f"✅ Credenciais Shopee salvas. Shop ID: {shop_id}")
     
-    # TODO: Implementar fetch_orders_since, mapeamento, etc.
-    # (Estrutura similar ao Mercado Livre)
-
+    def credentials_query(self) -> Dict:
+        """Loja do SHOPEE_SHOP_ID ou a primeira conectada"""
+        query = {'marketplace': 'SHOPEE'}
+        if self.shop_id:
+            query['shop_id'] = str(self.shop_id)
+        return query
+    
+    async def refresh_token(self, creds: Dict) -> Dict:
+        """Renova o access_token da loja usando o refresh_token"""
+        path = '/api/v2/auth/access_token/get'
+        timestamp = int(datetime.now(timezone.utc).timestamp())
+        shop_id = int(creds['shop_id'])
+        
+        response = await self._request(
+            'POST', path,
+            params={
+                'partner_id': self.partner_id,
+                'timestamp': timestamp,
+                'sign': self.generate_signature(path, timestamp)
+            },
+            json={
+                'refresh_token': creds.get('refresh_token', ''),
+                'partner_id': self.partner_id,
+                'shop_id': shop_id
+            },
+            single_use=True
+        )
+        
+        token_data = response.json() if response.status_code == 200 else {}
+        if not token_data.get('access_token'):
+            raise Exception(f"Erro ao renovar token Shopee: {response.text[:500]}")
+        
+        await self.save_credentials(token_data, shop_id)
+        return token_data
+    
+    async def _shop_get(self, path: str, params: Dict) -> Dict:
+        """GET assinado em endpoint de loja; erros da Shopee vêm no corpo com HTTP 200"""
+        creds = await self.ensure_valid_token()
+        timestamp = int(datetime.now(timezone.utc).timestamp())
+        shop_id = int(creds['shop_id'])
+        
+        signed = {
+            'partner_id': self.partner_id,
+            'timestamp': timestamp,
+            'access_token': creds['access_token'],
+            'shop_id': shop_id,
+            'sign': self.generate_signature(path, timestamp, creds['access_token'], shop_id)
+        }
+        response = await self._request('GET', path, params={**params, **signed})
+        
+        data = response.json() if response.headers.get('content-type', '').startswith('application/json') else {}
+        if response.status_code != 200 or data.get('error'):
+            if data.get('error') == 'error_auth':
+                self.invalidate_token()
+            raise Exception(f"Erro Shopee em {path} ({response.status_code}): {data.get('error')} {data.get('message', response.text[:300])}")
+        
+        return data.get('response', {})
+    
+    async def list_order_pages(self, date_from: datetime, date_to: datetime) -> AsyncIterator[List]:
+        """
+        Gancho do conector: order_sn alterados/criados na janela, com paginação por cursor.
+        A API aceita no máximo 15 dias por consulta, então a janela é fatiada.
+        """
+        seen = set()
+        window_start = date_from
+        
+        while window_start < date_to:
+            window_end = min(date_to, window_start + self.MAX_WINDOW)
+            cursor = ''
+            
+            while True:
+                data = await self._shop_get('/api/v2/order/get_order_list', {
+                    'time_range_field': self.time_range_field,
+                    'time_from': int(window_start.timestamp()),
+                    'time_to': int(window_end.timestamp()),
+                    'page_size': self.PAGE_SIZE,
+                    'cursor': cursor,
+                    'response_optional_fields': 'order_status'
+                })
+                
+                # Pedidos podem aparecer em duas fatias
+                page = [o['order_sn'] for o in data.get('order_list', []) if o['order_sn'] not in seen]
+                seen.update(page)
+                yield page
+                
+                if not data.get('more'):
+                    break
+                cursor = data.get('next_cursor', '')
+            
+            window_start = window_end
+    
+    def order_ref(self, order: Dict) -> str:
+        return str(order.get('order_sn', ''))
+    
+    async def fetch_order_batch(self, refs: List) -> List[Dict]:
+        """Gancho do conector: até 50 order_sn por chamada"""
+        data = await self._shop_get('/api/v2/order/get_order_detail', {
+            'order_sn_list': ','.join(refs),
+            'response_optional_fields': self.DETAIL_FIELDS
+        })
+        return data.get('order_list', [])
+    
+    # ----- Mapeamento para as entidades internas (Order, OrderItem, Payment, Shipment) -----
+    
+    def map_to_internal_order(self, order: Dict) -> Dict:
+        """Mapeia pedido Shopee (get_order_detail) para formato interno"""
+        order_sn = str(order.get('order_sn', ''))
+        address = order.get('recipient_address') or {}
+        packages = order.get('package_list') or []
+        first_package = packages[0] if packages else {}
+        
+        subtotal_items = 0.0
+        for item in order.get('item_list', []):
+            subtotal_items += float(item.get('model_discounted_price', 0)) * int(item.get('model_quantity_purchased', 1))
+        
+        shipping_status = first_package.get('logistics_status', '')
+        carrier = order.get('shipping_carrier') or first_package.get('shipping_carrier', '')
+        
+        return {
+            'marketplace': 'SHOPEE',
+            'marketplace_order_id': order_sn,
+            'order_number_display': order_sn,
+            
+            'status_general': self._map_shopee_status(order.get('order_status', '')),
+            'status_payment': 'approved' if order.get('pay_time') else 'pending',
+            'status_fulfillment': shipping_status,
+            
+            'created_at_marketplace': self._from_timestamp(order.get('create_time')),
+            'paid_at': self._from_timestamp(order.get('pay_time')),
+            'last_updated_at': self._from_timestamp(order.get('update_time')),
+            
+            'buyer_id_marketplace': str(order.get('buyer_user_id', '')),
+            'buyer_username': order.get('buyer_username', ''),
+            'buyer_full_name': address.get('name', ''),
+            'buyer_phone': address.get('phone', ''),
+            
+            'ship_to_name': address.get('name', ''),
+            'ship_to_phone': address.get('phone', ''),
+            'ship_to_street': address.get('full_address', ''),
+            'ship_to_district': address.get('district', '') or address.get('town', ''),
+            'ship_to_city': address.get('city', ''),
+            'ship_to_state': address.get('state', ''),
+            'ship_to_zipcode': address.get('zipcode', ''),
+            'ship_to_country': address.get('region', 'BR'),
+            
+            'currency': order.get('currency', 'BRL'),
+            'subtotal_items': subtotal_items,
+            'shipping_cost_charged': float(order.get('estimated_shipping_fee', 0) or 0),
+            'shipping_cost_real': float(order.get('actual_shipping_fee', 0) or 0),
+            'total_amount_buyer': float(order.get('total_amount', 0) or 0),
+            
+            'shipment_id_marketplace': str(first_package.get('package_number', '')),
+            'shipping_status': shipping_status,
+            'shipping_method': carrier,
+            'shipping_sla_ship_by': self._from_timestamp(order.get('ship_by_date')),
+            'tracking_carrier': carrier,
+            
+            'cancel_reason': order.get('cancel_reason', ''),
+            'marketplace_notes': order.get('message_to_seller', ''),
+            
+            'updated_at': datetime.now(timezone.utc)
+        }
+    
+    def map_to_internal_items(self, order: Dict, internal_order_id: str) -> List[Dict]:
+        """Mapeia itens do pedido Shopee para formato interno"""
+        items = []
+        
+        for item in order.get('item_list', []):
+            quantity = int(item.get('model_quantity_purchased', 1))
+            unit_price = float(item.get('model_discounted_price', 0))
+            model_id = str(item.get('model_id', '') or '')
+            
+            items.append({
+                'internal_order_id': internal_order_id,
+                'marketplace': 'SHOPEE',
+                'marketplace_order_id': str(order.get('order_sn', '')),
+                # item_id + model_id: a mesma anúncio pode vir com variações diferentes
+                'marketplace_item_id': f"{item.get('item_id', '')}:{model_id}" if model_id and model_id != '0' else str(item.get('item_id', '')),
+                'marketplace_variation_id': model_id,
+                
+                'seller_sku': item.get('model_sku') or item.get('item_sku', ''),
+                'product_title': item.get('item_name', ''),
+                'variation_name': item.get('model_name', ''),
+                
+                'quantity': quantity,
+                'unit_price': unit_price,
+                'original_unit_price': float(item.get('model_original_price', 0)),
+                'total_price_item': unit_price * quantity,
+                'currency': order.get('currency', 'BRL'),
+                'weight_kg': float(item.get('weight', 0) or 0),
+                
+                'updated_at': datetime.now(timezone.utc)
+            })
+        
+        return items
+    
+    def map_to_internal_payments(self, order: Dict, internal_order_id: str) -> List[Dict]:
+        """Shopee não expõe ID de pagamento: um pagamento por pedido, identificado pelo order_sn"""
+        if not order.get('pay_time'):
+            return []
+        
+        total = float(order.get('total_amount', 0) or 0)
+        return [{
+            'internal_order_id': internal_order_id,
+            'marketplace_payment_id': f"SHOPEE-{order.get('order_sn', '')}",
+            'method': order.get('payment_method', ''),
+            'status': 'refunded' if order.get('order_status') == 'CANCELLED' else 'approved',
+            'transaction_amount': total,
+            'total_paid_amount': total,
+            'currency': order.get('currency', 'BRL'),
+            'paid_at': self._from_timestamp(order.get('pay_time')),
+            'updated_at': datetime.now(timezone.utc)
+        }]
+    
+    def map_to_internal_shipments(self, order: Dict, internal_order_id: str) -> List[Dict]:
+        """Um envio por pacote (package_list)"""
+        address = order.get('recipient_address') or {}
+        shipments = []
+        
+        for package in order.get('package_list') or []:
+            if not package.get('package_number'):
+                continue
+            shipments.append({
+                'internal_order_id': internal_order_id,
+                'marketplace_shipment_id': str(package['package_number']),
+                'carrier_name': package.get('shipping_carrier', '') or order.get('shipping_carrier', ''),
+                'logistics_channel_id': str(package.get('logistics_channel_id', '')),
+                'status': package.get('logistics_status', ''),
+                'ship_by_deadline': self._from_timestamp(order.get('ship_by_date')),
+                'receiver_name': address.get('name', ''),
+                'receiver_phone': address.get('phone', ''),
+                'receiver_street': address.get('full_address', ''),
+                'receiver_district': address.get('district', '') or address.get('town', ''),
+                'receiver_city': address.get('city', ''),
+                'receiver_state': address.get('state', ''),
+                'receiver_zipcode': address.get('zipcode', ''),
+                'receiver_country': address.get('region', 'BR'),
+                'updated_at': datetime.now(timezone.utc)
+            })
+        
+        return shipments
+    
+    def _map_shopee_status(self, shopee_status: str) -> str:
+        """Mapeia status da Shopee para status geral interno"""
+        status_map = {
+            'UNPAID': 'pending',
+            'INVOICE_PENDING': 'pending',
+            'READY_TO_SHIP': 'paid',
+            'PROCESSED': 'ready_to_ship',
+            'RETRY_SHIP': 'ready_to_ship',
+            'SHIPPED': 'shipped',
+            'TO_CONFIRM_RECEIVE': 'shipped',
+            'COMPLETED': 'delivered',
+            'IN_CANCEL': 'cancelled',
+            'CANCELLED': 'cancelled',
+            'TO_RETURN': 'returned'
+        }
+        return status_map.get(shopee_status, shopee_status.lower())
 
-# ============= FUNÇÕES DE PERSISTÊNCIA =============
+# ============= TIKTOK SHOP =============
 
-async def save_or_update_order(order_data: Dict) -> str:
-    """Salva ou atualiza pedido na collection orders"""
-    marketplace_order_id = order_data.get('marketplace_order_id')
+class TikTokShopIntegrator(MarketplaceConnector):
+    """Integrador TikTok Shop (Partner API 202309) com assinatura HMAC"""
     
-    # Verificar se já existe
-    existing = await db.orders.find_one({'marketplace_order_id': marketplace_order_id})
+    marketplace = 'TIKTOK_SHOP'
+    env_prefix = 'TIKTOK'
+    DEFAULT_BASE_URL = 'https://open-api.tiktokglobalshop.com'
+    DEFAULT_CONCURRENCY = 4
     
-    if existing:
-        # Atualizar
-        await db.orders.update_one(
-            {'marketplace_order_id': marketplace_order_id},
-            {'$set': order_data}
+    PAGE_SIZE = 100
+    DETAIL_BATCH_SIZE = 50
+    # Códigos de token inválido/expirado
+    AUTH_ERROR_CODES = {105001, 105002, 36004004}
+    
+    def __init__(self):
+        super().__init__()
+        self.app_key = os.environ.get('TIKTOK_APP_KEY', '')
+        self.app_secret = os.environ.get('TIKTOK_APP_SECRET', '')
+        self.service_id = os.environ.get('TIKTOK_SERVICE_ID', '')
+        self.shop_id = os.environ.get('TIKTOK_SHOP_ID', '')
+        self.auth_base_url = os.environ.get('TIKTOK_AUTH_BASE_URL', 'https://auth.tiktok-shops.com')
+    
+    def generate_signature(self, path: str, params: Dict, body: str = '') -> str:
+        """
+        Assinatura HMAC SHA256: app_secret + path + parâmetros ordenados (chave+valor,
+        sem sign e access_token) + corpo + app_secret
+        """
+        ordered = ''.join(f"{key}{params[key]}" for key in sorted(params) if key not in ('sign', 'access_token'))
+        base_string = f"{self.app_secret}{path}{ordered}{body}{self.app_secret}"
+        
+        return hmac.new(
+            self.app_secret.encode('utf-8'),
+            base_string.encode('utf-8'),
+            hashlib.sha256
+        ).hexdigest()
+    
+    async def authorize(self) -> Dict:
+        """URL para o vendedor autorizar o app"""
+        return {
+            'url': f"https://services.tiktokshop.com/open/authorize?{urlencode({'service_id': self.service_id, 'state': secrets.token_urlsafe(16)})}"
+        }
+    
+    async def _auth_call(self, path: str, params: Dict) -> Dict:
+        """Endpoints de token (host de autenticação, sem assinatura)"""
+        response = await request_with_retry(
+            get_http_client(self.auth_base_url), 'GET', path,
+            rate_limiter=self._rate_limiter,
+            semaphore=self._semaphore,
+            max_retries=self.max_retries,
+            single_use=True,
+            params={'app_key': self.app_key, 'app_secret': self.app_secret, **params}
         )
-        print(f"🔄 Pedido {marketplace_order_id} atualizado")
-        return existing['internal_order_id']
-    else:
-        # Inserir novo
-        if 'internal_order_id' not in order_data:
-            order_data['internal_order_id'] = str(secrets.token_urlsafe(16))
-        
-        order_data['inserted_at'] = datetime.now(timezone.utc)
-        await db.orders.insert_one(order_data)
-        print(f"✅ Pedido {marketplace_order_id} criado")
-        return order_data['internal_order_id']
-
-async def save_or_update_order_items(items_data: List[Dict]):
-    """Salva ou atualiza itens do pedido"""
-    for item in items_data:
-        marketplace_order_id = item.get('marketplace_order_id')
-        marketplace_item_id = item.get('marketplace_item_id')
+        data = response.json() if response.status_code == 200 else {}
+        if data.get('code') != 0:
+            raise Exception(f"Erro de autenticação TikTok Shop ({response.status_code}): {data.get('message', response.text[:300])}")
+        return data['data']
+    
+    async def get_access_token(self, auth_code: str) -> Dict:
+        """Troca o auth_code pelo token e identifica a loja autorizada (shop_cipher)"""
+        token_data = await self._auth_call('/api/v2/token/get', {
+            'auth_code': auth_code,
+            'grant_type': 'authorized_code'
+        })
+        
+        # shop_cipher é obrigatório nas chamadas de pedidos; o token só vai para o cache
+        # compartilhado (com expiração e cipher) em save_credentials
+        shops = (await self._shop_call(
+            'GET', '/authorization/202309/shops', signed_shop=False, access_token=token_data['access_token']
+        )).get('shops', [])
+        if not shops:
+            raise Exception("Nenhuma loja TikTok Shop autorizada para este app")
+        shop = next((s for s in shops if str(s.get('id')) == str(self.shop_id)), shops[0])
+        
+        await self.save_credentials(token_data, shop)
+        return token_data
+    
+    async def save_credentials(self, token_data: Dict, shop: Dict):
+        """Salva credenciais TikTok Shop (expirações vêm como timestamp absoluto)"""
+        credentials = {
+            'marketplace': 'TIKTOK_SHOP',
+            'shop_id': str(shop['id']),
+            'shop_name': shop.get('name', ''),
+            'shop_cipher': shop.get('cipher', ''),
+            'seller_name': token_data.get('seller_name', ''),
+            'access_token': token_data['access_token'],
+            'refresh_token': token_data.get('refresh_token', ''),
+            'token_expires_at': datetime.fromtimestamp(int(token_data['access_token_expire_in']), tz=timezone.utc),
+            'refresh_token_expires_at': datetime.fromtimestamp(int(token_data.get('refresh_token_expire_in', 0)), tz=timezone.utc),
+            'updated_at': datetime.now(timezone.utc)
+        }
+        
+        await self._persist_credentials(credentials, {'marketplace': 'TIKTOK_SHOP', 'shop_id': credentials['shop_id']})
         
-        # Verificar se já existe
-        existing = await db.order_items.find_one({
-            'marketplace_order_id': marketplace_order_id,
-            'marketplace_item_id': marketplace_item_id
+        print(f"✅ Credenciais TikTok Shop salvas. Shop ID: {credentials['shop_id']}")
+    
+    def credentials_query(self) -> Dict:
+        """Loja do TIKTOK_SHOP_ID ou a primeira conectada"""
+        query = {'marketplace': 'TIKTOK_SHOP'}
+        if self.shop_id:
+            query['shop_id'] = str(self.shop_id)
+        return query
+    
+    async def refresh_token(self, creds: Dict) -> Dict:
+        token_data = await self._auth_call('/api/v2/token/refresh', {
+            'refresh_token': creds.get('refresh_token', ''),
+            'grant_type': 'refresh_token'
         })
+        await self.save_credentials(token_data, {
+            'id': creds['shop_id'],
+            'name': creds.get('shop_name', ''),
+            'cipher': creds.get('shop_cipher', '')
+        })
+        return token_data
+    
+    async def _shop_call(
+        self, method: str, path: str, params: Optional[Dict] = None, body: Optional[Dict] = None,
+        signed_shop: bool = True, access_token: Optional[str] = None
+    ) -> Dict:
+        """
+        Chamada assinada; erros da TikTok vêm no campo `code` do corpo.
+        access_token: token explícito (ex.: recém-emitido, antes de a loja ser conhecida)
+        """
+        creds = {'access_token': access_token} if access_token else await self.ensure_valid_token()
         
-        if existing:
-            await db.order_items.update_one(
-                {'internal_order_item_id': existing['internal_order_item_id']},
-                {'$set': item}
-            )
-        else:
-            if 'internal_order_item_id' not in item:
-                item['internal_order_item_id'] = str(secrets.token_urlsafe(16))
+        query = {'app_key': self.app_key, 'timestamp': int(time.time()), **(params or {})}
+        if signed_shop:
+            query['shop_cipher'] = creds.get('shop_cipher', '')
+        payload = json.dumps(body, separators=(',', ':')) if body is not None else ''
+        query['sign'] = self.generate_signature(path, query, payload)
+        
+        response = await self._request(
+            method, path,
+            params=query,
+            content=payload or None,
+            headers={'x-tts-access-token': creds['access_token'], 'Content-Type': 'application/json'}
+        )
+        
+        data = response.json() if response.headers.get('content-type', '').startswith('application/json') else {}
+        if response.status_code != 200 or data.get('code') != 0:
+            if data.get('code') in self.AUTH_ERROR_CODES:
+                self.invalidate_token()
+            raise Exception(f"Erro TikTok Shop em {path} ({response.status_code}): {data.get('code')} {data.get('message', response.text[:300])}")
+        
+        return data.get('data') or {}
+    
+    async def list_order_pages(self, date_from: datetime, date_to: datetime) -> AsyncIterator[List]:
+        """Gancho do conector: pedidos alterados na janela (a busca já devolve o pedido completo)"""
+        page_token = ''
+        while True:
+            params = {'page_size': self.PAGE_SIZE, 'sort_field': 'update_time', 'sort_order': 'ASC'}
+            if page_token:
+                params['page_token'] = page_token
             
-            item['inserted_at'] = datetime.now(timezone.utc)
-            await db.order_items.insert_one(item)
-
-async def save_or_update_payments(payments_data: List[Dict]):
-    """Salva ou atualiza pagamentos"""
-    for payment in payments_data:
-        marketplace_payment_id = payment.get('marketplace_payment_id')
+            data = await self._shop_call('POST', '/order/202309/orders/search', params=params, body={
+                'update_time_ge': int(date_from.timestamp()),
+                'update_time_lt': int(date_to.timestamp())
+            })
+            yield data.get('orders', [])
+            
+            page_token = data.get('next_page_token', '')
+            if not page_token:
+                break
+    
+    async def expand_orders(self, refs: List) -> List[Dict]:
+        """orders/search já traz os pedidos completos: sem chamadas de detalhe"""
+        return refs
+    
+    async def fetch_order_batch(self, refs: List) -> List[Dict]:
+        """Gancho do conector: até 50 ids por chamada (reprocessamentos e webhooks)"""
+        ids = [ref['id'] if isinstance(ref, dict) else str(ref) for ref in refs]
+        data = await self._shop_call('GET', '/order/202309/orders', params={'ids': ','.join(ids)})
+        return data.get('orders', [])
+    
+    # ----- Mapeamento para as entidades internas (Order, OrderItem, Payment, Shipment) -----
+    
+    def map_to_internal_order(self, order: Dict) -> Dict:
+        """Mapeia pedido TikTok Shop para formato interno"""
+        address = order.get('recipient_address') or {}
+        payment = order.get('payment') or {}
+        districts = {d.get('address_level_name', '').lower(): d.get('address_name', '') for d in address.get('district_info', [])}
         
-        if not marketplace_payment_id:
-            continue
+        return {
+            'marketplace': 'TIKTOK_SHOP',
+            'marketplace_order_id': str(order.get('id', '')),
+            'order_number_display': str(order.get('id', '')),
+            
+            'status_general': self._map_tiktok_status(order.get('status', '')),
+            'status_payment': 'approved' if order.get('paid_time') else 'pending',
+            'status_fulfillment': order.get('status', ''),
+            
+            'created_at_marketplace': self._from_timestamp(order.get('create_time')),
+            'paid_at': self._from_timestamp(order.get('paid_time')),
+            'shipped_at': self._from_timestamp(order.get('rts_time')),
+            'delivered_at': self._from_timestamp(order.get('delivery_time')),
+            'cancelled_at': self._from_timestamp(order.get('cancel_time')),
+            'last_updated_at': self._from_timestamp(order.get('update_time')),
+            
+            'buyer_id_marketplace': str(order.get('user_id', '')),
+            'buyer_full_name': address.get('name', ''),
+            'buyer_phone': address.get('phone_number', ''),
+            'buyer_email': order.get('buyer_email', ''),
+            
+            'ship_to_name': address.get('name', ''),
+            'ship_to_phone': address.get('phone_number', ''),
+            'ship_to_street': address.get('address_line1', '') or address.get('full_address', ''),
+            'ship_to_complement': address.get('address_line2', ''),
+            'ship_to_district': districts.get('district', '') or districts.get('l4', ''),
+            'ship_to_city': districts.get('city', '') or districts.get('l3', ''),
+            'ship_to_state': districts.get('state', '') or districts.get('l1', ''),
+            'ship_to_zipcode': address.get('postal_code', ''),
+            'ship_to_country': address.get('region_code', 'BR'),
+            
+            'currency': payment.get('currency', 'BRL'),
+            'subtotal_items': self._amount(payment.get('sub_total')),
+            'discount_seller': self._amount(payment.get('seller_discount')),
+            'discount_platform': self._amount(payment.get('platform_discount')),
+            'shipping_cost_charged': self._amount(payment.get('shipping_fee')),
+            'total_amount_buyer': self._amount(payment.get('total_amount')),
+            
+            'shipment_id_marketplace': str((order.get('packages') or [{}])[0].get('id', '')),
+            'shipping_status': order.get('status', ''),
+            'shipping_method': order.get('delivery_option_name', ''),
+            'shipping_sla_ship_by': self._from_timestamp(order.get('rts_sla_time')),
+            'tracking_number': order.get('tracking_number', ''),
+            'tracking_carrier': order.get('shipping_provider', ''),
+            
+            'cancel_reason': order.get('cancel_reason', ''),
+            'marketplace_notes': order.get('buyer_message', ''),
+            
+            'updated_at': datetime.now(timezone.utc)
+        }
+    
+    def map_to_internal_items(self, order: Dict, internal_order_id: str) -> List[Dict]:
+        """TikTok devolve uma linha por unidade: agrupadas por SKU"""
+        grouped: Dict[str, Dict] = {}
         
-        existing = await db.payments.find_one({'marketplace_payment_id': marketplace_payment_id})
+        for line in order.get('line_items', []):
+            sku_id = str(line.get('sku_id', '') or line.get('id', ''))
+            unit_price = self._amount(line.get('sale_price'))
+            item = grouped.get(sku_id)
+            
+            if item is None:
+                item = grouped[sku_id] = {
+                    'internal_order_id': internal_order_id,
+                    'marketplace': 'TIKTOK_SHOP',
+                    'marketplace_order_id': str(order.get('id', '')),
+                    'marketplace_item_id': sku_id,
+                    'marketplace_variation_id': str(line.get('product_id', '')),
+                    'seller_sku': line.get('seller_sku', ''),
+                    'product_title': line.get('product_name', ''),
+                    'variation_name': line.get('sku_name', ''),
+                    'quantity': 0,
+                    'unit_price': unit_price,
+                    'original_unit_price': self._amount(line.get('original_price')),
+                    'total_price_item': 0.0,
+                    'currency': line.get('currency', 'BRL'),
+                    'discount_item_seller': 0.0,
+                    'discount_item_platform': 0.0,
+                    'updated_at': datetime.now(timezone.utc)
+                }
+            
+            item['quantity'] += 1
+            item['total_price_item'] += unit_price
+            item['discount_item_seller'] += self._amount(line.get('seller_discount'))
+            item['discount_item_platform'] += self._amount(line.get('platform_discount'))
         
-        if existing:
-            await db.payments.update_one(
-                {'internal_payment_id': existing['internal_payment_id']},
-                {'$set': payment}
+        return list(grouped.values())
+    
+    def map_to_internal_payments(self, order: Dict, internal_order_id: str) -> List[Dict]:
+        """Um pagamento por pedido, identificado pelo id do pedido"""
+        if not order.get('paid_time'):
+            return []
+        
+        payment = order.get('payment') or {}
+        total = self._amount(payment.get('total_amount'))
+        return [{
+            'internal_order_id': internal_order_id,
+            'marketplace_payment_id': f"TIKTOK-{order.get('id', '')}",
+            'method': order.get('payment_method_name', ''),
+            'status': 'refunded' if order.get('status') == 'CANCELLED' else 'approved',
+            'transaction_amount': total,
+            'total_paid_amount': total,
+            'currency': payment.get('currency', 'BRL'),
+            'paid_at': self._from_timestamp(order.get('paid_time')),
+            'updated_at': datetime.now(timezone.utc)
+        }]
+    
+    def map_to_internal_shipments(self, order: Dict, internal_order_id: str) -> List[Dict]:
+        """Um envio por pacote"""
+        address = order.get('recipient_address') or {}
+        shipments = []
+        
+        for package in order.get('packages') or []:
+            if not package.get('id'):
+                continue
+            shipments.append({
+                'internal_order_id': internal_order_id,
+                'marketplace_shipment_id': str(package['id']),
+                'tracking_number': order.get('tracking_number', ''),
+                'carrier_name': order.get('shipping_provider', ''),
+                'status': order.get('status', ''),
+                'ship_by_deadline': self._from_timestamp(order.get('rts_sla_time')),
+                'shipped_at': self._from_timestamp(order.get('rts_time')),
+                'delivered_at': self._from_timestamp(order.get('delivery_time')),
+                'receiver_name': address.get('name', ''),
+                'receiver_phone': address.get('phone_number', ''),
+                'receiver_street': address.get('address_line1', '') or address.get('full_address', ''),
+                'receiver_zipcode': address.get('postal_code', ''),
+                'receiver_country': address.get('region_code', 'BR'),
+                'updated_at': datetime.now(timezone.utc)
+            })
+        
+        return shipments
+    
+    def _map_tiktok_status(self, tiktok_status: str) -> str:
+        """Mapeia status do TikTok Shop para status geral interno"""
+        status_map = {
+            'UNPAID': 'pending',
+            'ON_HOLD': 'pending',
+            'AWAITING_SHIPMENT': 'paid',
+            'PARTIALLY_SHIPPING': 'ready_to_ship',
+            'AWAITING_COLLECTION': 'ready_to_ship',
+            'IN_TRANSIT': 'shipped',
+            'DELIVERED': 'delivered',
+            'COMPLETED': 'delivered',
+            'CANCELLED': 'cancelled'
+        }
+        return status_map.get(tiktok_status, tiktok_status.lower())
+    
+    def _amount(self, value) -> float:
+        """Valores monetários vêm como string"""
+        try:
+            return float(value or 0)
+        except (TypeError, ValueError):
+            return 0.0
+
+# ============= FUNÇÕES DE PERSISTÊNCIA =============
+
+async def get_sync_state(marketplace: str, seller_id: str) -> Optional[Dict]:
+    """Busca o estado de sincronização incremental (watermark) de um vendedor"""
+    return await db.marketplace_sync_state.find_one(
+        {'marketplace': marketplace, 'seller_id': str(seller_id)},
+        {'_id': 0}
+    )
+
+async def advance_sync_watermark(marketplace: str, seller_id: str, watermark: datetime, orders_synced: int = 0):
+    """
+    Avança o watermark de last_updated do vendedor.
+    Chamar somente depois que todos os pedidos da janela foram persistidos.
+    """
+    now = datetime.now(timezone.utc)
+    await db.marketplace_sync_state.update_one(
+        {'marketplace': marketplace, 'seller_id': str(seller_id)},
+        {
+            # $max garante que o watermark nunca retrocede
+            '$max': {'last_updated_watermark': watermark},
+            '$set': {'last_success_at': now, 'last_orders_synced': orders_synced, 'updated_at': now},
+            '$setOnInsert': {'created_at': now}
+        },
+        upsert=True
+    )
+
+# ============= PERSISTÊNCIA EM LOTE (BULK UPSERT) =============
+
+async def _backfill_order_items_marketplace():
+    """Itens gravados antes da chave composta recebem o marketplace do pedido"""
+    internal_order_ids = await db.order_items.distinct('internal_order_id', {'marketplace': {'$exists': False}})
+    
+    for i in range(0, len(internal_order_ids), 500):
+        batch = internal_order_ids[i:i + 500]
+        orders = await db.orders.find(
+            {'internal_order_id': {'$in': batch}},
+            {'_id': 0, 'internal_order_id': 1, 'marketplace': 1}
+        ).to_list(None)
+        
+        by_marketplace: Dict[str, List[str]] = {}
+        for order in orders:
+            if order.get('marketplace'):
+                by_marketplace.setdefault(order['marketplace'], []).append(order['internal_order_id'])
+        
+        for marketplace, ids in by_marketplace.items():
+            await db.order_items.update_many(
+                {'internal_order_id': {'$in': ids}, 'marketplace': {'$exists': False}},
+                {'$set': {'marketplace': marketplace}}
             )
+
+async def ensure_marketplace_indexes():
+    """
+    Cria os índices únicos que sustentam os upserts em lote. Sem eles o upsert pode
+    duplicar pedidos, então uma falha (ex.: duplicatas antigas) interrompe a subida.
+    """
+    # O mesmo ID de pedido/item pode existir em marketplaces diferentes: a chave inclui o marketplace
+    await _backfill_order_items_marketplace()
+    
+    specs = [
+        (db.orders, [('marketplace', 1), ('marketplace_order_id', 1)], {}, 'marketplace_order_id_1'),
+        (db.order_items, [('marketplace', 1), ('marketplace_order_id', 1), ('marketplace_item_id', 1)], {},
+         'marketplace_order_id_1_marketplace_item_id_1'),
+        # Pagamentos/envios sem ID do marketplace nunca são gravados, mas podem existir registros antigos
+        (db.payments, [('marketplace_payment_id', 1)], {'partialFilterExpression': {'marketplace_payment_id': {'$type': 'string'}}}, None),
+        (db.shipments, [('marketplace_shipment_id', 1)], {'partialFilterExpression': {'marketplace_shipment_id': {'$type': 'string'}}}, None),
+        (db.marketplace_order_retries, [('marketplace', 1), ('marketplace_order_id', 1)], {}, None),
+    ]
+    
+    for collection, keys, options, legacy_index in specs:
+        try:
+            await collection.create_index(keys, unique=True, **options)
+        except Exception as e:
+            raise RuntimeError(f"Não foi possível criar índice único em {collection.name} {keys}: {e}") from e
+        
+        # Índice antigo (sem marketplace) só sai depois que o novo existe
+        if legacy_index:
+            try:
+                await collection.drop_index(legacy_index)
+            except Exception:
+                pass  # Índice antigo já removido (ou nunca criado)
+    
+    # Worker da fila de reprocessamento busca pendentes vencidos
+    await db.marketplace_order_retries.create_index([('status', 1), ('next_attempt_at', 1)])
+
+# (collection, campos) com índice único já confirmado; só o resultado positivo é guardado
+_unique_indexes_verified: set = set()
+
+async def _has_unique_index(collection, fields: tuple) -> bool:
+    """Confere se existe índice único exatamente sobre os campos da chave do upsert"""
+    cache_key = (collection.name, fields)
+    if cache_key in _unique_indexes_verified:
+        return True
+    
+    indexes = await collection.index_information()
+    for index in indexes.values():
+        if index.get('unique') and tuple(field for field, _ in index.get('key', [])) == fields:
+            _unique_indexes_verified.add(cache_key)
+            return True
+    return False
+
+async def _drop_stale_docs(collection, keyed_docs: Dict[tuple, tuple], version_field: str) -> tuple:
+    """
+    Leitura e comparação (sem índice único): separa os docs cuja versão é anterior à gravada.
+    Retorna (keyed_docs a gravar, chaves stale).
+    """
+    filters = [key_filter for key_filter, _ in keyed_docs.values()]
+    fields = list(filters[0].keys())
+    stored = await collection.find(
+        {'$or': filters},
+        {'_id': 0, version_field: 1, **{field: 1 for field in fields}}
+    ).to_list(None)
+    stored_versions = {tuple(o.get(field) for field in fields): as_utc(o.get(version_field)) for o in stored}
+    
+    fresh, stale = {}, []
+    for key, (key_filter, doc) in keyed_docs.items():
+        stored_version = stored_versions.get(tuple(key_filter[field] for field in fields))
+        version = as_utc(doc.get(version_field))
+        if stored_version and version and stored_version > version:
+            stale.append(key)
         else:
-            if 'internal_payment_id' not in payment:
-                payment['internal_payment_id'] = str(secrets.token_urlsafe(16))
-            
-            payment['inserted_at'] = datetime.now(timezone.utc)
-            await db.payments.insert_one(payment)
+            fresh[key] = (key_filter, doc)
+    return fresh, stale
+
+def _upsert_op(key_filter: Dict, doc: Dict, internal_id_field: str, version_field: Optional[str] = None) -> UpdateOne:
+    """
+    UpdateOne com upsert: IDs internos e inserted_at só são gravados na inserção.
+    Com version_field, só sobrescreve registro com versão igual ou anterior à do doc;
+    se o gravado é mais novo o filtro não casa e o upsert esbarra no índice único.
+    """
+    version = doc.get(version_field) if version_field else None
+    if version is not None:
+        key_filter = {**key_filter, '$or': [{version_field: {'$lte': version}}, {version_field: None}]}
+    
+    now = datetime.now(timezone.utc)
+    on_insert = {
+        internal_id_field: doc.get(internal_id_field) or str(secrets.token_urlsafe(16)),
+        'inserted_at': now
+    }
+    to_set = {k: v for k, v in doc.items() if k not in on_insert and k != '_id'}
+    return UpdateOne(key_filter, {'$set': to_set, '$setOnInsert': on_insert}, upsert=True)
 
-async def save_or_update_shipments(shipments_data: List[Dict]):
-    """Salva ou atualiza envios"""
+async def _bulk_upsert(collection, keyed_docs: Dict[tuple, tuple], internal_id_field: str, version_field: Optional[str] = None) -> Dict:
+    """
+    Executa um único bulk_write e devolve contagem de criados/atualizados e as chaves
+    ignoradas por já existir versão mais nova gravada (stale, apenas com version_field)
+    """
+    if not keyed_docs:
+        return {'created': 0, 'updated': 0, 'stale': []}
+    
+    # O filtro de versão depende do índice único para não inserir duplicata com payload antigo
+    stale = []
+    if version_field:
+        key_fields = tuple(next(iter(keyed_docs.values()))[0].keys())
+        if not await _has_unique_index(collection, key_fields):
+            print(f"⚠️  Índice único ausente em {collection.name} {list(key_fields)} - comparando versões antes de gravar")
+            keyed_docs, stale = await _drop_stale_docs(collection, keyed_docs, version_field)
+            version_field = None
+            if not keyed_docs:
+                return {'created': 0, 'updated': 0, 'stale': stale}
+    
+    keys = list(keyed_docs.keys())
+    ops = [_upsert_op(key_filter, doc, internal_id_field, version_field) for key_filter, doc in keyed_docs.values()]
+    try:
+        result = await collection.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if not version_field or any(error.get('code') != 11000 for error in errors):
+            raise
+        return {
+            'created': e.details.get('nUpserted', 0),
+            'updated': e.details.get('nModified', 0),
+            'stale': [keys[error['index']] for error in errors]
+        }
+    
+    return {'created': result.upserted_count, 'updated': result.modified_count, 'stale': stale}
+
+async def bulk_upsert_orders(orders_data: List[Dict]) -> Dict:
+    """
+    Salva ou atualiza vários pedidos com um único bulk_write. Pedido com last_updated_at
+    anterior ao já gravado (ex.: payload antigo da fila de reprocessamento) não sobrescreve
+    o registro e fica fora de internal_ids, para que seus itens também não sejam regravados.
+    Retorna {created, updated, stale, internal_ids: {(marketplace, marketplace_order_id): internal_order_id}}
+    """
+    # Último registro vence quando o mesmo pedido aparece duas vezes no lote
+    keyed = {}
+    for order in orders_data:
+        key = (order.get('marketplace'), order.get('marketplace_order_id'))
+        if key[1]:
+            keyed[key] = ({'marketplace': key[0], 'marketplace_order_id': key[1]}, order)
+    
+    result = await _bulk_upsert(db.orders, keyed, 'internal_order_id', version_field='last_updated_at')
+    stale = set(result['stale'])
+    
+    # IDs internos de pedidos já existentes não voltam no resultado do bulk_write
+    ids_by_marketplace: Dict[str, List[str]] = {}
+    for marketplace, marketplace_order_id in keyed:
+        ids_by_marketplace.setdefault(marketplace, []).append(marketplace_order_id)
+    stored = await db.orders.find(
+        {'$or': [
+            {'marketplace': marketplace, 'marketplace_order_id': {'$in': ids}}
+            for marketplace, ids in ids_by_marketplace.items()
+        ]},
+        {'_id': 0, 'marketplace': 1, 'marketplace_order_id': 1, 'internal_order_id': 1}
+    ).to_list(None) if keyed else []
+    result['internal_ids'] = {
+        (o.get('marketplace'), o['marketplace_order_id']): o['internal_order_id']
+        for o in stored if (o.get('marketplace'), o['marketplace_order_id']) not in stale
+    }
+    
+    print(f"💾 Pedidos: {result['created']} criados, {result['updated']} atualizados")
+    if stale:
+        print(f"⏭️  {len(stale)} pedidos ignorados: já existe versão mais recente gravada")
+    return result
+
+async def bulk_upsert_order_items(items_data: List[Dict]) -> Dict:
+    """Salva ou atualiza itens de vários pedidos com um único bulk_write"""
+    keyed = {}
+    for item in items_data:
+        key = (item.get('marketplace'), item.get('marketplace_order_id'), item.get('marketplace_item_id'))
+        keyed[key] = ({'marketplace': key[0], 'marketplace_order_id': key[1], 'marketplace_item_id': key[2]}, item)
+    
+    return await _bulk_upsert(db.order_items, keyed, 'internal_order_item_id')
+
+async def bulk_upsert_payments(payments_data: List[Dict]) -> Dict:
+    """Salva ou atualiza pagamentos com um único bulk_write"""
+    keyed = {}
+    for payment in payments_data:
+        marketplace_payment_id = payment.get('marketplace_payment_id')
+        if marketplace_payment_id:
+            keyed[marketplace_payment_id] = ({'marketplace_payment_id': marketplace_payment_id}, payment)
+    
+    return await _bulk_upsert(db.payments, keyed, 'internal_payment_id')
+
+async def bulk_upsert_shipments(shipments_data: List[Dict]) -> Dict:
+    """Salva ou atualiza envios com um único bulk_write"""
+    keyed = {}
     for shipment in shipments_data:
         marketplace_shipment_id = shipment.get('marketplace_shipment_id')
-        
-        if not marketplace_shipment_id:
+        if marketplace_shipment_id:
+            keyed[marketplace_shipment_id] = ({'marketplace_shipment_id': marketplace_shipment_id}, shipment)
+    
+    return await _bulk_upsert(db.shipments, keyed, 'internal_shipment_id')
+
+async def ingest_marketplace_orders(integrator, raw_orders: List[Dict], queue_failures: bool = True) -> Dict:
+    """
+    Mapeia e persiste pedidos de qualquer integrador em lote (map_to_internal_order/items
+    obrigatórios; map_to_internal_payments/shipments quando o marketplace os expõe no pedido).
+    
+    Pedidos que falham no mapeamento ou na gravação vão para a fila de reprocessamento
+    (marketplace_order_retries) com o payload original, salvo queue_failures=False.
+    Retorna contagens (created, updated, failed, queued), o maior last_updated persistido
+    e as falhas {ref: (payload, etapa, erro)}.
+    """
+    mapped = []
+    failures: Dict[str, tuple] = {}
+    
+    for raw_order in raw_orders:
+        try:
+            mapped.append((raw_order, integrator.map_to_internal_order(raw_order)))
+        except Exception as e:
+            ref = integrator.order_ref(raw_order)
+            failures[ref] = (raw_order, 'map', str(e))
+            print(f"❌ Erro ao mapear pedido {ref}: {e}")
+    
+    try:
+        orders_result = await bulk_upsert_orders([internal_order for _, internal_order in mapped])
+    except Exception as e:
+        print(f"❌ Erro ao gravar lote de {len(mapped)} pedidos: {e}")
+        for raw_order, _ in mapped:
+            failures[integrator.order_ref(raw_order)] = (raw_order, 'save', str(e))
+        mapped = []
+        orders_result = {'created': 0, 'updated': 0, 'internal_ids': {}}
+    internal_ids = orders_result['internal_ids']
+    
+    map_payments = getattr(integrator, 'map_to_internal_payments', None)
+    map_shipments = getattr(integrator, 'map_to_internal_shipments', None)
+    
+    items, payments, shipments = [], [], []
+    for raw_order, internal_order in mapped:
+        internal_order_id = internal_ids.get((internal_order.get('marketplace'), internal_order['marketplace_order_id']))
+        if not internal_order_id:
+            continue
+        try:
+            order_items = integrator.map_to_internal_items(raw_order, internal_order_id)
+            order_payments = map_payments(raw_order, internal_order_id) if map_payments else []
+            order_shipments = map_shipments(raw_order, internal_order_id) if map_shipments else []
+        except Exception as e:
+            ref = integrator.order_ref(raw_order)
+            failures[ref] = (raw_order, 'map', str(e))
+            print(f"❌ Erro ao mapear itens do pedido {ref}: {e}")
+            continue
+        items.extend(order_items)
+        payments.extend(order_payments)
+        shipments.extend(order_shipments)
+    
+    try:
+        await bulk_upsert_order_items(items)
+        if payments:
+            await bulk_upsert_payments(payments)
+        if shipments:
+            await bulk_upsert_shipments(shipments)
+    except Exception as e:
+        print(f"❌ Erro ao gravar itens/pagamentos/envios do lote: {e}")
+        for raw_order, _ in mapped:
+            failures.setdefault(integrator.order_ref(raw_order), (raw_order, 'save', str(e)))
+    
+    persisted = [o for raw_order, o in mapped if integrator.order_ref(raw_order) not in failures]
+    updates = [o['last_updated_at'] for o in persisted if o.get('last_updated_at')]
+    
+    # Pedido gravado com sucesso não deve ser reprocessado a partir de um payload antigo
+    if persisted:
+        await resolve_retried_orders(integrator.marketplace, [o['marketplace_order_id'] for o in persisted])
+    
+    queued = 0
+    if failures and queue_failures:
+        queued = await enqueue_failed_orders(integrator.marketplace, failures)
+    
+    return {
+        'created': orders_result['created'],
+        'updated': orders_result['updated'],
+        'failed': len(failures),
+        'queued': queued,
+        'processed': len(persisted),
+        'max_last_updated': max(updates) if updates else None,
+        'failures': failures
+    }
+
+async def ingest_ml_orders(integrator: MercadoLivreIntegrator, ml_orders: List[Dict]) -> Dict:
+    """Mapeia e persiste pedidos do Mercado Livre em lote"""
+    return await ingest_marketplace_orders(integrator, ml_orders)
+
+# ============= FILA DE REPROCESSAMENTO =============
+
+# Pedidos com falha são reprocessados a partir do payload salvo, sem rebuscar a janela
+ORDER_RETRY_MAX_ATTEMPTS = int(os.environ.get('ORDER_RETRY_MAX_ATTEMPTS', '8'))
+ORDER_RETRY_BASE_DELAY_SECONDS = float(os.environ.get('ORDER_RETRY_BASE_DELAY_SECONDS', '60'))
+ORDER_RETRY_MAX_DELAY_SECONDS = float(os.environ.get('ORDER_RETRY_MAX_DELAY_SECONDS', '21600'))
+
+def order_retry_delay(attempts: int) -> timedelta:
+    """Backoff exponencial com jitter de ±20% entre tentativas"""
+    seconds = min(ORDER_RETRY_MAX_DELAY_SECONDS, ORDER_RETRY_BASE_DELAY_SECONDS * (2 ** attempts))
+    return timedelta(seconds=seconds * random.uniform(0.8, 1.2))
+
+async def enqueue_failed_orders(marketplace: str, failures: Dict[str, tuple]) -> int:
+    """
+    Registra pedidos com falha (payload original, etapa e erro) em marketplace_order_retries.
+    Um registro por pedido: nova falha do mesmo pedido substitui o payload e zera as tentativas.
+    """
+    now = datetime.now(timezone.utc)
+    ops = []
+    for ref, (payload, stage, error) in failures.items():
+        if not ref:
+            continue
+        ops.append(UpdateOne(
+            {'marketplace': marketplace, 'marketplace_order_id': ref},
+            {
+                '$set': {
+                    'payload': payload,
+                    'stage': stage,
+                    'error': error,
+                    'status': 'pending',
+                    'attempts': 0,
+                    'next_attempt_at': now + order_retry_delay(0),
+                    'last_failed_at': now,
+                    'updated_at': now
+                },
+                '$setOnInsert': {'id': str(uuid.uuid4()), 'created_at': now}
+            },
+            upsert=True
+        ))
+    
+    if not ops:
+        return 0
+    
+    try:
+        await db.marketplace_order_retries.bulk_write(ops, ordered=False)
+    except Exception as e:
+        print(f"❌ Não foi possível registrar {len(ops)} pedidos na fila de reprocessamento: {e}")
+        return 0
+    
+    print(f"📥 {len(ops)} pedidos {marketplace} enviados para reprocessamento")
+    return len(ops)
+
+async def resolve_retried_orders(marketplace: str, marketplace_order_ids: List[str]):
+    """Marca como resolvidos os registros da fila dos pedidos que acabaram de ser gravados"""
+    now = datetime.now(timezone.utc)
+    try:
+        result = await db.marketplace_order_retries.update_many(
+            {
+                'marketplace': marketplace,
+                'marketplace_order_id': {'$in': marketplace_order_ids},
+                'status': {'$in': ['pending', 'dead']}
+            },
+            {'$set': {'status': 'resolved', 'resolved_at': now, 'updated_at': now}}
+        )
+    except Exception as e:
+        print(f"⚠️  Não foi possível atualizar a fila de reprocessamento: {e}")
+        return
+    
+    if result.modified_count:
+        print(f"✅ {result.modified_count} pedidos {marketplace} da fila resolvidos pela sincronização")
+
+def build_connectors() -> Dict[str, 'MarketplaceConnector']:
+    """Um conector de cada marketplace, indexado pelo nome usado nas collections"""
+    return {
+        connector.marketplace: connector
+        for connector in (MercadoLivreIntegrator(), ShopeeIntegrator(), TikTokShopIntegrator())
+    }
+
+async def replay_failed_orders(
+    connectors: Dict[str, 'MarketplaceConnector'],
+    limit: int = 200,
+    force: bool = False,
+    ids: Optional[List[str]] = None,
+    marketplace: Optional[str] = None,
+    include_dead: bool = False
+) -> Dict:
+    """
+    Reprocessa pedidos da fila a partir do payload salvo: um mapeamento por pedido.
+    Sem force, apenas os vencidos (next_attempt_at); esgotadas as tentativas o registro
+    fica 'dead' e só volta com include_dead (reprocessamento manual).
+    """
+    now = datetime.now(timezone.utc)
+    query: Dict = {'status': {'$in': ['pending', 'dead']} if include_dead else 'pending'}
+    if not force:
+        query['next_attempt_at'] = {'$lte': now}
+    if ids:
+        query['id'] = {'$in': ids}
+    if marketplace:
+        query['marketplace'] = marketplace
+    
+    entries = await db.marketplace_order_retries.find(query).sort('next_attempt_at', 1).limit(limit).to_list(None)
+    stats = {'replayed': 0, 'resolved': 0, 'failed': 0, 'dead': 0, 'skipped': 0}
+    
+    by_marketplace: Dict[str, List[Dict]] = {}
+    for entry in entries:
+        by_marketplace.setdefault(entry['marketplace'], []).append(entry)
+    
+    ops = []
+    for marketplace_name, group in by_marketplace.items():
+        connector = connectors.get(marketplace_name)
+        if connector is None:
+            stats['skipped'] += len(group)
             continue
         
-        existing = await db.shipments.find_one({'marketplace_shipment_id': marketplace_shipment_id})
+        result = await ingest_marketplace_orders(connector, [entry['payload'] for entry in group], queue_failures=False)
+        stats['replayed'] += len(group)
         
-        if existing:
-            await db.shipments.update_one(
-                {'internal_shipment_id': existing['internal_shipment_id']},
-                {'$set': shipment}
-            )
-        else:
-            if 'internal_shipment_id' not in shipment:
-                shipment['internal_shipment_id'] = str(secrets.token_urlsafe(16))
+        for entry in group:
+            attempts = entry.get('attempts', 0) + 1
+            failure = result['failures'].get(entry['marketplace_order_id'])
             
-            shipment['inserted_at'] = datetime.now(timezone.utc)
-            await db.shipments.insert_one(shipment)
+            if failure is None:
+                stats['resolved'] += 1
+                ops.append(UpdateOne({'_id': entry['_id']}, {'$set': {
+                    'status': 'resolved', 'attempts': attempts, 'resolved_at': now, 'updated_at': now
+                }}))
+                continue
+            
+            _, stage, error = failure
+            dead = attempts >= ORDER_RETRY_MAX_ATTEMPTS
+            stats['dead' if dead else 'failed'] += 1
+            ops.append(UpdateOne({'_id': entry['_id']}, {'$set': {
+                'status': 'dead' if dead else 'pending',
+                'stage': stage,
+                'error': error,
+                'attempts': attempts,
+                'next_attempt_at': now + order_retry_delay(attempts),
+                'last_failed_at': now,
+                'updated_at': now
+            }}))
+    
+    if ops:
+        await db.marketplace_order_retries.bulk_write(ops, ordered=False)
+    
+    if entries:
+        print(f"🔁 Reprocessamento: {stats['resolved']} resolvidos, {stats['failed']} com nova falha, {stats['dead']} esgotados")
+    return stats
@@ -5,6 +5,7 @@ from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
+import asyncio
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, ValidationError
 from typing import List, Optional
@@ -928,26 +929,149 @@ class Produto(BaseModel):
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+# ============= CATÁLOGO DE PREÇOS EM MEMÓRIA =============
+
+from pymongo import ReturnDocument
+
+CATALOGO_POLL_SECONDS = float(os.environ.get('CATALOGO_POLL_SECONDS', '5'))
+PRAZOS_CUSTO = ['vista', '30dias', '60dias', '90dias', '120dias', '150dias']
+
+class SnapshotCatalogo:
+    """Cópia em memória de produtos_gestao e insumos, indexada por id, loja e tipo"""
+    
+    def __init__(self, versao: int, produtos: list, insumos: list):
+        self.versao = versao
+        self.carregado_em = datetime.now(timezone.utc)
+        self.produtos = produtos
+        self.insumos = insumos
+        
+        # Produtos: por id (primeiro documento, como o find_one), por loja e preços pré-calculados
+        self.produtos_por_id = {}
+        self.produtos_por_loja = {}
+        self.precos_produto = {}
+        for produto in produtos:
+            produto.pop('_id', None)
+            self.produtos_por_loja.setdefault(produto.get('loja_id'), []).append(produto)
+            if produto.get('id') in self.produtos_por_id:
+                continue
+            self.produtos_por_id[produto.get('id')] = produto
+            
+            custo = get_custo_por_prazo(produto, produto.get('prazo_selecionado', '120dias'))
+            markup = produto.get('markup_manufatura')
+            self.precos_produto[produto.get('id')] = {
+                'custo': custo,
+                'preco': produto.get('preco_manufatura', custo),
+                'markup': (markup / 100) + 1 if markup else None,  # % → multiplicador
+                'custos_por_prazo': {prazo: get_custo_por_prazo(produto, prazo) for prazo in PRAZOS_CUSTO}
+            }
+        
+        # Insumos: por id e ativos por (loja, tipo), com None = sem filtro
+        self.insumos_por_id = {}
+        self.insumos_ativos = {}
+        for insumo in insumos:
+            insumo.pop('_id', None)
+            self.insumos_por_id.setdefault(insumo.get('id'), insumo)
+            if insumo.get('ativo') is not True:
+                continue
+            loja, tipo = insumo.get('loja_id'), insumo.get('tipo_insumo')
+            for chave in {(None, None), (loja, None), (None, tipo), (loja, tipo)}:
+                self.insumos_ativos.setdefault(chave, []).append(insumo)
+    
+    def listar_produtos(self, loja: Optional[str] = None) -> list:
+        if loja:
+            return list(self.produtos_por_loja.get(loja, []))
+        return list(self.produtos)
+    
+    def listar_insumos(self, loja: Optional[str] = None, tipo: Optional[str] = None) -> list:
+        return list(self.insumos_ativos.get((loja or None, tipo or None), []))
+
+class CatalogoPrecos:
+    """
+    Catálogo de produtos/insumos versionado, mantido em memória por worker
+    
+    Escritas em produtos/insumos incrementam a versão em catalogo_versao e recarregam o
+    snapshot local; os demais workers consultam a versão a cada CATALOGO_POLL_SECONDS e
+    recarregam quando ela muda. Cálculos e listagens leem apenas o snapshot.
+    """
+    
+    def __init__(self):
+        self.snapshot: Optional[SnapshotCatalogo] = None
+        self._lock = asyncio.Lock()
+        self._poll_task = None
+    
+    async def versao_atual(self) -> int:
+        doc = await db.catalogo_versao.find_one({"id": "precos"})
+        return doc.get('versao', 0) if doc else 0
+    
+    async def recarregar(self, versao: Optional[int] = None) -> SnapshotCatalogo:
+        async with self._lock:
+            # Versão lida antes dos dados: uma escrita concorrente só causa um recarregamento extra
+            if versao is None:
+                versao = await self.versao_atual()
+            if self.snapshot is not None and self.snapshot.versao == versao:
+                return self.snapshot
+            
+            produtos, insumos = await asyncio.gather(
+                db.produtos_gestao.find({}).to_list(None),
+                db.insumos.find({}).to_list(None)
+            )
+            self.snapshot = SnapshotCatalogo(versao, produtos, insumos)
+            print(f"📚 Catálogo de preços v{versao} carregado: {len(produtos)} produtos, {len(insumos)} insumos")
+            return self.snapshot
+    
+    async def obter(self) -> SnapshotCatalogo:
+        if self.snapshot is None:
+            return await self.recarregar()
+        return self.snapshot
+    
+    async def registrar_alteracao(self):
+        """Incrementa a versão após escrita em produtos_gestao/insumos e recarrega o snapshot local"""
+        doc = await db.catalogo_versao.find_one_and_update(
+            {"id": "precos"},
+            {"$inc": {"versao": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        await self.recarregar(doc['versao'])
+    
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(CATALOGO_POLL_SECONDS)
+            try:
+                versao = await self.versao_atual()
+                if self.snapshot is None or versao != self.snapshot.versao:
+                    await self.recarregar(versao)
+            except Exception as e:
+                print(f"⚠️ Erro ao verificar versão do catálogo: {e}")
+    
+    def iniciar_polling(self):
+        if self._poll_task is None:
+            self._poll_task = asyncio.create_task(self._poll())
+    
+    async def parar_polling(self):
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
+
+catalogo_precos = CatalogoPrecos()
+
 # Endpoints de Produtos
 @api_router.get("/gestao/produtos")
 async def get_produtos(loja: Optional[str] = None, current_user: dict = Depends(get_current_user)):
     """Retorna produtos filtrados por loja. Fábrica vê todos."""
-    query = {}
-    if loja and loja != 'fabrica':
-        query['loja_id'] = loja
-    
-    produtos = await db.produtos_gestao.find(query).to_list(None)
-    # Remove _id do MongoDB para evitar problemas de serialização
-    for produto in produtos:
-        if '_id' in produto:
-            del produto['_id']
-    return produtos
+    catalogo = await catalogo_precos.obter()
+    return catalogo.listar_produtos(loja if loja and loja != 'fabrica' else None)
 
 @api_router.post("/gestao/produtos")
 async def create_produto(produto: Produto, current_user: dict = Depends(get_current_user)):
     """Cria um novo produto"""
     produto_dict = produto.model_dump()
     await db.produtos_gestao.insert_one(produto_dict)
+    await catalogo_precos.registrar_alteracao()
     return produto
 
 @api_router.put("/gestao/produtos/{produto_id}")
@@ -956,12 +1080,14 @@ async def update_produto(produto_id: str, produto: Produto, current_user: dict =
     produto_dict = produto.model_dump()
     produto_dict['updated_at'] = datetime.now(timezone.utc).isoformat()
     await db.produtos_gestao.update_one({"id": produto_id}, {"$set": produto_dict})
+    await catalogo_precos.registrar_alteracao()
     return {"message": "Produto atualizado com sucesso"}
 
 @api_router.delete("/gestao/produtos/{produto_id}")
 async def delete_produto(produto_id: str, current_user: dict = Depends(get_current_user)):
     """Deleta um produto"""
     await db.produtos_gestao.delete_one({"id": produto_id})
+    await catalogo_precos.registrar_alteracao()
     return {"message": "Produto excluído com sucesso"}
 
 # ============= INSUMOS E ORÇAMENTOS =============
@@ -1040,24 +1166,15 @@ class Orcamento(BaseModel):
 @api_router.get("/gestao/insumos")
 async def get_insumos(loja: Optional[str] = None, tipo: Optional[str] = None, current_user: dict = Depends(get_current_user)):
     """Retorna insumos filtrados por loja e tipo"""
-    query = {"ativo": True}
-    if loja and loja != 'fabrica':
-        query['loja_id'] = loja
-    if tipo:
-        query['tipo_insumo'] = tipo
-    
-    insumos = await db.insumos.find(query).to_list(None)
-    # Remove _id do MongoDB
-    for insumo in insumos:
-        if '_id' in insumo:
-            del insumo['_id']
-    return insumos
+    catalogo = await catalogo_precos.obter()
+    return catalogo.listar_insumos(loja if loja and loja != 'fabrica' else None, tipo)
 
 @api_router.post("/gestao/insumos")
 async def create_insumo(insumo: Insumo, current_user: dict = Depends(get_current_user)):
     """Cria um novo insumo"""
     insumo_dict = insumo.model_dump()
     await db.insumos.insert_one(insumo_dict)
+    await catalogo_precos.registrar_alteracao()
     return insumo
 
 @api_router.put("/gestao/insumos/{insumo_id}")
@@ -1066,12 +1183,14 @@ async def update_insumo(insumo_id: str, insumo: Insumo, current_user: dict = Dep
     insumo_dict = insumo.model_dump()
     insumo_dict['updated_at'] = datetime.now(timezone.utc).isoformat()
     await db.insumos.update_one({"id": insumo_id}, {"$set": insumo_dict})
+    await catalogo_precos.registrar_alteracao()
     return {"message": "Insumo atualizado com sucesso"}
 
 @api_router.delete("/gestao/insumos/{insumo_id}")
 async def delete_insumo(insumo_id: str, current_user: dict = Depends(get_current_user)):
     """Deleta um insumo"""
     await db.insumos.delete_one({"id": insumo_id})
+    await catalogo_precos.registrar_alteracao()
     return {"message": "Insumo excluído com sucesso"}
 
 # Endpoints de Orçamentos
@@ -1086,13 +1205,14 @@ async def calcular_orcamento(orcamento: Orcamento, current_user: dict = Depends(
     # 2. Calcular perímetro (cm)
     orcamento.perimetro = (2 * orcamento.altura) + (2 * orcamento.largura)
     
-    # 3. Buscar insumos e calcular custos
+    # 3. Buscar insumos no catálogo em memória e calcular custos
+    catalogo = await catalogo_precos.obter()
     itens = []
     custo_total = 0
     
     # 3.1 Moldura
     if orcamento.moldura_id:
-        moldura = await db.insumos.find_one({"id": orcamento.moldura_id})
+        moldura = catalogo.insumos_por_id.get(orcamento.moldura_id)
         if moldura:
             # Calcular barras necessárias
             barra_padrao = moldura.get('barra_padrao', 270)
@@ -1123,7 +1243,7 @@ async def calcular_orcamento(orcamento: Orcamento, current_user: dict = Depends(
     
     # 3.2 Vidro
     if orcamento.usar_vidro and orcamento.vidro_id:
-        vidro = await db.insumos.find_one({"id": orcamento.vidro_id})
+        vidro = catalogo.insumos_por_id.get(orcamento.vidro_id)
         if vidro:
             custo_vidro = orcamento.area * vidro['custo_unitario'] * orcamento.quantidade
             custo_total += custo_vidro
@@ -1140,7 +1260,7 @@ async def calcular_orcamento(orcamento: Orcamento, current_user: dict = Depends(
     
     # 3.3 MDF
     if orcamento.usar_mdf and orcamento.mdf_id:
-        mdf = await db.insumos.find_one({"id": orcamento.mdf_id})
+        mdf = catalogo.insumos_por_id.get(orcamento.mdf_id)
         if mdf:
             custo_mdf = orcamento.area * mdf['custo_unitario'] * orcamento.quantidade
             custo_total += custo_mdf
@@ -1157,7 +1277,7 @@ async def calcular_orcamento(orcamento: Orcamento, current_user: dict = Depends(
     
     # 3.4 Papel/Adesivo
     if orcamento.usar_papel and orcamento.papel_id:
-        papel = await db.insumos.find_one({"id": orcamento.papel_id})
+        papel = catalogo.insumos_por_id.get(orcamento.papel_id)
         if papel:
             custo_papel = orcamento.area * papel['custo_unitario'] * orcamento.quantidade
             custo_total += custo_papel
@@ -1175,7 +1295,7 @@ async def calcular_orcamento(orcamento: Orcamento, current_user: dict = Depends(
     # 3.5 Acessórios
     if orcamento.usar_acessorios and orcamento.acessorios_ids:
         for acessorio_id in orcamento.acessorios_ids:
-            acessorio = await db.insumos.find_one({"id": acessorio_id})
+            acessorio = catalogo.insumos_por_id.get(acessorio_id)
             if acessorio:
                 custo_acessorio = acessorio['custo_unitario'] * orcamento.quantidade
                 custo_total += custo_acessorio
@@ -1198,6 +1318,32 @@ async def calcular_orcamento(orcamento: Orcamento, current_user: dict = Depends(
     
     return orcamento
 
+# ========================================
+# PROJEÇÕES DAS LISTAGENS (view=summary|full)
+# ========================================
+# As listagens devolvem por padrão o resumo: o documento sem os campos pesados
+# (imagens, itens, históricos, timeline, checklist). O documento completo fica nas
+# rotas de detalhe /{id} ou em view=full.
+
+CAMPOS_PESADOS_LISTAGEM = {
+    'pedidos_manufatura': ['imagem_anexada', 'itens', 'historico_status'],
+    'ordens_producao': [
+        'timeline', 'historico_aprovacoes', 'checklist',
+        'fotos_entrada_material', 'fotos_trabalho_pronto', 'comprovante_pagamento'
+    ],
+    'pedidos_lojas': ['fotos'],
+    'orcamentos': ['itens'],
+}
+
+def projecao_listagem(colecao: str, view: str = "summary") -> dict:
+    """Projeção do MongoDB para a listagem da coleção conforme a view pedida"""
+    if view not in ("summary", "full"):
+        raise HTTPException(status_code=400, detail="view deve ser 'summary' ou 'full'")
+    projecao = {"_id": 0}
+    if view == "summary":
+        projecao.update({campo: 0 for campo in CAMPOS_PESADOS_LISTAGEM[colecao]})
+    return projecao
+
 @api_router.post("/gestao/orcamentos")
 async def create_orcamento(orcamento: Orcamento, current_user: dict = Depends(get_current_user)):
     """Salva um orçamento"""
@@ -1206,18 +1352,13 @@ async def create_orcamento(orcamento: Orcamento, current_user: dict = Depends(ge
     return orcamento
 
 @api_router.get("/gestao/orcamentos")
-async def get_orcamentos(loja: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    """Retorna orçamentos filtrados por loja"""
+async def get_orcamentos(loja: Optional[str] = None, view: str = "summary", current_user: dict = Depends(get_current_user)):
+    """Retorna orçamentos filtrados por loja (resumo; itens no detalhe ou com view=full)"""
     query = {}
     if loja and loja != 'fabrica':
         query['loja_id'] = loja
     
-    orcamentos = await db.orcamentos.find(query).to_list(None)
-    # Remove _id do MongoDB
-    for orcamento in orcamentos:
-        if '_id' in orcamento:
-            del orcamento['_id']
-    return orcamentos
+    return await db.orcamentos.find(query, projecao_listagem('orcamentos', view)).to_list(None)
 
 @api_router.get("/gestao/orcamentos/{orcamento_id}")
 async def get_orcamento(orcamento_id: str, current_user: dict = Depends(get_current_user)):
@@ -1373,6 +1514,36 @@ class PedidoCalculoRequest(BaseModel):
     sobre_preco_percentual: float = 0
     sobre_preco_valor: float = 0
 
+class TamanhoCalculo(BaseModel):
+    altura: float  # cm
+    largura: float  # cm
+
+class PedidoCalculoLoteRequest(BaseModel):
+    """Matriz tamanhos × molduras para comparação de preços (demais insumos iguais em todas as células)"""
+    model_config = ConfigDict(extra="ignore")
+    
+    tamanhos: List[TamanhoCalculo]
+    moldura_ids: List[Optional[str]] = []
+    quantidade: int = 1
+    
+    # Insumos aplicados a todas as combinações
+    usar_vidro: bool = False
+    vidro_id: Optional[str] = None
+    usar_mdf: bool = False
+    mdf_id: Optional[str] = None
+    usar_papel: bool = False
+    papel_id: Optional[str] = None
+    usar_passepartout: bool = False
+    passepartout_id: Optional[str] = None
+    usar_acessorios: bool = False
+    acessorios_ids: Optional[List[str]] = []
+    
+    # Campos comerciais
+    desconto_percentual: float = 0
+    desconto_valor: float = 0
+    sobre_preco_percentual: float = 0
+    sobre_preco_valor: float = 0
+
 class PedidoManufatura(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -2147,38 +2318,99 @@ class Shipment(BaseModel):
     inserted_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+# ============= CONTADORES SEQUENCIAIS =============
+# Sequências na collection counters ({_id: nome, seq: último valor}), incrementadas com $inc atômico:
+# pedidos simultâneos nunca recebem o mesmo número e não há ordenação da collection a cada inserção
+
+async def proximo_numero(sequencia: str, session=None) -> int:
+    """Incrementa atomicamente a sequência e retorna o novo valor"""
+    contador = await db.counters.find_one_and_update(
+        {"_id": sequencia},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    return contador['seq']
+
 # Contador para número de ordem
 async def get_next_numero_ordem():
     """Gera o próximo número de ordem sequencial"""
-    ultima_ordem = await db.ordens_producao.find_one(sort=[("numero_ordem", -1)])
-    if ultima_ordem and 'numero_ordem' in ultima_ordem:
-        return ultima_ordem['numero_ordem'] + 1
-    return 1
+    return await proximo_numero('numero_ordem')
 
 # Contador para número de pedido
 async def get_next_numero_pedido():
     """Gera o próximo número de pedido sequencial"""
-    ultimo_pedido = await db.pedidos_manufatura.find_one(sort=[("numero_pedido", -1)])
-    if ultimo_pedido and 'numero_pedido' in ultimo_pedido:
-        return ultimo_pedido['numero_pedido'] + 1
-    return 1
+    return await proximo_numero('numero_pedido')
+
+# Documento em counters que indica que a semeadura já foi feita
+CONTADORES_MARCADOR_SEMENTE = "_semeadura"
+
+async def inicializar_contadores():
+    """
+    Semeia counters com os maiores números já gravados e cria os índices únicos
+    
+    A varredura das collections roda uma única vez (marcador em counters): depois dela
+    todo número novo sai de proximo_numero, então os counters já estão à frente.
+    """
+    if not await db.counters.find_one({"_id": CONTADORES_MARCADOR_SEMENTE}):
+        await semear_contadores()
+    
+    # Índices únicos garantem os números (parciais: ignoram registros antigos sem número)
+    for collection, campo, filtro in [
+        (db.pedidos_manufatura, 'numero_pedido', {'numero_pedido': {'$gt': 0}}),
+        (db.ordens_producao, 'numero_ordem', {'numero_ordem': {'$gt': 0}}),
+        (db.pedidos_lojas, 'numero_pedido', {'numero_pedido': {'$type': 'string'}})
+    ]:
+        try:
+            await collection.create_index(campo, unique=True, partialFilterExpression=filtro)
+        except Exception as e:
+            print(f"⚠️ Índice único {collection.name}.{campo} não criado (há números duplicados?): {e}")
+
+async def semear_contadores():
+    """Varre os números já gravados e leva cada sequência ao maior deles ($max nunca volta uma sequência)"""
+    sementes = {}
+    
+    ultimo_pedido = await db.pedidos_manufatura.find_one({"numero_pedido": {"$gt": 0}}, sort=[("numero_pedido", -1)])
+    if ultimo_pedido:
+        sementes['numero_pedido'] = ultimo_pedido['numero_pedido']
+    
+    ultima_ordem = await db.ordens_producao.find_one({"numero_ordem": {"$gt": 0}}, sort=[("numero_ordem", -1)])
+    if ultima_ordem:
+        sementes['numero_ordem'] = ultima_ordem['numero_ordem']
+    
+    # Pedidos de lojas físicas: uma sequência por prefixo (LJ-SJB-0001 → pedidos_lojas:SJB)
+    async for pedido in db.pedidos_lojas.find({"numero_pedido": {"$regex": "^LJ-"}}, {"numero_pedido": 1}):
+        prefixo, _, numero = pedido['numero_pedido'][3:].rpartition('-')
+        try:
+            numero = int(numero)
+        except ValueError:
+            continue
+        sequencia = f"pedidos_lojas:{prefixo}"
+        sementes[sequencia] = max(sementes.get(sequencia, 0), numero)
+    
+    for sequencia, valor in sementes.items():
+        await db.counters.update_one({"_id": sequencia}, {"$max": {"seq": valor}}, upsert=True)
+    
+    await db.counters.update_one(
+        {"_id": CONTADORES_MARCADOR_SEMENTE},
+        {"$set": {"semeado_em": datetime.now(timezone.utc), "sequencias": len(sementes)}},
+        upsert=True
+    )
+    print(f"🔢 Counters semeados ({len(sementes)} sequências)")
 
 # Endpoints de Pedidos de Manufatura
 @api_router.get("/gestao/pedidos")
-async def get_pedidos(loja: Optional[str] = None, status: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    """Retorna pedidos filtrados por loja e status"""
+async def get_pedidos(loja: Optional[str] = None, status: Optional[str] = None, view: str = "summary", current_user: dict = Depends(get_current_user)):
+    """Retorna pedidos filtrados por loja e status (resumo; completo no detalhe ou com view=full)"""
     query = {}
     if loja and loja != 'fabrica':
         query['loja_id'] = loja
     if status:
         query['status'] = status
     
-    pedidos = await db.pedidos_manufatura.find(query).sort("numero_pedido", -1).to_list(None)
-    # Remove _id do MongoDB
-    for pedido in pedidos:
-        if '_id' in pedido:
-            del pedido['_id']
-    return pedidos
+    projecao = projecao_listagem('pedidos_manufatura', view)
+    return await db.pedidos_manufatura.find(query, projecao).sort("numero_pedido", -1).to_list(None)
 
 def get_custo_por_prazo(produto, prazo_selecionado):
     """Obtém o custo unitário baseado no prazo selecionado do produto"""
@@ -2220,27 +2452,28 @@ async def calcular_pedido(pedido: PedidoCalculoRequest, current_user: dict = Dep
     # 2. Calcular perímetro (cm)
     resultado['perimetro'] = (2 * pedido.altura) + (2 * pedido.largura)
     
-    # 3. Buscar insumos e calcular custos
+    # 3. Buscar insumos no catálogo em memória (sem acesso ao banco) e calcular custos
+    catalogo = await catalogo_precos.obter()
     itens = []
     custo_total = 0
     markup_sugerido = 3.0  # Markup padrão
     
     # 3.1 Moldura
     if pedido.moldura_id:
-        moldura_produto = await db.produtos_gestao.find_one({"id": pedido.moldura_id})
-        moldura = await db.insumos.find_one({"id": pedido.moldura_id})
+        moldura_produto = catalogo.produtos_por_id.get(pedido.moldura_id)
+        moldura = catalogo.insumos_por_id.get(pedido.moldura_id)
         
         if moldura_produto:
-            # Usar prazo selecionado no produto
-            prazo = moldura_produto.get('prazo_selecionado', '120dias')
-            custo_metro_linear = get_custo_por_prazo(moldura_produto, prazo)  # Custo por metro linear
+            # Custos pré-calculados no catálogo pelo prazo selecionado no produto
+            precos = catalogo.precos_produto[moldura_produto['id']]
+            custo_metro_linear = precos['custo']  # Custo por metro linear
             
             # Preço de manufatura (preço de venda por metro linear)
-            preco_metro_linear = moldura_produto.get('preco_manufatura', custo_metro_linear)
+            preco_metro_linear = precos['preco']
             
-            # Pegar markup do produto (usar markup_manufatura)
-            if moldura_produto.get('markup_manufatura'):
-                markup_sugerido = (moldura_produto['markup_manufatura'] / 100) + 1  # Converter % para multiplicador
+            # Pegar markup do produto (markup_manufatura já convertido para multiplicador)
+            if precos['markup'] is not None:
+                markup_sugerido = precos['markup']
             
             moldura = {
                 'id': moldura_produto['id'],
@@ -2308,19 +2541,19 @@ async def calcular_pedido(pedido: PedidoCalculoRequest, current_user: dict = Dep
     
     # 3.2 Vidro
     if pedido.usar_vidro and pedido.vidro_id:
-        vidro_produto = await db.produtos_gestao.find_one({"id": pedido.vidro_id})
-        vidro = await db.insumos.find_one({"id": pedido.vidro_id})
+        vidro_produto = catalogo.produtos_por_id.get(pedido.vidro_id)
+        vidro = catalogo.insumos_por_id.get(pedido.vidro_id)
         
         if vidro_produto:
-            prazo = vidro_produto.get('prazo_selecionado', '120dias')
-            custo_unitario = get_custo_por_prazo(vidro_produto, prazo)
+            precos = catalogo.precos_produto[vidro_produto['id']]
+            custo_unitario = precos['custo']
             
             # NOVO: Pegar preço de manufatura
-            preco_unitario = vidro_produto.get('preco_manufatura', custo_unitario)
+            preco_unitario = precos['preco']
             
             # Pegar markup do produto
-            if vidro_produto.get('markup_manufatura'):
-                markup_item = (vidro_produto['markup_manufatura'] / 100) + 1
+            if precos['markup'] is not None:
+                markup_item = precos['markup']
                 if markup_item > markup_sugerido:
                     markup_sugerido = markup_item
             
@@ -2353,18 +2586,18 @@ async def calcular_pedido(pedido: PedidoCalculoRequest, current_user: dict = Dep
     
     # 3.3 MDF
     if pedido.usar_mdf and pedido.mdf_id:
-        mdf_produto = await db.produtos_gestao.find_one({"id": pedido.mdf_id})
-        mdf = await db.insumos.find_one({"id": pedido.mdf_id})
+        mdf_produto = catalogo.produtos_por_id.get(pedido.mdf_id)
+        mdf = catalogo.insumos_por_id.get(pedido.mdf_id)
         
         if mdf_produto:
-            prazo = mdf_produto.get('prazo_selecionado', '120dias')
-            custo_unitario = get_custo_por_prazo(mdf_produto, prazo)
+            precos = catalogo.precos_produto[mdf_produto['id']]
+            custo_unitario = precos['custo']
             
             # NOVO: Pegar preço de manufatura
-            preco_unitario = mdf_produto.get('preco_manufatura', custo_unitario)
+            preco_unitario = precos['preco']
             
-            if mdf_produto.get('markup_manufatura'):
-                markup_item = (mdf_produto['markup_manufatura'] / 100) + 1
+            if precos['markup'] is not None:
+                markup_item = precos['markup']
                 if markup_item > markup_sugerido:
                     markup_sugerido = markup_item
             
@@ -2397,18 +2630,18 @@ async def calcular_pedido(pedido: PedidoCalculoRequest, current_user: dict = Dep
     
     # 3.4 Papel/Adesivo
     if pedido.usar_papel and pedido.papel_id:
-        papel_produto = await db.produtos_gestao.find_one({"id": pedido.papel_id})
-        papel = await db.insumos.find_one({"id": pedido.papel_id})
+        papel_produto = catalogo.produtos_por_id.get(pedido.papel_id)
+        papel = catalogo.insumos_por_id.get(pedido.papel_id)
         
         if papel_produto:
-            prazo = papel_produto.get('prazo_selecionado', '120dias')
-            custo_unitario = get_custo_por_prazo(papel_produto, prazo)
+            precos = catalogo.precos_produto[papel_produto['id']]
+            custo_unitario = precos['custo']
             
             # NOVO: Pegar preço de manufatura
-            preco_unitario = papel_produto.get('preco_manufatura', custo_unitario)
+            preco_unitario = precos['preco']
             
-            if papel_produto.get('markup_manufatura'):
-                markup_item = (papel_produto['markup_manufatura'] / 100) + 1
+            if precos['markup'] is not None:
+                markup_item = precos['markup']
                 if markup_item > markup_sugerido:
                     markup_sugerido = markup_item
             
@@ -2441,18 +2674,18 @@ async def calcular_pedido(pedido: PedidoCalculoRequest, current_user: dict = Dep
     
     # 3.5 Passe-partout
     if pedido.usar_passepartout and pedido.passepartout_id:
-        passepartout_produto = await db.produtos_gestao.find_one({"id": pedido.passepartout_id})
-        passepartout = await db.insumos.find_one({"id": pedido.passepartout_id})
+        passepartout_produto = catalogo.produtos_por_id.get(pedido.passepartout_id)
+        passepartout = catalogo.insumos_por_id.get(pedido.passepartout_id)
         
         if passepartout_produto:
-            prazo = passepartout_produto.get('prazo_selecionado', '120dias')
-            custo_unitario = get_custo_por_prazo(passepartout_produto, prazo)
+            precos = catalogo.precos_produto[passepartout_produto['id']]
+            custo_unitario = precos['custo']
             
             # NOVO: Pegar preço de manufatura
-            preco_unitario = passepartout_produto.get('preco_manufatura', custo_unitario)
+            preco_unitario = precos['preco']
             
-            if passepartout_produto.get('markup_manufatura'):
-                markup_item = (passepartout_produto['markup_manufatura'] / 100) + 1
+            if precos['markup'] is not None:
+                markup_item = precos['markup']
                 if markup_item > markup_sugerido:
                     markup_sugerido = markup_item
             
@@ -2487,18 +2720,18 @@ async def calcular_pedido(pedido: PedidoCalculoRequest, current_user: dict = Dep
     if pedido.usar_acessorios and pedido.acessorios_ids:
         descricoes = []
         for acessorio_id in pedido.acessorios_ids:
-            acessorio_produto = await db.produtos_gestao.find_one({"id": acessorio_id})
-            acessorio = await db.insumos.find_one({"id": acessorio_id})
+            acessorio_produto = catalogo.produtos_por_id.get(acessorio_id)
+            acessorio = catalogo.insumos_por_id.get(acessorio_id)
             
             if acessorio_produto:
-                prazo = acessorio_produto.get('prazo_selecionado', '120dias')
-                custo_unitario = get_custo_por_prazo(acessorio_produto, prazo)
+                precos = catalogo.precos_produto[acessorio_produto['id']]
+                custo_unitario = precos['custo']
                 
                 # NOVO: Pegar preço de manufatura
-                preco_unitario = acessorio_produto.get('preco_manufatura', custo_unitario)
+                preco_unitario = precos['preco']
                 
-                if acessorio_produto.get('markup_manufatura'):
-                    markup_item = (acessorio_produto['markup_manufatura'] / 100) + 1
+                if precos['markup'] is not None:
+                    markup_item = precos['markup']
                     if markup_item > markup_sugerido:
                         markup_sugerido = markup_item
                 
@@ -2566,6 +2799,173 @@ async def calcular_pedido(pedido: PedidoCalculoRequest, current_user: dict = Dep
     
     return resultado
 
+CALCULO_LOTE_MAX_CELULAS = int(os.environ.get('CALCULO_LOTE_MAX_CELULAS', '5000'))
+
+def precos_insumo_calculo(catalogo: SnapshotCatalogo, insumo_id: str, campo_custo: str = 'custo_unitario', campo_preco: str = 'preco_unitario') -> Optional[dict]:
+    """Custo, preço e markup de um insumo resolvidos como em calcular_pedido (produto primeiro, depois insumo)"""
+    produto = catalogo.produtos_por_id.get(insumo_id)
+    if produto:
+        precos = catalogo.precos_produto[produto['id']]
+        return {
+            'descricao': produto['descricao'],
+            'custo': precos['custo'],
+            'preco': precos['preco'],
+            'markup': precos['markup'],
+            'barra_padrao': 270,
+            'largura_moldura': produto.get('largura', 0) or 0
+        }
+    
+    insumo = catalogo.insumos_por_id.get(insumo_id)
+    if not insumo:
+        return None
+    try:
+        return {
+            'descricao': insumo['descricao'],
+            'custo': insumo[campo_custo],
+            'preco': insumo[campo_preco],
+            'markup': None,
+            'barra_padrao': insumo.get('barra_padrao', 270),
+            'largura_moldura': insumo.get('largura_moldura', 0) or 0
+        }
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"Insumo {insumo_id} sem o campo {e} necessário para o cálculo")
+
+@api_router.post("/gestao/pedidos/calcular-lote")
+async def calcular_pedidos_lote(lote: PedidoCalculoLoteRequest, current_user: dict = Depends(get_current_user)):
+    """
+    Calcula de uma vez a matriz tamanhos × molduras com NumPy
+    
+    Cada célula equivale a /gestao/pedidos/calcular com aquele tamanho e moldura e os demais
+    insumos do lote (mesmas fórmulas e mesma ordem das somas). Retorna uma matriz
+    [tamanho][moldura] por métrica.
+    """
+    import numpy as np
+    
+    moldura_ids = lote.moldura_ids or [None]
+    if not lote.tamanhos:
+        raise HTTPException(status_code=400, detail="Informe ao menos um tamanho")
+    if len(lote.tamanhos) * len(moldura_ids) > CALCULO_LOTE_MAX_CELULAS:
+        raise HTTPException(status_code=400, detail=f"Lote excede o limite de {CALCULO_LOTE_MAX_CELULAS} combinações")
+    
+    catalogo = await catalogo_precos.obter()
+    quantidade = lote.quantidade
+    
+    # 1. Insumos iguais em todas as células: por área (vidro, MDF, papel, passe-partout) e acessórios
+    insumos_area = []
+    for usar, insumo_id in [
+        (lote.usar_vidro, lote.vidro_id),
+        (lote.usar_mdf, lote.mdf_id),
+        (lote.usar_papel, lote.papel_id),
+        (lote.usar_passepartout, lote.passepartout_id)
+    ]:
+        if usar and insumo_id:
+            insumo = precos_insumo_calculo(catalogo, insumo_id)
+            if insumo:
+                insumos_area.append(insumo)
+    
+    acessorios = []
+    if lote.usar_acessorios and lote.acessorios_ids:
+        for acessorio_id in lote.acessorios_ids:
+            acessorio = precos_insumo_calculo(catalogo, acessorio_id)
+            if acessorio:
+                acessorios.append(acessorio)
+    
+    # 2. Molduras (colunas); markup: a moldura define e os demais insumos só elevam
+    molduras = [
+        precos_insumo_calculo(catalogo, moldura_id, 'custo_por_metro', 'preco_por_metro') if moldura_id else None
+        for moldura_id in moldura_ids
+    ]
+    markups = []
+    for moldura in molduras:
+        markup = 3.0
+        if moldura and moldura['markup'] is not None:
+            markup = moldura['markup']
+        for insumo in insumos_area + acessorios:
+            if insumo['markup'] is not None and insumo['markup'] > markup:
+                markup = insumo['markup']
+        markups.append(markup)
+    
+    encontrada = np.array([moldura is not None for moldura in molduras])
+    custo_metro = np.array([moldura['custo'] if moldura else 0 for moldura in molduras], dtype=float)
+    preco_metro = np.array([moldura['preco'] if moldura else 0 for moldura in molduras], dtype=float)
+    barra_padrao = np.array([moldura['barra_padrao'] if moldura else 270 for moldura in molduras], dtype=float)
+    largura_moldura = np.array([moldura['largura_moldura'] if moldura else 0 for moldura in molduras], dtype=float)
+    
+    # 3. Tamanhos (linhas): área (m²) e perímetro (cm)
+    altura = np.array([tamanho.altura for tamanho in lote.tamanhos], dtype=float)[:, None]
+    largura = np.array([tamanho.largura for tamanho in lote.tamanhos], dtype=float)[:, None]
+    area = (altura * largura) / 10000
+    perimetro = (2 * altura) + (2 * largura)
+    
+    # 4. Moldura: barras, sobra e perdas (largura × 8 no corte; sobra < 100cm é cobrada)
+    barras = np.where(encontrada, np.ceil(perimetro / barra_padrao), 0)
+    sobra = np.where(encontrada, (barras * barra_padrao) - perimetro, 0)
+    perda_corte_cm = np.where(largura_moldura > 0, largura_moldura * 8, 0)
+    perda_sobra_cm = np.where(sobra < 100, sobra, 0)
+    perda_total_cm = perda_corte_cm + perda_sobra_cm
+    perimetro_cobrado_metros = (perimetro + perda_total_cm) / 100
+    
+    custo_total = np.where(encontrada, perimetro_cobrado_metros * custo_metro * quantidade, 0)
+    preco_venda = np.where(encontrada, perimetro_cobrado_metros * preco_metro * quantidade, 0)
+    custo_perda = np.where(encontrada, (perda_total_cm / 100) * custo_metro, 0)
+    
+    # 5. Demais insumos, somados na mesma ordem de calcular_pedido
+    for insumo in insumos_area:
+        custo_total = custo_total + area * insumo['custo'] * quantidade
+        preco_venda = preco_venda + area * insumo['preco'] * quantidade
+    for acessorio in acessorios:
+        custo_total = custo_total + acessorio['custo'] * quantidade
+        preco_venda = preco_venda + acessorio['preco'] * quantidade
+    
+    com_venda = preco_venda > 0
+    margem_percentual = np.where(com_venda, (preco_venda - custo_total) / np.where(com_venda, preco_venda, 1) * 100, 0)
+    
+    # 6. Desconto/sobre-preço (% ou valor)
+    desconto = np.zeros_like(preco_venda)
+    if lote.desconto_percentual > 0:
+        desconto = preco_venda * (lote.desconto_percentual / 100)
+    elif lote.desconto_valor > 0:
+        desconto = np.full_like(preco_venda, lote.desconto_valor)
+    
+    sobre_preco = np.zeros_like(preco_venda)
+    if lote.sobre_preco_percentual > 0:
+        sobre_preco = preco_venda * (lote.sobre_preco_percentual / 100)
+    elif lote.sobre_preco_valor > 0:
+        sobre_preco = np.full_like(preco_venda, lote.sobre_preco_valor)
+    
+    valor_final = preco_venda - desconto + sobre_preco
+    
+    forma = (len(lote.tamanhos), len(moldura_ids))
+    
+    def matriz(valores):
+        return np.broadcast_to(valores, forma).tolist()
+    
+    return {
+        "tamanhos": [
+            {"altura": t.altura, "largura": t.largura, "area": float(a), "perimetro": float(p)}
+            for t, a, p in zip(lote.tamanhos, area[:, 0], perimetro[:, 0])
+        ],
+        "molduras": [
+            {
+                "id": moldura_id,
+                "descricao": moldura['descricao'] if moldura else '',
+                "encontrada": moldura is not None,
+                "markup": markup,
+                "perda_corte_cm": float(perda)
+            }
+            for moldura_id, moldura, markup, perda in zip(moldura_ids, molduras, markups, perda_corte_cm)
+        ],
+        "matrizes": {
+            "barras_necessarias": matriz(barras.astype(int)),
+            "sobra": matriz(sobra),
+            "custo_perda": matriz(custo_perda),
+            "custo_total": matriz(custo_total),
+            "preco_venda": matriz(preco_venda),
+            "margem_percentual": matriz(margem_percentual),
+            "valor_final": matriz(valor_final)
+        }
+    }
+
 @api_router.post("/gestao/pedidos")
 async def create_pedido(request: Request, current_user: dict = Depends(get_current_user)):
     """Cria um novo pedido de manufatura"""
@@ -2595,7 +2995,9 @@ async def create_pedido(request: Request, current_user: dict = Depends(get_curre
         ]
         
         pedido_dict = pedido.model_dump()
+        pedido_dict['eventos_migrados'] = True
         await db.pedidos_manufatura.insert_one(pedido_dict)
+        await registrar_eventos('pedido', pedido_dict['id'], 'historico_status', pedido_dict['historico_status'])
         
         # Remove _id
         if '_id' in pedido_dict:
@@ -2613,220 +3015,576 @@ async def create_pedido(request: Request, current_user: dict = Depends(get_curre
         print(f"\n❌ ERRO GERAL: {str(e)}\n")
         raise
 
-@api_router.get("/gestao/pedidos/{pedido_id}")
-async def get_pedido(pedido_id: str, current_user: dict = Depends(get_current_user)):
-    """Retorna um pedido específico"""
-    pedido = await db.pedidos_manufatura.find_one({"id": pedido_id})
-    if not pedido:
-        raise HTTPException(status_code=404, detail="Pedido não encontrado")
-    if '_id' in pedido:
-        del pedido['_id']
-    return pedido
-
 @api_router.put("/gestao/pedidos/{pedido_id}")
 async def update_pedido(pedido_id: str, pedido: PedidoManufatura, current_user: dict = Depends(get_current_user)):
-    """Atualiza um pedido existente"""
-    pedido_dict = pedido.model_dump()
+    """Atualiza um pedido existente (o histórico de status é gravado só pela rota de status)"""
+    pedido_dict = pedido.model_dump(exclude={'historico_status'})
     pedido_dict['updated_at'] = datetime.now(timezone.utc).isoformat()
-    await db.pedidos_manufatura.update_one({"id": pedido_id}, {"$set": pedido_dict})
+    anterior = await db.pedidos_manufatura.find_one_and_update(
+        {"id": pedido_id},
+        {"$set": pedido_dict},
+        projection={"_id": 0, "status": 1, "historico_status": 1}
+    )
+    
+    # Itens editados em pedido Pronto/Entregue (ou que saiu desses status) realinham o ledger de consumo
+    if anterior and (pedido_dict.get('status') in STATUS_CONSUMO_INSUMOS or anterior.get('status') in STATUS_CONSUMO_INSUMOS):
+        atualizado = {**pedido_dict, 'id': pedido_id, 'historico_status': anterior.get('historico_status')}
+        await sincronizar_consumo_pedido(atualizado, data_conclusao_pedido(atualizado))
+    
     return {"message": "Pedido atualizado com sucesso"}
 
+# ============= EVENTOS DE PRODUÇÃO (HISTÓRICO / TIMELINE) =============
+# Histórico de status dos pedidos, timeline e aprovações das ordens ficam na coleção
+# append-only eventos_producao (um insert por entrada). O documento pai guarda só as
+# últimas HISTORICO_CACHE_N entradas, atualizadas com $push + $slice (sem reescrever o array).
+
+HISTORICO_CACHE_N = int(os.environ.get('HISTORICO_CACHE_N', '20'))
+EVENTOS_PAGINA_MAX = 200
+
+# entidade -> (coleção do documento pai, {campo/tipo do evento: campo de data da entrada})
+ENTIDADES_EVENTOS = {
+    'pedido': ('pedidos_manufatura', {'historico_status': 'data'}),
+    'ordem': ('ordens_producao', {'timeline': 'data_hora', 'historico_aprovacoes': 'data_aprovacao'}),
+}
+
+async def ensure_eventos_producao_indexes():
+    await db.eventos_producao.create_index('id', unique=True)
+    # (data, id) é a ordem e o cursor da paginação: eventos com a mesma data não se perdem
+    await db.eventos_producao.create_index([('entidade', 1), ('entidade_id', 1), ('tipo', 1), ('data', -1), ('id', -1)])
+    try:
+        await db.eventos_producao.drop_index('entidade_1_entidade_id_1_tipo_1_data_-1')
+    except Exception:
+        pass  # Índice antigo (sem id) já removido ou nunca criado
+
+def documento_evento(entidade: str, entidade_id: str, tipo: str, registro: dict, evento_id: Optional[str] = None) -> dict:
+    """Evento com a entrada original em 'registro' e a data dela normalizada para ordenação"""
+    campo_data = ENTIDADES_EVENTOS[entidade][1][tipo]
+    return {
+        'id': evento_id or str(uuid.uuid4()),
+        'entidade': entidade,
+        'entidade_id': entidade_id,
+        'tipo': tipo,
+        'data': parse_data_pedido(registro.get(campo_data)) or datetime(1970, 1, 1, tzinfo=timezone.utc),
+        'registro': registro
+    }
+
+def push_cache_eventos(tipo: str, registros: list) -> dict:
+    """$push que acrescenta as entradas ao cache do documento pai mantendo só as últimas N"""
+    return {tipo: {"$each": registros, "$slice": -HISTORICO_CACHE_N}}
+
+async def registrar_eventos(entidade: str, entidade_id: str, tipo: str, registros: list, session=None):
+    """Grava as entradas em eventos_producao (append-only)"""
+    if registros:
+        await db.eventos_producao.insert_many(
+            [documento_evento(entidade, entidade_id, tipo, registro) for registro in registros],
+            session=session
+        )
+
+async def migrar_eventos_legados(entidade: str, entidade_id: str, documento: Optional[dict] = None, session=None) -> int:
+    """
+    Copia o histórico embutido (anterior aos eventos) para eventos_producao e corta o cache.
+    Idempotente: ids determinísticos por posição e marcação eventos_migrados no documento pai.
+    """
+    from pymongo.errors import BulkWriteError
+    
+    colecao, campos = ENTIDADES_EVENTOS[entidade]
+    if documento is None or 'eventos_migrados' not in documento:
+        documento = await db[colecao].find_one(
+            {"id": entidade_id},
+            {"_id": 0, "eventos_migrados": 1, **{campo: 1 for campo in campos}},
+            session=session
+        )
+    if not documento or documento.get('eventos_migrados'):
+        return 0
+    
+    eventos = [
+        documento_evento(entidade, entidade_id, tipo, registro, evento_id=f"legado:{entidade}:{entidade_id}:{tipo}:{i}")
+        for tipo in campos
+        for i, registro in enumerate(documento.get(tipo) or [])
+        if isinstance(registro, dict)
+    ]
+    if eventos:
+        try:
+            await db.eventos_producao.insert_many(eventos, ordered=False, session=session)
+        except BulkWriteError as e:
+            # Migração concorrente do mesmo documento: só duplicatas são esperadas
+            if any(erro.get('code') != 11000 for erro in e.details.get('writeErrors', [])):
+                raise
+    
+    # Só depois de copiar: marca e corta os arrays para as últimas N entradas
+    await db[colecao].update_one(
+        {"id": entidade_id, "eventos_migrados": {"$ne": True}},
+        {
+            "$set": {"eventos_migrados": True},
+            "$push": {campo: {"$each": [], "$slice": -HISTORICO_CACHE_N} for campo in campos}
+        },
+        session=session
+    )
+    return len(eventos)
+
+async def backfill_eventos_producao(lote: int = 200) -> dict:
+    """Migra em segundo plano os documentos que ainda têm o histórico só embutido"""
+    resumo = {}
+    for entidade, (colecao, campos) in ENTIDADES_EVENTOS.items():
+        documentos = eventos = 0
+        cursor = db[colecao].find(
+            {"eventos_migrados": {"$ne": True}},
+            {"_id": 0, "id": 1, "eventos_migrados": 1, **{campo: 1 for campo in campos}}
+        ).batch_size(lote)
+        async for documento in cursor:
+            documento.setdefault('eventos_migrados', False)
+            eventos += await migrar_eventos_legados(entidade, documento['id'], documento)
+            documentos += 1
+        resumo[entidade] = {"documentos": documentos, "eventos": eventos}
+    
+    if any(item["documentos"] for item in resumo.values()):
+        print(f"🕒 Históricos embutidos migrados para eventos_producao: {resumo}")
+    return resumo
+
+async def inicializar_eventos_producao():
+    await ensure_eventos_producao_indexes()
+    asyncio.create_task(backfill_eventos_producao())
+
+async def listar_eventos(entidade: str, entidade_id: str, tipo: str, limit: int, antes: Optional[str]) -> dict:
+    """
+    Página de eventos (mais recentes primeiro); 'proximo' é o cursor para a página seguinte,
+    no formato "<data ISO>|<id do evento>" (uma data ISO sozinha também é aceita em 'antes')
+    """
+    await migrar_eventos_legados(entidade, entidade_id)
+    
+    limit = min(max(limit, 1), EVENTOS_PAGINA_MAX)
+    query = {"entidade": entidade, "entidade_id": entidade_id, "tipo": tipo}
+    if antes:
+        cursor_texto, _, cursor_id = antes.partition('|')
+        cursor_data = parse_data_pedido(cursor_texto)
+        if not cursor_data:
+            raise HTTPException(status_code=400, detail="Parâmetro 'antes' deve ser o cursor 'proximo' ou uma data ISO")
+        if cursor_id:
+            query["$or"] = [{"data": {"$lt": cursor_data}}, {"data": cursor_data, "id": {"$lt": cursor_id}}]
+        else:
+            query["data"] = {"$lt": cursor_data}
+    
+    eventos = await db.eventos_producao.find(query, {"_id": 0}).sort([("data", -1), ("id", -1)]).limit(limit).to_list(None)
+    ultimo = eventos[-1] if len(eventos) == limit else None
+    return {
+        "eventos": [evento['registro'] for evento in eventos],
+        "proximo": f"{ultimo['data'].isoformat()}|{ultimo['id']}" if ultimo else None
+    }
+
+@api_router.get("/gestao/pedidos/{pedido_id}/historico")
+async def get_historico_pedido(pedido_id: str, limit: int = 50, antes: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """Histórico de status do pedido, paginado"""
+    return await listar_eventos('pedido', pedido_id, 'historico_status', limit, antes)
+
+@api_router.get("/gestao/producao/{ordem_id}/timeline")
+async def get_timeline_ordem(ordem_id: str, limit: int = 50, antes: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """Timeline da ordem de produção, paginada"""
+    return await listar_eventos('ordem', ordem_id, 'timeline', limit, antes)
+
+@api_router.get("/gestao/producao/{ordem_id}/aprovacoes")
+async def get_aprovacoes_ordem(ordem_id: str, limit: int = 50, antes: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """Histórico de aprovações da ordem de produção, paginado"""
+    return await listar_eventos('ordem', ordem_id, 'historico_aprovacoes', limit, antes)
+
+# ============= OUTBOX DAS AUTOMAÇÕES DE STATUS =============
+# A mudança de status grava o pedido e um evento em outbox_eventos na mesma transação; os efeitos
+# (ordem de produção, contas a receber, lançamento financeiro) rodam depois, em outra transação,
+# pelo OutboxWorker. Chaves de idempotência por pedido tornam cada efeito seguro para reprocessar.
+
+from pymongo.errors import OperationFailure
+
+OUTBOX_POLL_SECONDS = float(os.environ.get('OUTBOX_POLL_SECONDS', '10'))
+OUTBOX_LEASE_SECONDS = float(os.environ.get('OUTBOX_LEASE_SECONDS', '120'))
+OUTBOX_MAX_TENTATIVAS = int(os.environ.get('OUTBOX_MAX_TENTATIVAS', '10'))
+STATUS_COM_AUTOMACAO = {"Montagem", "Pronto", "Entregue"}
+
+_transacoes_suportadas: Optional[bool] = None
+
+async def executar_em_transacao(operacao):
+    """
+    Executa operacao(session) numa transação multi-documento
+    
+    MongoDB standalone não suporta transações: nesse caso a operação roda sem sessão e a
+    consistência fica com as chaves de idempotência (o evento é reprocessado até concluir).
+    """
+    global _transacoes_suportadas
+    if _transacoes_suportadas is not False:
+        try:
+            async with await client.start_session() as session:
+                resultado = await session.with_transaction(operacao)
+            _transacoes_suportadas = True
+            return resultado
+        except OperationFailure as e:
+            if e.code != 20:  # IllegalOperation: servidor sem replica set
+                raise
+            _transacoes_suportadas = False
+            print("⚠️ MongoDB sem suporte a transações (standalone): automações rodam sem transação")
+    return await operacao(None)
+
+async def ensure_outbox_indexes():
+    """Índices da outbox e das chaves de idempotência dos efeitos"""
+    await db.outbox_eventos.create_index('id', unique=True)
+    await db.outbox_eventos.create_index([('status', 1), ('proxima_tentativa', 1)])
+    for collection, campo in [
+        (db.ordens_producao, 'id_pedido_origem'),
+        (db.contas_receber, 'chave_idempotencia'),
+        (db.lancamentos_financeiros, 'chave_idempotencia')
+    ]:
+        try:
+            await collection.create_index(campo, unique=True, partialFilterExpression={campo: {'$type': 'string'}})
+        except Exception as e:
+            print(f"⚠️ Índice único {collection.name}.{campo} não criado (há registros duplicados?): {e}")
+
+async def criar_ordem_producao_pedido(pedido: dict, usuario: str, session=None):
+    """Cria a Ordem de Produção do pedido em Montagem (uma por pedido: id_pedido_origem)"""
+    pedido_id = pedido['id']
+    print(f"\n🏭 AUTOMAÇÃO: Criando Ordem de Produção para pedido #{pedido['numero_pedido']}")
+    
+    # Verificar se já existe ordem de produção para este pedido
+    ordem_existente = await db.ordens_producao.find_one({"id_pedido_origem": pedido_id}, session=session)
+    if ordem_existente:
+        print(f"⚠️ Ordem de Produção já existe para este pedido")
+        return
+    
+    # Gerar número da ordem
+    numero_ordem = await proximo_numero('numero_ordem', session=session)
+    
+    # Criar ordem de produção
+    ordem_producao = {
+        'id': str(uuid.uuid4()),
+        'numero_ordem': numero_ordem,
+        'cliente_nome': pedido.get('cliente_nome', 'Cliente não informado'),
+        'loja_origem': pedido.get('loja_id', 'fabrica'),
+        'id_pedido_origem': pedido_id,
+        'numero_pedido_origem': pedido.get('numero_pedido', 0),
+        'status_producao': 'Em Fila',  # Status inicial
+        'responsavel_atual': '',
+        'timeline': [{
+            'data_hora': datetime.now(timezone.utc).isoformat(),
+            'usuario': usuario,
+            'mudanca': 'Ordem criada automaticamente',
+            'comentario': f'Pedido #{pedido.get("numero_pedido")} entrou em Montagem'
+        }],
+        'checklist': {
+            'arte_aprovada': False,
+            'insumos_conferidos': False,
+            'pagamento_confirmado': False,
+            'qualidade_concluida': False,
+            'embalado': False
+        },
+        'observacoes': f"Tipo: {pedido.get('tipo_produto', 'Quadro')}, Dimensões: {pedido.get('altura', 0)}x{pedido.get('largura', 0)}cm",
+        'anexos': [],
+        'sla_status': 'No Prazo',
+        'prioridade': 'Normal',
+        'dias_em_producao': 0,
+        'data_entrada': datetime.now(timezone.utc).isoformat(),
+        'data_previsao': None,
+        'data_conclusao': None,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'updated_at': datetime.now(timezone.utc).isoformat(),
+        'created_by': usuario
+    }
+    
+    ordem_producao['eventos_migrados'] = True
+    await db.ordens_producao.insert_one(ordem_producao, session=session)
+    await registrar_eventos('ordem', ordem_producao['id'], 'timeline', ordem_producao['timeline'], session=session)
+    print(f"✅ Ordem de Produção #{numero_ordem} criada com sucesso!")
+
+async def criar_contas_receber_pedido(pedido: dict, usuario: str, session=None):
+    """Cria as Contas a Receber (uma por parcela, em um único insert_many) do pedido em Montagem"""
+    pedido_id = pedido['id']
+    print(f"\n💰 AUTOMAÇÃO: Criando Contas a Receber para pedido #{pedido['numero_pedido']}")
+    
+    # Verificar se tem forma de pagamento definida
+    if not pedido.get('forma_pagamento_id'):
+        print(f"⚠️ Pedido sem forma de pagamento definida - pulando criação de contas a receber")
+        return
+    
+    # Buscar dados da forma de pagamento
+    forma_pagamento = await db.formas_pagamento_banco.find_one({"id": pedido.get('forma_pagamento_id')}, session=session)
+    if not forma_pagamento:
+        print(f"⚠️ Forma de pagamento não encontrada")
+        return
+    
+    total_parcelas = forma_pagamento.get('numero_parcelas', 1)
+    chaves = [f"montagem:{pedido_id}:{i}/{total_parcelas}" for i in range(1, total_parcelas + 1)]
+    
+    # Parcelas já criadas (reprocessamento) ou contas antigas sem chave de idempotência
+    existentes = await db.contas_receber.find(
+        {"pedido_id": pedido_id},
+        {"_id": 0, "chave_idempotencia": 1},
+        session=session
+    ).to_list(None)
+    if any(not conta.get('chave_idempotencia') for conta in existentes):
+        print(f"⚠️ Contas a Receber já existem para este pedido")
+        return
+    chaves_existentes = {conta['chave_idempotencia'] for conta in existentes}
+    
+    espaco_dias = forma_pagamento.get('espaco_parcelas_dias', 30)
+    valor_bruto = pedido.get('valor_bruto', pedido.get('valor_final', 0))
+    taxa_percentual = pedido.get('taxa_percentual', 0)
+    valor_liquido = pedido.get('valor_liquido_empresa', valor_bruto)
+    
+    # Calcular valor por parcela
+    valor_bruto_parcela = valor_bruto / total_parcelas
+    valor_liquido_parcela = valor_liquido / total_parcelas
+    
+    print(f"📊 Gerando {total_parcelas} parcela(s) - Valor bruto: R${valor_bruto:.2f} - Valor líquido: R${valor_liquido:.2f}")
+    
+    contas = []
+    for i, chave in enumerate(chaves, start=1):
+        if chave in chaves_existentes:
+            continue
+        
+        # Calcular data de vencimento da parcela
+        dias_adicionar = (i - 1) * espaco_dias
+        data_venc = datetime.now(timezone.utc) + timedelta(days=dias_adicionar)
+        
+        contas.append({
+            'id': str(uuid.uuid4()),
+            'chave_idempotencia': chave,
+            'pedido_id': pedido_id,
+            'documento': f"Pedido_{pedido.get('numero_pedido', 0)}-{i}/{total_parcelas}",
+            'cliente_origem': pedido.get('cliente_nome', 'Cliente não informado'),
+            'loja_id': pedido.get('loja_id', 'fabrica'),
+            'vendedor': usuario,
+            'valor_bruto': valor_bruto_parcela,
+            'valor_liquido': valor_liquido_parcela,
+            'valor': valor_liquido_parcela,
+            'forma_pagamento_id': pedido.get('forma_pagamento_id'),
+            'forma_pagamento_nome': pedido.get('forma_pagamento_nome', ''),
+            'conta_bancaria_id': pedido.get('conta_bancaria_id', ''),
+            'conta_bancaria_nome': pedido.get('conta_bancaria_nome', ''),
+            'taxa_percentual': taxa_percentual,
+            'numero_parcela': i,
+            'total_parcelas': total_parcelas,
+            'data_emissao': datetime.now(timezone.utc).isoformat(),
+            'data_vencimento': data_venc.isoformat(),
+            'data_prevista': data_venc.isoformat(),
+            'data_operacao_bancaria': None,
+            'data_pago_loja': None,
+            'data_recebimento': None,
+            'categoria_id': '',
+            'categoria_nome': 'Venda de Produtos e Serviços',
+            'grupo_categoria': 'Receita Bruta',
+            'status': 'Pendente',
+            'dc': 'C',
+            'recorrencia': 'ÚNICA',
+            'lote': '',
+            'conta_id_interno': '',
+            'descricao': f"Venda {pedido.get('loja_id', 'fabrica')} - Pedido #{pedido.get('numero_pedido', 0)}",
+            'observacoes': f"Parcela {i} de {total_parcelas}",
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'updated_at': datetime.now(timezone.utc).isoformat(),
+            'created_by': usuario
+        })
+    
+    if not contas:
+        print(f"⚠️ Contas a Receber já existem para este pedido")
+        return
+    
+    await db.contas_receber.insert_many(contas, session=session)
+    print(f"✅ Total de {len(contas)} Conta(s) a Receber criada(s) com sucesso!")
+
+async def criar_lancamento_pedido(pedido: dict, novo_status: str, usuario: str, session=None):
+    """Gera o lançamento financeiro do pedido Pronto/Entregue (um por pedido e status)"""
+    chave = f"lancamento:{pedido['id']}:{novo_status}"
+    if await db.lancamentos_financeiros.find_one({"chave_idempotencia": chave}, {"_id": 1}, session=session):
+        return
+    
+    lancamento = {
+        'id': str(uuid.uuid4()),
+        'chave_idempotencia': chave,
+        'pedido_id': pedido['id'],
+        'numero_pedido': pedido['numero_pedido'],
+        'tipo': 'Receita',
+        'categoria': 'Venda de Manufatura',
+        'descricao': f"Pedido #{pedido['numero_pedido']} - {pedido.get('cliente_nome', 'Cliente')}",
+        'valor_custo': pedido.get('custo_total', 0),
+        'valor_venda': pedido.get('preco_venda', 0),
+        'margem_percentual': pedido.get('margem_percentual', 0),
+        'loja_id': pedido.get('loja_id', 'fabrica'),
+        'data': datetime.now(timezone.utc).isoformat(),
+        'status': 'Concluído' if novo_status == 'Entregue' else 'Pendente',
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'created_by': usuario
+    }
+    await db.lancamentos_financeiros.insert_one(lancamento, session=session)
+
+async def aplicar_automacoes_status(evento: dict, session=None):
+    """Efeitos da mudança de status do pedido registrada no evento da outbox"""
+    pedido = await db.pedidos_manufatura.find_one({"id": evento['pedido_id']}, session=session)
+    if not pedido:
+        print(f"⚠️ Pedido {evento['pedido_id']} não encontrado - automações ignoradas")
+        return
+    
+    novo_status = evento['status_pedido']
+    usuario = evento.get('usuario', '')
+    
+    # AUTOMAÇÃO: Se status for "Montagem", criar Ordem de Produção e Contas a Receber
+    if novo_status == "Montagem":
+        await criar_ordem_producao_pedido(pedido, usuario, session)
+        await criar_contas_receber_pedido(pedido, usuario, session)
+    
+    # Se status for "Pronto" ou "Entregue", gerar lançamento financeiro
+    if novo_status in ["Pronto", "Entregue"]:
+        await criar_lancamento_pedido(pedido, novo_status, usuario, session)
+    
+    # Ledger de consumo segue o status atual do pedido (eventos fora de ordem convergem)
+    await sincronizar_consumo_pedido(pedido, evento.get('created_at') or datetime.now(timezone.utc), session)
+
+class OutboxWorker:
+    """
+    Processa outbox_eventos: cada evento é disparado logo após o commit da mudança de status e,
+    se o processo cair ou o efeito falhar, o polling retoma pendentes e leases vencidos
+    """
+    
+    def __init__(self):
+        self._poll_task = None
+        self._tarefas = set()
+    
+    async def _reivindicar(self, evento_id: Optional[str] = None) -> Optional[dict]:
+        agora = datetime.now(timezone.utc)
+        filtro = {"$or": [
+            {"status": "pendente", "proxima_tentativa": {"$lte": agora}},
+            {"status": "processando", "bloqueado_ate": {"$lt": agora}}
+        ]}
+        if evento_id:
+            filtro["id"] = evento_id
+        return await db.outbox_eventos.find_one_and_update(
+            filtro,
+            {
+                "$set": {"status": "processando", "bloqueado_ate": agora + timedelta(seconds=OUTBOX_LEASE_SECONDS)},
+                "$inc": {"tentativas": 1}
+            },
+            sort=[("proxima_tentativa", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+    
+    async def processar(self, evento_id: Optional[str] = None) -> bool:
+        """Processa um evento (o indicado ou o próximo vencido); retorna False se não havia evento"""
+        evento = await self._reivindicar(evento_id)
+        if not evento:
+            return False
+        
+        async def aplicar(session):
+            await aplicar_automacoes_status(evento, session)
+            await db.outbox_eventos.update_one(
+                {"id": evento['id']},
+                {
+                    "$set": {"status": "concluido", "processado_em": datetime.now(timezone.utc)},
+                    "$unset": {"bloqueado_ate": "", "ultimo_erro": ""}
+                },
+                session=session
+            )
+        
+        try:
+            await executar_em_transacao(aplicar)
+        except Exception as e:
+            tentativas = evento.get('tentativas', 1)
+            esgotado = tentativas >= OUTBOX_MAX_TENTATIVAS
+            atraso = min(3600, 30 * (2 ** (tentativas - 1)))
+            await db.outbox_eventos.update_one(
+                {"id": evento['id']},
+                {
+                    "$set": {
+                        "status": "erro" if esgotado else "pendente",
+                        "ultimo_erro": str(e),
+                        "proxima_tentativa": datetime.now(timezone.utc) + timedelta(seconds=atraso)
+                    },
+                    "$unset": {"bloqueado_ate": ""}
+                }
+            )
+            print(f"❌ Erro nas automações do pedido {evento.get('pedido_id')} ({evento.get('status_pedido')}), tentativa {tentativas}: {e}")
+        return True
+    
+    def disparar(self, evento_id: str):
+        """Processa o evento em segundo plano, sem segurar a resposta da requisição"""
+        tarefa = asyncio.create_task(self.processar(evento_id))
+        self._tarefas.add(tarefa)
+        tarefa.add_done_callback(self._tarefas.discard)
+    
+    async def _poll(self):
+        while True:
+            try:
+                while await self.processar():
+                    pass
+            except Exception as e:
+                print(f"⚠️ Erro ao processar outbox: {e}")
+            await asyncio.sleep(OUTBOX_POLL_SECONDS)
+    
+    def iniciar_polling(self):
+        if self._poll_task is None:
+            self._poll_task = asyncio.create_task(self._poll())
+    
+    async def parar_polling(self):
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
+
+outbox_worker = OutboxWorker()
+
 @api_router.put("/gestao/pedidos/{pedido_id}/status")
 async def update_status_pedido(pedido_id: str, novo_status: str, observacao: Optional[str] = "", current_user: dict = Depends(get_current_user)):
-    """Atualiza o status de um pedido e registra no histórico"""
+    """
+    Atualiza o status de um pedido e registra no histórico
+    
+    Automações (Montagem, Pronto, Entregue e a saída de Pronto/Entregue, que estorna o consumo
+    de insumos) são gravadas como evento na outbox junto com o status e executadas pelo
+    OutboxWorker depois da resposta.
+    """
     pedido = await db.pedidos_manufatura.find_one({"id": pedido_id})
     if not pedido:
         raise HTTPException(status_code=404, detail="Pedido não encontrado")
     
-    # Adicionar ao histórico
-    historico = pedido.get('historico_status', [])
-    historico.append({
+    # Entrada do histórico (evento append-only + cache das últimas N no pedido)
+    await migrar_eventos_legados('pedido', pedido_id, pedido)
+    entrada_historico = {
         'status': novo_status,
         'data': datetime.now(timezone.utc).isoformat(),
         'usuario': current_user.get('username', ''),
         'observacao': observacao
-    })
+    }
     
-    # Atualizar pedido
-    await db.pedidos_manufatura.update_one(
-        {"id": pedido_id},
-        {
-            "$set": {
-                "status": novo_status,
-                "historico_status": historico,
-                "updated_at": datetime.now(timezone.utc).isoformat()
-            }
+    evento = None
+    if novo_status in STATUS_COM_AUTOMACAO or pedido.get('status') in STATUS_CONSUMO_INSUMOS:
+        evento = {
+            'id': str(uuid.uuid4()),
+            'tipo': 'pedido_status',
+            'pedido_id': pedido_id,
+            'status_pedido': novo_status,
+            'usuario': current_user.get('username', ''),
+            'status': 'pendente',
+            'tentativas': 0,
+            'proxima_tentativa': datetime.now(timezone.utc),
+            'created_at': datetime.now(timezone.utc)
         }
-    )
     
-    # AUTOMAÇÃO: Se status for "Montagem", criar Ordem de Produção automaticamente
-    if novo_status == "Montagem":
-        try:
-            print(f"\n🏭 AUTOMAÇÃO: Criando Ordem de Produção para pedido #{pedido['numero_pedido']}")
-            
-            # Verificar se já existe ordem de produção para este pedido
-            ordem_existente = await db.ordens_producao.find_one({"id_pedido_origem": pedido_id})
-            
-            if not ordem_existente:
-                # Gerar número da ordem
-                ultimo_numero = await db.ordens_producao.find_one({}, sort=[("numero_ordem", -1)])
-                numero_ordem = (ultimo_numero['numero_ordem'] + 1) if ultimo_numero and 'numero_ordem' in ultimo_numero else 1
-                
-                # Criar ordem de produção
-                ordem_producao = {
-                    'id': str(uuid.uuid4()),
-                    'numero_ordem': numero_ordem,
-                    'cliente_nome': pedido.get('cliente_nome', 'Cliente não informado'),
-                    'loja_origem': pedido.get('loja_id', 'fabrica'),
-                    'id_pedido_origem': pedido_id,
-                    'numero_pedido_origem': pedido.get('numero_pedido', 0),
-                    'status_producao': 'Em Fila',  # Status inicial
-                    'responsavel_atual': '',
-                    'timeline': [{
-                        'data_hora': datetime.now(timezone.utc).isoformat(),
-                        'usuario': current_user.get('username', ''),
-                        'mudanca': 'Ordem criada automaticamente',
-                        'comentario': f'Pedido #{pedido.get("numero_pedido")} entrou em Montagem'
-                    }],
-                    'checklist': {
-                        'arte_aprovada': False,
-                        'insumos_conferidos': False,
-                        'pagamento_confirmado': False,
-                        'qualidade_concluida': False,
-                        'embalado': False
-                    },
-                    'observacoes': f"Tipo: {pedido.get('tipo_produto', 'Quadro')}, Dimensões: {pedido.get('altura', 0)}x{pedido.get('largura', 0)}cm",
-                    'anexos': [],
-                    'sla_status': 'No Prazo',
-                    'prioridade': 'Normal',
-                    'dias_em_producao': 0,
-                    'data_entrada': datetime.now(timezone.utc).isoformat(),
-                    'data_previsao': None,
-                    'data_conclusao': None,
-                    'created_at': datetime.now(timezone.utc).isoformat(),
-                    'updated_at': datetime.now(timezone.utc).isoformat(),
-                    'created_by': current_user.get('username', '')
-                }
-                
-                await db.ordens_producao.insert_one(ordem_producao)
-                print(f"✅ Ordem de Produção #{numero_ordem} criada com sucesso!")
-            else:
-                print(f"⚠️ Ordem de Produção já existe para este pedido")
-                
-        except Exception as e:
-            print(f"❌ Erro ao criar ordem de produção: {e}")
-            # Não interromper o fluxo, apenas logar o erro
+    # Atualizar pedido e registrar o evento na mesma transação
+    async def gravar_status(session):
+        await db.pedidos_manufatura.update_one(
+            {"id": pedido_id},
+            {
+                "$set": {
+                    "status": novo_status,
+                    "updated_at": datetime.now(timezone.utc).isoformat()
+                },
+                "$push": push_cache_eventos('historico_status', [entrada_historico])
+            },
+            session=session
+        )
+        await registrar_eventos('pedido', pedido_id, 'historico_status', [entrada_historico], session=session)
+        if evento:
+            await db.outbox_eventos.insert_one(dict(evento), session=session)
     
-    # AUTOMAÇÃO: Se status for "Montagem", criar Contas a Receber automaticamente
-    if novo_status == "Montagem":
-        try:
-            print(f"\n💰 AUTOMAÇÃO: Criando Contas a Receber para pedido #{pedido['numero_pedido']}")
-            
-            # Verificar se tem forma de pagamento definida
-            if not pedido.get('forma_pagamento_id'):
-                print(f"⚠️ Pedido sem forma de pagamento definida - pulando criação de contas a receber")
-            else:
-                # Verificar se já existem contas a receber para este pedido
-                contas_existentes = await db.contas_receber.find_one({"pedido_id": pedido_id})
-                
-                if not contas_existentes:
-                    # Buscar dados da forma de pagamento
-                    forma_pagamento = await db.formas_pagamento_banco.find_one({"id": pedido.get('forma_pagamento_id')})
-                    
-                    if forma_pagamento:
-                        total_parcelas = forma_pagamento.get('numero_parcelas', 1)
-                        espaco_dias = forma_pagamento.get('espaco_parcelas_dias', 30)
-                        valor_bruto = pedido.get('valor_bruto', pedido.get('valor_final', 0))
-                        taxa_percentual = pedido.get('taxa_percentual', 0)
-                        valor_liquido = pedido.get('valor_liquido_empresa', valor_bruto)
-                        
-                        # Calcular valor por parcela
-                        valor_bruto_parcela = valor_bruto / total_parcelas
-                        valor_liquido_parcela = valor_liquido / total_parcelas
-                        
-                        print(f"📊 Gerando {total_parcelas} parcela(s) - Valor bruto: R${valor_bruto:.2f} - Valor líquido: R${valor_liquido:.2f}")
-                        
-                        # Criar uma conta a receber para cada parcela
-                        for i in range(1, total_parcelas + 1):
-                            # Calcular data de vencimento da parcela
-                            dias_adicionar = (i - 1) * espaco_dias
-                            data_venc = datetime.now(timezone.utc) + timedelta(days=dias_adicionar)
-                            
-                            conta_receber = {
-                                'id': str(uuid.uuid4()),
-                                'pedido_id': pedido_id,
-                                'documento': f"Pedido_{pedido.get('numero_pedido', 0)}-{i}/{total_parcelas}",
-                                'cliente_origem': pedido.get('cliente_nome', 'Cliente não informado'),
-                                'loja_id': pedido.get('loja_id', 'fabrica'),
-                                'vendedor': current_user.get('username', ''),
-                                'valor_bruto': valor_bruto_parcela,
-                                'valor_liquido': valor_liquido_parcela,
-                                'valor': valor_liquido_parcela,
-                                'forma_pagamento_id': pedido.get('forma_pagamento_id'),
-                                'forma_pagamento_nome': pedido.get('forma_pagamento_nome', ''),
-                                'conta_bancaria_id': pedido.get('conta_bancaria_id', ''),
-                                'conta_bancaria_nome': pedido.get('conta_bancaria_nome', ''),
-                                'taxa_percentual': taxa_percentual,
-                                'numero_parcela': i,
-                                'total_parcelas': total_parcelas,
-                                'data_emissao': datetime.now(timezone.utc).isoformat(),
-                                'data_vencimento': data_venc.isoformat(),
-                                'data_prevista': data_venc.isoformat(),
-                                'data_operacao_bancaria': None,
-                                'data_pago_loja': None,
-                                'data_recebimento': None,
-                                'categoria_id': '',
-                                'categoria_nome': 'Venda de Produtos e Serviços',
-                                'grupo_categoria': 'Receita Bruta',
-                                'status': 'Pendente',
-                                'dc': 'C',
-                                'recorrencia': 'ÚNICA',
-                                'lote': '',
-                                'conta_id_interno': '',
-                                'descricao': f"Venda {pedido.get('loja_id', 'fabrica')} - Pedido #{pedido.get('numero_pedido', 0)}",
-                                'observacoes': f"Parcela {i} de {total_parcelas}",
-                                'created_at': datetime.now(timezone.utc).isoformat(),
-                                'updated_at': datetime.now(timezone.utc).isoformat(),
-                                'created_by': current_user.get('username', '')
-                            }
-                            
-                            await db.contas_receber.insert_one(conta_receber)
-                            print(f"✅ Conta a Receber criada: Parcela {i}/{total_parcelas} - Vencimento: {data_venc.strftime('%d/%m/%Y')}")
-                        
-                        print(f"✅ Total de {total_parcelas} Conta(s) a Receber criada(s) com sucesso!")
-                    else:
-                        print(f"⚠️ Forma de pagamento não encontrada")
-                else:
-                    print(f"⚠️ Contas a Receber já existem para este pedido")
-                    
-        except Exception as e:
-            print(f"❌ Erro ao criar contas a receber: {e}")
-            import traceback
-            print(traceback.format_exc())
-            # Não interromper o fluxo, apenas logar o erro
+    await executar_em_transacao(gravar_status)
     
-    # Se status for "Pronto" ou "Entregue", gerar lançamento financeiro
-    if novo_status in ["Pronto", "Entregue"]:
-        try:
-            lancamento = {
-                'id': str(uuid.uuid4()),
-                'pedido_id': pedido_id,
-                'numero_pedido': pedido['numero_pedido'],
-                'tipo': 'Receita',
-                'categoria': 'Venda de Manufatura',
-                'descricao': f"Pedido #{pedido['numero_pedido']} - {pedido.get('cliente_nome', 'Cliente')}",
-                'valor_custo': pedido.get('custo_total', 0),
-                'valor_venda': pedido.get('preco_venda', 0),
-                'margem_percentual': pedido.get('margem_percentual', 0),
-                'loja_id': pedido.get('loja_id', 'fabrica'),
-                'data': datetime.now(timezone.utc).isoformat(),
-                'status': 'Concluído' if novo_status == 'Entregue' else 'Pendente',
-                'created_at': datetime.now(timezone.utc).isoformat(),
-                'created_by': current_user.get('username', '')
-            }
-            await db.lancamentos_financeiros.insert_one(lancamento)
-        except Exception as e:
-            print(f"Erro ao criar lançamento financeiro: {e}")
+    if evento:
+        outbox_worker.disparar(evento['id'])
     
     return {"message": f"Status atualizado para {novo_status}"}
 
@@ -2839,8 +3597,8 @@ async def delete_pedido(pedido_id: str, current_user: dict = Depends(get_current
 # ============= ENDPOINTS: ORDEM DE PRODUÇÃO (FÁBRICA) =============
 
 @api_router.get("/gestao/producao")
-async def get_ordens_producao(loja: Optional[str] = None, status: Optional[str] = None, responsavel: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    """Lista todas as ordens de produção com filtros opcionais"""
+async def get_ordens_producao(loja: Optional[str] = None, status: Optional[str] = None, responsavel: Optional[str] = None, view: str = "summary", current_user: dict = Depends(get_current_user)):
+    """Lista todas as ordens de produção com filtros opcionais (resumo; completa no detalhe ou com view=full)"""
     filtro = {}
     
     if loja:
@@ -2850,13 +3608,8 @@ async def get_ordens_producao(loja: Optional[str] = None, status: Optional[str]
     if responsavel:
         filtro['responsavel_atual'] = responsavel
     
-    ordens = await db.ordens_producao.find(filtro).sort("created_at", -1).to_list(length=1000)
-    
-    # Remover _id
-    for ordem in ordens:
-        ordem.pop('_id', None)
-    
-    return ordens
+    projecao = projecao_listagem('ordens_producao', view)
+    return await db.ordens_producao.find(filtro, projecao).sort("created_at", -1).to_list(length=1000)
 
 @api_router.post("/gestao/producao")
 async def create_ordem_producao(ordem: OrdemProducao, current_user: dict = Depends(get_current_user)):
@@ -2873,52 +3626,112 @@ async def create_ordem_producao(ordem: OrdemProducao, current_user: dict = Depen
     ordem.timeline.append(entrada_inicial)
     
     ordem_dict = ordem.model_dump()
+    ordem_dict['eventos_migrados'] = True
     await db.ordens_producao.insert_one(ordem_dict)
+    await registrar_eventos('ordem', ordem_dict['id'], 'timeline', ordem_dict['timeline'])
     
     ordem_dict.pop('_id', None)
     return ordem_dict
 
-@api_router.get("/gestao/producao/{ordem_id}")
-async def get_ordem_producao(ordem_id: str, current_user: dict = Depends(get_current_user)):
-    """Busca uma ordem de produção por ID"""
-    ordem = await db.ordens_producao.find_one({"id": ordem_id})
-    if not ordem:
+# Campos de OrdemProducao que o PATCH não altera (controle interno, histórico ou
+# aprovações - estas só mudam pelas rotas de aprovação/envio para setor)
+CAMPOS_ORDEM_NAO_EDITAVEIS = {
+    'id', 'numero_ordem', 'timeline', 'historico_aprovacoes', 'created_at', 'created_by', 'updated_at',
+    'aguardando_aprovacao', 'responsavel_pendente',
+    'aprovacao_gerencia_producao', 'aprovacao_financeiro',
+    'gerente_que_aprovou', 'financeiro_que_aprovou',
+    'data_aprovacao_gerencia', 'data_aprovacao_financeiro',
+}
+
+_adaptadores_campos_ordem = {}
+
+def validar_campos_ordem(dados: dict) -> dict:
+    """Valida só os campos enviados contra os tipos de OrdemProducao e devolve os valores para o $set"""
+    from pydantic import TypeAdapter
+    
+    campos = OrdemProducao.model_fields
+    invalidos = [campo for campo in dados if campo not in campos or campo in CAMPOS_ORDEM_NAO_EDITAVEIS]
+    if invalidos:
+        raise HTTPException(status_code=400, detail=f"Campos não editáveis: {', '.join(sorted(invalidos))}")
+    
+    valores = {}
+    erros = []
+    for campo, valor in dados.items():
+        adaptador = _adaptadores_campos_ordem.get(campo)
+        if adaptador is None:
+            adaptador = _adaptadores_campos_ordem[campo] = TypeAdapter(campos[campo].annotation)
+        try:
+            valores[campo] = adaptador.dump_python(adaptador.validate_python(valor))
+        except ValidationError as e:
+            erros.extend({**erro, 'loc': (campo, *erro['loc'])} for erro in e.errors(include_context=False))
+    if erros:
+        raise HTTPException(status_code=422, detail=erros)
+    return valores
+
+async def erro_versao_ordem(ordem_id: str):
+    """404 se a ordem não existe; senão 409 (foi alterada depois da versão lida pelo cliente)"""
+    atual = await db.ordens_producao.find_one({"id": ordem_id}, {"_id": 0, "versao": 1})
+    if not atual:
         raise HTTPException(status_code=404, detail="Ordem não encontrada")
-    
-    ordem.pop('_id', None)
-    return ordem
+    raise HTTPException(
+        status_code=409,
+        detail=f"Ordem alterada por outro usuário (versão atual: {atual.get('versao', 0)}). Recarregue e tente novamente."
+    )
 
-@api_router.put("/gestao/producao/{ordem_id}")
-async def update_ordem_producao(ordem_id: str, ordem: OrdemProducao, current_user: dict = Depends(get_current_user)):
-    """Atualiza uma ordem de produção"""
-    ordem_existente = await db.ordens_producao.find_one({"id": ordem_id})
-    if not ordem_existente:
-        raise HTTPException(status_code=404, detail="Ordem não encontrada")
-    
-    ordem.updated_at = datetime.now(timezone.utc)
-    
-    # Verificar mudanças e adicionar na timeline
-    if ordem_existente.get('status_interno') != ordem.status_interno:
-        entrada_timeline = TimelineEntry(
-            usuario=current_user.get('username', ''),
-            mudanca=f"Status alterado: {ordem_existente.get('status_interno')} → {ordem.status_interno}",
-            comentario=""
-        )
-        ordem.timeline.append(entrada_timeline)
-    
-    if ordem_existente.get('responsavel_atual') != ordem.responsavel_atual:
-        entrada_timeline = TimelineEntry(
-            usuario=current_user.get('username', ''),
-            mudanca=f"Responsável alterado: {ordem_existente.get('responsavel_atual')} → {ordem.responsavel_atual}",
-            comentario=""
+@api_router.patch("/gestao/producao/{ordem_id}")
+async def patch_ordem_producao(ordem_id: str, dados: dict, current_user: dict = Depends(get_current_user)):
+    """
+    Atualização parcial da ordem: recebe só os campos alterados e a 'versao' lida pelo cliente.
+    Grava com $set condicionado à versão (409 se outra edição chegou antes).
+    """
+    dados = dict(dados)
+    versao = dados.pop('versao', None)
+    if not isinstance(versao, int) or isinstance(versao, bool):
+        raise HTTPException(status_code=428, detail="Informe a 'versao' da ordem que está sendo editada")
+    
+    alteracoes = validar_campos_ordem(dados)
+    if not alteracoes:
+        raise HTTPException(status_code=400, detail="Nenhum campo para atualizar")
+    
+    # Ordens antigas não têm 'versao' (equivale a 0)
+    filtro = {"id": ordem_id, "versao": versao if versao else {"$in": [0, None]}}
+    
+    # Timeline: só lê os campos comparados, e só quando eles foram enviados
+    novas_entradas = []
+    campos_timeline = {'status_interno': 'Status', 'responsavel_atual': 'Responsável'}
+    if any(campo in alteracoes for campo in campos_timeline):
+        atual = await db.ordens_producao.find_one(
+            filtro, {"_id": 0, "id": 1, "eventos_migrados": 1, **{campo: 1 for campo in campos_timeline}}
         )
-        ordem.timeline.append(entrada_timeline)
-    
-    ordem_dict = ordem.model_dump()
-    await db.ordens_producao.replace_one({"id": ordem_id}, ordem_dict)
+        if not atual:
+            await erro_versao_ordem(ordem_id)
+        await migrar_eventos_legados('ordem', ordem_id, atual)
+        for campo, rotulo in campos_timeline.items():
+            if campo in alteracoes and atual.get(campo) != alteracoes[campo]:
+                novas_entradas.append(TimelineEntry(
+                    usuario=current_user.get('username', ''),
+                    mudanca=f"{rotulo} alterado: {atual.get(campo)} → {alteracoes[campo]}",
+                    comentario=""
+                ).model_dump())
+    
+    atualizacao = {
+        "$set": {**alteracoes, "updated_at": datetime.now(timezone.utc)},
+        "$inc": {"versao": 1}
+    }
+    if novas_entradas:
+        atualizacao["$push"] = push_cache_eventos('timeline', novas_entradas)
+    
+    ordem = await db.ordens_producao.find_one_and_update(
+        filtro,
+        atualizacao,
+        projection={"_id": 0, "id": 1, "versao": 1, "updated_at": 1, **{campo: 1 for campo in alteracoes}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not ordem:
+        await erro_versao_ordem(ordem_id)
+    await registrar_eventos('ordem', ordem_id, 'timeline', novas_entradas)
     
-    ordem_dict.pop('_id', None)
-    return ordem_dict
+    return ordem
 
 @api_router.delete("/gestao/producao/{ordem_id}")
 async def delete_ordem_producao(ordem_id: str, current_user: dict = Depends(get_current_user)):
@@ -2929,9 +3742,10 @@ async def delete_ordem_producao(ordem_id: str, current_user: dict = Depends(get_
 @api_router.post("/gestao/producao/{ordem_id}/timeline")
 async def add_timeline_entry(ordem_id: str, mudanca: str, comentario: Optional[str] = "", current_user: dict = Depends(get_current_user)):
     """Adiciona uma entrada manual na timeline"""
-    ordem = await db.ordens_producao.find_one({"id": ordem_id})
+    ordem = await db.ordens_producao.find_one({"id": ordem_id}, {"_id": 0, "id": 1, "eventos_migrados": 1})
     if not ordem:
         raise HTTPException(status_code=404, detail="Ordem não encontrada")
+    await migrar_eventos_legados('ordem', ordem_id, ordem)
     
     entrada = {
         'data_hora': datetime.now(timezone.utc).isoformat(),
@@ -2942,65 +3756,366 @@ async def add_timeline_entry(ordem_id: str, mudanca: str, comentario: Optional[s
     
     await db.ordens_producao.update_one(
         {"id": ordem_id},
-        {"$push": {"timeline": entrada}}
+        {"$push": push_cache_eventos('timeline', [entrada])}
     )
+    await registrar_eventos('ordem', ordem_id, 'timeline', [entrada])
     
     return {"message": "Entrada adicionada à timeline"}
 
+STATUS_PRODUCAO_DASHBOARD = ["Armazenado na Loja", "Aguardando Arte", "Armazenado Fábrica", "Pronto para Impressão", "Impresso", "Produção", "Acabamento", "Pronto", "Entregue", "Reparo"]
+LOJAS_PRODUCAO_DASHBOARD = ["fabrica", "loja1", "loja2", "loja3", "loja4", "loja5"]
+DASHBOARD_CACHE_SECONDS = float(os.environ.get('DASHBOARD_CACHE_SECONDS', '5'))
+
+# Último resultado do dashboard (compartilhado entre requisições do processo)
+_dashboard_stats_cache = {"expira_em": 0.0, "dados": None}
+
+async def ensure_producao_indexes():
+    """Índices dos filtros de produção (listagem e dashboard)"""
+    await db.ordens_producao.create_index('status_interno')
+    await db.ordens_producao.create_index('loja_origem')
+    await db.ordens_producao.create_index('data_entrega_prometida')
+
+def contagens_com_padrao(grupos: list, padrao: list) -> dict:
+    """Contagens na ordem da lista padrão (zeros incluídos) + valores extras presentes nos dados"""
+    contagens = {chave: 0 for chave in padrao}
+    for grupo in grupos:
+        if grupo['_id'] is not None:
+            contagens[grupo['_id']] = grupo['total']
+    return contagens
+
 @api_router.get("/gestao/producao/dashboard/stats")
 async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
-    """Retorna estatísticas para o dashboard"""
-    # Total por status
-    stats_status = {}
-    for status in ["Armazenado na Loja", "Aguardando Arte", "Armazenado Fábrica", "Pronto para Impressão", "Impresso", "Produção", "Acabamento", "Pronto", "Entregue", "Reparo"]:
-        count = await db.ordens_producao.count_documents({"status_interno": status})
-        stats_status[status] = count
-    
-    # Total por loja
-    stats_lojas = {}
-    for loja in ["fabrica", "loja1", "loja2", "loja3", "loja4", "loja5"]:
-        count = await db.ordens_producao.count_documents({"loja_origem": loja})
-        stats_lojas[loja] = count
-    
-    # Atrasados (data_entrega_prometida < hoje e status != Entregue)
+    """Retorna estatísticas para o dashboard (uma agregação, cache de poucos segundos)"""
+    import time
+    
+    agora = time.monotonic()
+    if _dashboard_stats_cache["dados"] is not None and agora < _dashboard_stats_cache["expira_em"]:
+        return _dashboard_stats_cache["dados"]
+    
+    # Atrasados: data_entrega_prometida < hoje e status != Entregue
     hoje = datetime.now(timezone.utc)
-    atrasados = await db.ordens_producao.count_documents({
-        "data_entrega_prometida": {"$lt": hoje},
-        "status_interno": {"$ne": "Entregue"}
-    })
+    resultado = await db.ordens_producao.aggregate([
+        {"$project": {"_id": 0, "status_interno": 1, "loja_origem": 1, "data_entrega_prometida": 1}},
+        {"$facet": {
+            "por_status": [{"$group": {"_id": "$status_interno", "total": {"$sum": 1}}}],
+            "por_loja": [{"$group": {"_id": "$loja_origem", "total": {"$sum": 1}}}],
+            "atrasados": [
+                {"$match": {"data_entrega_prometida": {"$lt": hoje}, "status_interno": {"$ne": "Entregue"}}},
+                {"$count": "total"}
+            ]
+        }}
+    ]).to_list(1)
+    facetas = resultado[0] if resultado else {"por_status": [], "por_loja": [], "atrasados": []}
     
-    # Em reparo
-    em_reparo = await db.ordens_producao.count_documents({"status_interno": "Reparo"})
+    stats_status = contagens_com_padrao(facetas["por_status"], STATUS_PRODUCAO_DASHBOARD)
+    stats_lojas = contagens_com_padrao(facetas["por_loja"], LOJAS_PRODUCAO_DASHBOARD)
     
-    return {
+    dados = {
         "por_status": stats_status,
         "por_loja": stats_lojas,
-        "atrasados": atrasados,
-        "em_reparo": em_reparo,
+        "atrasados": facetas["atrasados"][0]["total"] if facetas["atrasados"] else 0,
+        "em_reparo": stats_status["Reparo"],
         "total": sum(stats_status.values())
     }
+    _dashboard_stats_cache.update(dados=dados, expira_em=agora + DASHBOARD_CACHE_SECONDS)
+    return dados
 
-@api_router.post("/gestao/pedidos/upload-imagem")
-async def upload_imagem_pedido(file: UploadFile, current_user: dict = Depends(get_current_user)):
-    """Upload de imagem do objeto do cliente"""
+# ========================================
+# ARMAZENAMENTO DE IMAGENS (GridFS)
+# ========================================
+# Uploads vão para o bucket GridFS 'arquivos' com _id = sha256 do conteúdo (arquivo
+# repetido não é gravado de novo). Os documentos guardam só a URL de download; a
+# miniatura (JPEG) é gerada no upload quando o Pillow está instalado.
+
+ARQUIVOS_MAX_BYTES = int(os.environ.get('ARQUIVOS_MAX_BYTES', str(15 * 1024 * 1024)))
+MINIATURA_LADO_MAX = int(os.environ.get('MINIATURA_LADO_MAX', '320'))
+ARQUIVOS_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Campos com imagens embutidas (data: URL) migrados para o GridFS
+CAMPOS_IMAGEM_EMBUTIDA = [
+    ('pedidos_manufatura', 'imagem_anexada', False),
+    ('ordens_producao', 'fotos_entrada_material', True),
+    ('ordens_producao', 'fotos_trabalho_pronto', True),
+    ('ordens_producao', 'comprovante_pagamento', True),
+    ('pedidos_lojas', 'fotos', True),
+]
+
+def bucket_arquivos():
+    from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+    return AsyncIOMotorGridFSBucket(db, bucket_name='arquivos')
+
+def url_arquivo(arquivo_id: str, miniatura: bool = False) -> str:
+    return f"/api/gestao/arquivos/{arquivo_id}" + ("?miniatura=1" if miniatura else "")
+
+def _pillow_disponivel() -> bool:
+    """Miniaturas dependem do pacote opcional 'Pillow' (pip install Pillow)"""
+    try:
+        import PIL  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def gerar_miniatura(conteudo: bytes) -> Optional[bytes]:
+    """Reduz a imagem para caber em MINIATURA_LADO_MAX (JPEG); None sem Pillow ou se não for imagem"""
+    if not _pillow_disponivel():
+        return None
+    import io
+    from PIL import Image
+    
+    try:
+        with Image.open(io.BytesIO(conteudo)) as imagem:
+            imagem.thumbnail((MINIATURA_LADO_MAX, MINIATURA_LADO_MAX))
+            if imagem.mode not in ('RGB', 'L'):
+                imagem = imagem.convert('RGB')
+            saida = io.BytesIO()
+            imagem.save(saida, format='JPEG', quality=80, optimize=True)
+            return saida.getvalue()
+    except Exception as e:
+        print(f"⚠️  Miniatura não gerada: {e}")
+        return None
+
+async def gravar_no_bucket(bucket, arquivo_id: str, nome: str, origem, metadata: dict) -> bool:
+    """Grava o arquivo com _id fixo; False se o mesmo conteúdo já estava armazenado"""
+    from pymongo.errors import DuplicateKeyError
+    
+    if await db['arquivos.files'].find_one({"_id": arquivo_id}, {"_id": 1}):
+        return False
+    try:
+        await bucket.upload_from_stream_with_id(arquivo_id, nome, origem, metadata=metadata)
+        return True
+    except DuplicateKeyError:
+        # Upload concorrente do mesmo conteúdo
+        return False
+
+def calcular_hash_arquivo(origem) -> tuple:
+    """(sha256, tamanho) lendo em blocos, sem montar string base64 em memória; 413 acima do limite"""
+    import hashlib
+    
+    sha256 = hashlib.sha256()
+    tamanho = 0
+    origem.seek(0)
+    while True:
+        bloco = origem.read(1024 * 1024)
+        if not bloco:
+            break
+        tamanho += len(bloco)
+        if tamanho > ARQUIVOS_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"Arquivo maior que {ARQUIVOS_MAX_BYTES // (1024 * 1024)} MB")
+        sha256.update(bloco)
+    return sha256.hexdigest(), tamanho
+
+def miniatura_do_arquivo(origem) -> Optional[bytes]:
+    origem.seek(0)
+    return gerar_miniatura(origem.read())
+
+async def armazenar_imagem(origem, nome: str, content_type: str, usuario: str = "") -> dict:
+    """
+    Armazena a imagem no GridFS (deduplicada por sha256) e a miniatura, se possível.
+    `origem` é um arquivo binário (lido em blocos) ou bytes. Leitura, hash e Pillow
+    rodam em thread para não travar o event loop.
+    """
+    import io
+    
+    if isinstance(origem, (bytes, bytearray)):
+        origem = io.BytesIO(origem)
+    
+    arquivo_id, tamanho = await asyncio.to_thread(calcular_hash_arquivo, origem)
+    
+    bucket = bucket_arquivos()
+    origem.seek(0)
+    novo = await gravar_no_bucket(bucket, arquivo_id, nome or arquivo_id, origem, {
+        "content_type": content_type or "application/octet-stream",
+        "tamanho": tamanho,
+        "enviado_por": usuario,
+    })
+    
+    miniatura_id = f"{arquivo_id}_miniatura"
+    tem_miniatura = bool(await db['arquivos.files'].find_one({"_id": miniatura_id}, {"_id": 1}))
+    if novo and not tem_miniatura and (content_type or "").startswith("image/"):
+        miniatura = await asyncio.to_thread(miniatura_do_arquivo, origem)
+        if miniatura:
+            await gravar_no_bucket(bucket, miniatura_id, f"miniatura_{nome or arquivo_id}.jpg", io.BytesIO(miniatura), {
+                "content_type": "image/jpeg",
+                "tamanho": len(miniatura),
+                "original": arquivo_id,
+            })
+            tem_miniatura = True
+    
+    return {
+        "id": arquivo_id,
+        "url": url_arquivo(arquivo_id),
+        "thumbnail_url": url_arquivo(arquivo_id, miniatura=True) if tem_miniatura else url_arquivo(arquivo_id),
+        "tamanho": tamanho,
+        "content_type": content_type,
+        "duplicado": not novo
+    }
+
+@api_router.get("/gestao/arquivos/{arquivo_id}")
+async def download_arquivo(arquivo_id: str, request: Request, miniatura: bool = False):
+    """
+    Serve o arquivo do GridFS em blocos. O id é o sha256 do conteúdo, então a resposta
+    é imutável (cache longo + ETag). Sem autenticação para poder ser usado em <img src>.
+    """
+    from fastapi.responses import Response, StreamingResponse
+    from gridfs.errors import NoFile
+    
+    bucket = bucket_arquivos()
+    grid_out = None
+    servido_id = arquivo_id
+    if miniatura:
+        try:
+            servido_id = f"{arquivo_id}_miniatura"
+            grid_out = await bucket.open_download_stream(servido_id)
+        except NoFile:
+            servido_id = arquivo_id  # sem miniatura: serve o original
+    if grid_out is None:
+        try:
+            grid_out = await bucket.open_download_stream(arquivo_id)
+        except NoFile:
+            raise HTTPException(status_code=404, detail="Arquivo não encontrado")
+    
+    etag = f'"{servido_id}"'
+    headers = {"Cache-Control": ARQUIVOS_CACHE_CONTROL, "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    async def blocos():
+        while True:
+            bloco = await grid_out.readchunk()
+            if not bloco:
+                break
+            yield bloco
+    
+    headers["Content-Length"] = str(grid_out.length)
+    content_type = (grid_out.metadata or {}).get("content_type", "application/octet-stream")
+    return StreamingResponse(blocos(), media_type=content_type, headers=headers)
+
+def decodificar_data_url(data_url: str):
+    """'data:<mime>;base64,<dados>' -> (bytes, mime); None se não for data URL base64"""
     import base64
-    from datetime import datetime
+    import binascii
     
-    # Ler arquivo
-    contents = await file.read()
+    if not isinstance(data_url, str) or not data_url.startswith("data:"):
+        return None
+    cabecalho, _, dados = data_url.partition(",")
+    if ";base64" not in cabecalho:
+        return None
+    try:
+        return base64.b64decode(dados), cabecalho[5:].split(";")[0] or "image/jpeg"
+    except (binascii.Error, ValueError):
+        return None
+
+# Documento em counters que indica que a migração das imagens embutidas já rodou
+ARQUIVOS_MARCADOR_MIGRACAO = "_migracao_imagens"
+
+async def migrar_imagens_embutidas(lote: int = 50) -> dict:
+    """
+    Move imagens base64 embutidas nos documentos para o GridFS, trocando-as pela URL.
+    Ao concluir grava o marcador: uploads novos já vão para o GridFS, então a
+    varredura não roda mais na subida (só pela rota de reprocessamento).
+    """
+    resumo = {}
+    for colecao, campo, lista in CAMPOS_IMAGEM_EMBUTIDA:
+        migradas = 0
+        filtro = {campo: {"$regex": "^data:"}}
+        cursor = db[colecao].find(filtro, {"_id": 0, "id": 1, campo: 1}).batch_size(lote)
+        async for documento in cursor:
+            original = documento.get(campo)
+            valores = list(original or []) if lista else [original]
+            for i, valor in enumerate(valores):
+                decodificado = decodificar_data_url(valor)
+                if not decodificado:
+                    continue
+                conteudo, content_type = decodificado
+                arquivo = await armazenar_imagem(conteudo, f"{colecao}_{documento.get('id')}", content_type)
+                valores[i] = arquivo['url']
+            # Só grava se o campo não mudou desde a leitura
+            resultado = await db[colecao].update_one(
+                {"id": documento.get('id'), campo: original},
+                {"$set": {campo: valores if lista else valores[0]}}
+            )
+            migradas += resultado.modified_count
+        resumo[f"{colecao}.{campo}"] = migradas
     
-    # Converter para base64
-    image_base64 = base64.b64encode(contents).decode('utf-8')
+    total = sum(resumo.values())
+    if total:
+        print(f"🖼️ Imagens embutidas movidas para o GridFS: {total} ({resumo})")
     
-    # Retornar URL data
+    await db.counters.update_one(
+        {"_id": ARQUIVOS_MARCADOR_MIGRACAO},
+        {"$set": {"migrado_em": datetime.now(timezone.utc), "imagens": total}},
+        upsert=True
+    )
+    return resumo
+
+async def inicializar_arquivos():
+    """Índice de apoio do bucket e migração das imagens embutidas em segundo plano (uma única vez)"""
+    await db['arquivos.files'].create_index('metadata.original', sparse=True)
+    if not await db.counters.find_one({"_id": ARQUIVOS_MARCADOR_MIGRACAO}):
+        asyncio.create_task(migrar_imagens_embutidas())
+
+@api_router.post("/gestao/arquivos/migrar-imagens")
+async def reprocessar_imagens_embutidas(current_user: dict = Depends(get_current_user)):
+    """Move para o GridFS as imagens base64 que ainda estão dentro dos documentos"""
+    return await migrar_imagens_embutidas()
+
+@api_router.post("/gestao/pedidos/upload-imagem")
+async def upload_imagem_pedido(file: UploadFile, current_user: dict = Depends(get_current_user)):
+    """Upload de imagem do objeto do cliente (armazenada no GridFS)"""
+    arquivo = await armazenar_imagem(file.file, file.filename, file.content_type, current_user.get('username', ''))
+    
+    # Retornar URL de download (o pedido guarda só a referência)
     return {
         "success": True,
-        "url": f"data:image/jpeg;base64,{image_base64}",
+        "url": arquivo['url'],
+        "thumbnail_url": arquivo['thumbnail_url'],
+        "arquivo_id": arquivo['id'],
         "filename": file.filename
     }
 
 
 # ============= SISTEMA DE APROVAÇÃO EM CASCATA =============
+# Cada transição é um único find_one_and_update cuja pré-condição está no filtro: dois
+# aprovadores simultâneos não passam ambos. Quando o filtro não casa, a ordem é relida
+# só para explicar o motivo (404/400/403 como antes, ou 409 se outra transição venceu).
+
+async def ensure_fila_aprovacao_indexes():
+    """Índices das filas de aprovação (por responsável pendente e aprovação dupla)"""
+    await db.ordens_producao.create_index([('aguardando_aprovacao', 1), ('responsavel_pendente', 1), ('created_at', -1)])
+    await db.ordens_producao.create_index([('aprovacao_gerencia_producao', 1), ('responsavel_atual', 1)])
+    await db.ordens_producao.create_index([('aprovacao_financeiro', 1), ('responsavel_atual', 1)])
+
+async def transicao_ordem(ordem_id: str, condicao: dict, atualizacao, eventos_cache: bool = False) -> Optional[dict]:
+    """
+    Aplica a transição se a ordem ainda satisfaz `condicao`; devolve a ordem anterior ou None.
+    Com `eventos_cache`, a ordem precisa estar migrada para eventos_producao antes do $push/$slice.
+    """
+    filtro = {"id": ordem_id, **condicao}
+    if eventos_cache:
+        ordem = await db.ordens_producao.find_one_and_update({**filtro, "eventos_migrados": True}, atualizacao)
+        if ordem is not None:
+            return ordem
+        await migrar_eventos_legados('ordem', ordem_id)
+    return await db.ordens_producao.find_one_and_update(filtro, atualizacao)
+
+def condicao_versao_ordem(versao) -> dict:
+    """Filtro da 'versao' lida pelo cliente (opcional; ordens antigas sem versão equivalem a 0)"""
+    if not isinstance(versao, int) or isinstance(versao, bool):
+        return {}
+    return {"versao": versao if versao else {"$in": [0, None]}}
+
+async def erro_transicao_ordem(ordem_id: str, verificacoes: list, versao=None):
+    """Relê a ordem e levanta o erro da primeira verificação que falha (ou 409)"""
+    ordem = await db.ordens_producao.find_one({"id": ordem_id}, {"_id": 0})
+    if not ordem:
+        raise HTTPException(status_code=404, detail="Ordem não encontrada")
+    # Cliente com versão desatualizada: outra transição venceu
+    if condicao_versao_ordem(versao) and (ordem.get("versao") or 0) != versao:
+        raise HTTPException(status_code=409, detail="A ordem foi alterada por outra ação. Recarregue e tente novamente.")
+    for falhou, status_code, detail in verificacoes:
+        if falhou(ordem):
+            raise HTTPException(status_code=status_code, detail=detail(ordem) if callable(detail) else detail)
+    raise HTTPException(status_code=409, detail="A ordem foi alterada por outra ação. Recarregue e tente novamente.")
 
 @api_router.get("/gestao/producao/pendentes-aprovacao")
 async def get_ordens_pendentes_aprovacao(
@@ -3014,7 +4129,7 @@ async def get_ordens_pendentes_aprovacao(
         if responsavel:
             query["responsavel_pendente"] = responsavel
         
-        ordens = await db.ordens_producao.find(query).to_list(length=1000)
+        ordens = await db.ordens_producao.find(query, projecao_listagem('ordens_producao')).to_list(length=1000)
         
         return {
             "success": True,
@@ -3025,62 +4140,89 @@ async def get_ordens_pendentes_aprovacao(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@api_router.get("/gestao/producao/fila-aprovacao")
+async def get_fila_aprovacao(
+    responsavel: Optional[str] = None,
+    limit: int = 50,
+    skip: int = 0,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Fila de aprovação por responsável: a página de ordens do responsável pedido (padrão: o
+    usuário logado) sai de um find no índice (aguardando_aprovacao, responsavel_pendente,
+    created_at) e a contagem de pendentes de cada responsável de um $group, em paralelo.
+    """
+    responsavel = responsavel or current_user.get("nome") or current_user.get("username")
+    limit = min(max(limit, 1), 200)
+    
+    pagina = db.ordens_producao.find(
+        {"aguardando_aprovacao": True, "responsavel_pendente": responsavel},
+        projecao_listagem('ordens_producao')
+    ).sort("created_at", -1).skip(max(skip, 0)).limit(limit).to_list(None)
+    grupos = db.ordens_producao.aggregate([
+        {"$match": {"aguardando_aprovacao": True}},
+        {"$group": {"_id": "$responsavel_pendente", "total": {"$sum": 1}}}
+    ]).to_list(None)
+    ordens, grupos = await asyncio.gather(pagina, grupos)
+    contagens = {grupo['_id'] or "": grupo['total'] for grupo in grupos}
+    
+    return {
+        "success": True,
+        "responsavel": responsavel,
+        "contagens": contagens,
+        "total": contagens.get(responsavel, 0),
+        "ordens": ordens
+    }
+
+
 @api_router.post("/gestao/producao/{ordem_id}/aprovar")
 async def aprovar_ordem(
     ordem_id: str,
     dados: dict,
     current_user: dict = Depends(get_current_user)
 ):
-    """Aprovar e assumir responsabilidade sobre uma ordem de produção"""
+    """Aprovar e assumir responsabilidade sobre uma ordem de produção ('versao' opcional: 409 se a ordem mudou)"""
     try:
-        # Buscar a ordem
-        ordem = await db.ordens_producao.find_one({"id": ordem_id})
-        if not ordem:
-            raise HTTPException(status_code=404, detail="Ordem não encontrada")
-        
-        # Verificar se está aguardando aprovação
-        if not ordem.get("aguardando_aprovacao"):
-            raise HTTPException(status_code=400, detail="Esta ordem não está aguardando aprovação")
-        
-        # Verificar se o usuário é o responsável pendente
-        responsavel_pendente = ordem.get("responsavel_pendente")
-        if responsavel_pendente and responsavel_pendente != current_user.get("nome"):
-            raise HTTPException(
-                status_code=403, 
-                detail=f"Você não tem permissão. Aguardando aprovação de: {responsavel_pendente}"
-            )
-        
         # Registrar aprovação no histórico
+        aprovador = current_user.get("nome") or current_user.get("username")
         aprovacao = {
-            "responsavel": current_user.get("nome") or current_user.get("username"),
+            "responsavel": aprovador,
             "data_aprovacao": datetime.now(timezone.utc).isoformat(),
             "observacao": dados.get("observacao", "")
         }
         
-        historico = ordem.get("historico_aprovacoes", [])
-        historico.append(aprovacao)
-        
-        # Atualizar ordem
-        resultado = await db.ordens_producao.update_one(
-            {"id": ordem_id},
+        # Só aprova quem está pendente (ou qualquer um, se não há responsável definido)
+        anterior = await transicao_ordem(
+            ordem_id,
+            {
+                "aguardando_aprovacao": True,
+                "responsavel_pendente": {"$in": [current_user.get("nome"), "", None]},
+                **condicao_versao_ordem(dados.get("versao"))
+            },
             {
                 "$set": {
                     "aguardando_aprovacao": False,
-                    "responsavel_atual": responsavel_pendente,
+                    "responsavel_atual": aprovador,
                     "responsavel_pendente": "",
-                    "historico_aprovacoes": historico,
                     "updated_at": datetime.now(timezone.utc).isoformat()
-                }
-            }
+                },
+                "$inc": {"versao": 1},
+                "$push": push_cache_eventos('historico_aprovacoes', [aprovacao])
+            },
+            eventos_cache=True
         )
-        
-        if resultado.modified_count == 0:
-            raise HTTPException(status_code=500, detail="Erro ao aprovar ordem")
+        if anterior is None:
+            await erro_transicao_ordem(ordem_id, [
+                (lambda o: not o.get("aguardando_aprovacao"), 400, "Esta ordem não está aguardando aprovação"),
+                (lambda o: o.get("responsavel_pendente") and o.get("responsavel_pendente") != current_user.get("nome"),
+                 403, lambda o: f"Você não tem permissão. Aguardando aprovação de: {o.get('responsavel_pendente')}")
+            ], dados.get("versao"))
+        await registrar_eventos('ordem', ordem_id, 'historico_aprovacoes', [aprovacao])
         
         return {
             "success": True,
             "message": f"Ordem aprovada! Você assumiu a responsabilidade.",
-            "responsavel": responsavel_pendente
+            "responsavel": anterior.get("responsavel_pendente") or aprovador
         }
         
     except HTTPException:
@@ -3095,29 +4237,29 @@ async def rejeitar_ordem(
     dados: dict,
     current_user: dict = Depends(get_current_user)
 ):
-    """Rejeitar ordem e devolver para o responsável anterior"""
+    """Rejeitar ordem e devolver para o responsável anterior ('versao' opcional: 409 se a ordem mudou)"""
     try:
         motivo = dados.get("motivo", "")
         if not motivo:
             raise HTTPException(status_code=400, detail="Motivo da rejeição é obrigatório")
         
-        # Buscar a ordem
-        ordem = await db.ordens_producao.find_one({"id": ordem_id})
-        if not ordem:
-            raise HTTPException(status_code=404, detail="Ordem não encontrada")
-        
-        # Voltar para o responsável anterior
-        resultado = await db.ordens_producao.update_one(
-            {"id": ordem_id},
-            {
-                "$set": {
-                    "aguardando_aprovacao": False,
-                    "responsavel_pendente": "",
-                    "observacoes_internas": f"{ordem.get('observacoes_internas', '')}\n\n❌ REJEITADO por {current_user.get('nome')}: {motivo}",
-                    "updated_at": datetime.now(timezone.utc).isoformat()
-                }
-            }
+        # Voltar para o responsável anterior (observação concatenada no próprio update)
+        texto_rejeicao = f"\n\n❌ REJEITADO por {current_user.get('nome')}: {motivo}"
+        anterior = await transicao_ordem(
+            ordem_id,
+            {"aguardando_aprovacao": True, **condicao_versao_ordem(dados.get("versao"))},
+            [{"$set": {
+                "aguardando_aprovacao": False,
+                "responsavel_pendente": "",
+                "observacoes_internas": {"$concat": [{"$ifNull": ["$observacoes_internas", ""]}, {"$literal": texto_rejeicao}]},
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+                "versao": {"$add": [{"$ifNull": ["$versao", 0]}, 1]}
+            }}]
         )
+        if anterior is None:
+            await erro_transicao_ordem(ordem_id, [
+                (lambda o: not o.get("aguardando_aprovacao"), 400, "Esta ordem não está aguardando aprovação")
+            ], dados.get("versao"))
         
         return {
             "success": True,
@@ -3142,20 +4284,24 @@ async def transferir_responsavel(
         if not novo_responsavel:
             raise HTTPException(status_code=400, detail="Novo responsável é obrigatório")
         
-        # Atualizar ordem para aguardar aprovação
-        resultado = await db.ordens_producao.update_one(
-            {"id": ordem_id},
+        # Atualizar ordem para aguardar aprovação (se ainda não há aprovação pendente)
+        anterior = await transicao_ordem(
+            ordem_id,
+            {"aguardando_aprovacao": {"$ne": True}},
             {
                 "$set": {
                     "aguardando_aprovacao": True,
                     "responsavel_pendente": novo_responsavel,
                     "updated_at": datetime.now(timezone.utc).isoformat()
-                }
+                },
+                "$inc": {"versao": 1}
             }
         )
-        
-        if resultado.modified_count == 0:
-            raise HTTPException(status_code=404, detail="Ordem não encontrada")
+        if anterior is None:
+            await erro_transicao_ordem(ordem_id, [
+                (lambda o: o.get("aguardando_aprovacao"), 409,
+                 lambda o: f"Ordem já aguarda aprovação de: {o.get('responsavel_pendente') or 'responsável não definido'}")
+            ])
         
         return {
             "success": True,
@@ -3179,8 +4325,9 @@ async def aprovar_gerencia_producao(
     try:
         observacoes = dados.get("observacoes", "")
         
-        resultado = await db.ordens_producao.update_one(
-            {"id": ordem_id},
+        anterior = await transicao_ordem(
+            ordem_id,
+            {"aprovacao_gerencia_producao": {"$ne": True}},
             {
                 "$set": {
                     "aprovacao_gerencia_producao": True,
@@ -3188,12 +4335,15 @@ async def aprovar_gerencia_producao(
                     "data_aprovacao_gerencia": datetime.now(timezone.utc).isoformat(),
                     "observacoes_gerencia": observacoes,
                     "updated_at": datetime.now(timezone.utc).isoformat()
-                }
+                },
+                "$inc": {"versao": 1}
             }
         )
-        
-        if resultado.modified_count == 0:
-            raise HTTPException(status_code=404, detail="Ordem não encontrada")
+        if anterior is None:
+            await erro_transicao_ordem(ordem_id, [
+                (lambda o: o.get("aprovacao_gerencia_producao"), 409,
+                 lambda o: f"Já aprovado pela Gerência de Produção ({o.get('gerente_que_aprovou', '')})")
+            ])
         
         return {
             "success": True,
@@ -3215,8 +4365,9 @@ async def aprovar_financeiro(
     try:
         observacoes = dados.get("observacoes", "")
         
-        resultado = await db.ordens_producao.update_one(
-            {"id": ordem_id},
+        anterior = await transicao_ordem(
+            ordem_id,
+            {"aprovacao_financeiro": {"$ne": True}},
             {
                 "$set": {
                     "aprovacao_financeiro": True,
@@ -3224,12 +4375,15 @@ async def aprovar_financeiro(
                     "data_aprovacao_financeiro": datetime.now(timezone.utc).isoformat(),
                     "observacoes_financeiro": observacoes,
                     "updated_at": datetime.now(timezone.utc).isoformat()
-                }
+                },
+                "$inc": {"versao": 1}
             }
         )
-        
-        if resultado.modified_count == 0:
-            raise HTTPException(status_code=404, detail="Ordem não encontrada")
+        if anterior is None:
+            await erro_transicao_ordem(ordem_id, [
+                (lambda o: o.get("aprovacao_financeiro"), 409,
+                 lambda o: f"Já aprovado pelo Financeiro ({o.get('financeiro_que_aprovou', '')})")
+            ])
         
         return {
             "success": True,
@@ -3254,7 +4408,7 @@ async def get_ordens_aprovacao_dupla(
                 {"aprovacao_financeiro": False}
             ],
             "responsavel_atual": "Vendedor"
-        }).to_list(length=1000)
+        }, projecao_listagem('ordens_producao')).to_list(length=1000)
         
         return {
             "success": True,
@@ -3277,28 +4431,26 @@ async def enviar_para_setor(
         if not proximo_setor:
             raise HTTPException(status_code=400, detail="Próximo setor é obrigatório")
         
-        # Verificar se tem as duas aprovações
-        ordem = await db.ordens_producao.find_one({"id": ordem_id})
-        if not ordem:
-            raise HTTPException(status_code=404, detail="Ordem não encontrada")
-        
-        if not ordem.get("aprovacao_gerencia_producao"):
-            raise HTTPException(status_code=400, detail="Aguardando aprovação da Gerência de Produção")
-        
-        if not ordem.get("aprovacao_financeiro"):
-            raise HTTPException(status_code=400, detail="Aguardando aprovação do Financeiro")
-        
-        # Enviar para o próximo setor
-        resultado = await db.ordens_producao.update_one(
-            {"id": ordem_id},
+        # Enviar para o próximo setor (exige as duas aprovações e nenhuma aprovação pendente)
+        anterior = await transicao_ordem(
+            ordem_id,
+            {"aprovacao_gerencia_producao": True, "aprovacao_financeiro": True, "aguardando_aprovacao": {"$ne": True}},
             {
                 "$set": {
                     "aguardando_aprovacao": True,
                     "responsavel_pendente": proximo_setor,
                     "updated_at": datetime.now(timezone.utc).isoformat()
-                }
+                },
+                "$inc": {"versao": 1}
             }
         )
+        if anterior is None:
+            await erro_transicao_ordem(ordem_id, [
+                (lambda o: not o.get("aprovacao_gerencia_producao"), 400, "Aguardando aprovação da Gerência de Produção"),
+                (lambda o: not o.get("aprovacao_financeiro"), 400, "Aguardando aprovação do Financeiro"),
+                (lambda o: o.get("aguardando_aprovacao"), 409,
+                 lambda o: f"Ordem já aguarda aprovação de: {o.get('responsavel_pendente') or 'responsável não definido'}")
+            ])
         
         return {
             "success": True,
@@ -3309,53 +4461,66 @@ async def enviar_para_setor(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-        
-        return {
-            "success": True,
-            "message": f"Ordem transferida para {novo_responsavel}. Aguardando aprovação."
-        }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+
+# Detalhe da ordem: registrado depois das rotas fixas /gestao/producao/<nome> para não capturá-las
+@api_router.get("/gestao/producao/{ordem_id}")
+async def get_ordem_producao(ordem_id: str, current_user: dict = Depends(get_current_user)):
+    """Busca uma ordem de produção por ID"""
+    ordem = await db.ordens_producao.find_one({"id": ordem_id})
+    if not ordem:
+        raise HTTPException(status_code=404, detail="Ordem não encontrada")
+    
+    ordem.pop('_id', None)
+    return ordem
 
 
+# tipo_foto do upload -> campo da ordem que guarda as URLs
+CAMPOS_FOTO_PRODUCAO = {
+    "entrada_material": "fotos_entrada_material",
+    "trabalho_pronto": "fotos_trabalho_pronto",
+    "comprovante_pagamento": "comprovante_pagamento",
+}
 
 @api_router.post("/gestao/producao/{ordem_id}/fotos")
 async def upload_fotos_producao(
     ordem_id: str,
-    tipo_foto: str,  # "entrada_material" ou "trabalho_pronto"
+    tipo_foto: str,  # "entrada_material", "trabalho_pronto" ou "comprovante_pagamento"
     file: UploadFile,
     current_user: dict = Depends(get_current_user)
 ):
-    """Upload de fotos para ordem de produção"""
-    import base64
-    
+    """Upload de fotos para ordem de produção (armazenadas no GridFS)"""
     try:
-        # Ler arquivo
-        contents = await file.read()
+        if tipo_foto not in CAMPOS_FOTO_PRODUCAO:
+            raise HTTPException(status_code=400, detail="tipo_foto inválido")
+        
+        if not await db.ordens_producao.find_one({"id": ordem_id}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="Ordem não encontrada")
         
-        # Converter para base64
-        image_base64 = base64.b64encode(contents).decode('utf-8')
-        foto_url = f"data:image/jpeg;base64,{image_base64}"
+        arquivo = await armazenar_imagem(file.file, file.filename, file.content_type, current_user.get('username', ''))
+        foto_url = arquivo['url']
         
-        # Atualizar ordem com a nova foto
-        campo_foto = f"fotos_{tipo_foto}"
-        resultado = await db.ordens_producao.update_one(
+        # Atualizar ordem com a nova foto (nova versão: o formulário adota a retornada)
+        campo_foto = CAMPOS_FOTO_PRODUCAO[tipo_foto]
+        ordem = await db.ordens_producao.find_one_and_update(
             {"id": ordem_id},
-            {"$push": {campo_foto: foto_url}}
+            {"$push": {campo_foto: foto_url}, "$inc": {"versao": 1}},
+            projection={"_id": 0, "versao": 1},
+            return_document=ReturnDocument.AFTER
         )
         
-        if resultado.modified_count == 0:
+        if not ordem:
             raise HTTPException(status_code=404, detail="Ordem não encontrada")
         
         return {
             "success": True,
             "url": foto_url,
+            "thumbnail_url": arquivo['thumbnail_url'],
             "filename": file.filename,
-            "tipo": tipo_foto
+            "tipo": tipo_foto,
+            "versao": ordem['versao']
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -4390,86 +5555,238 @@ async def get_relatorio_taxas(
 
 # ============= DASHBOARD E RELATÓRIOS =============
 
+def converter_data_agg(campo: str) -> dict:
+    """Expressão de agregação que lê o campo como data (BSON date ou string ISO); inválido vira null"""
+    return {"$convert": {"input": f"${campo}", "to": "date", "onError": None, "onNull": None}}
+
 @api_router.get("/gestao/pedidos/estatisticas")
 async def get_estatisticas_pedidos(loja: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    """Retorna estatísticas consolidadas dos pedidos"""
-    from datetime import timedelta
-    
+    """Retorna estatísticas consolidadas dos pedidos (uma agregação $facet, só com os campos usados)"""
     query = {}
     if loja and loja != 'fabrica':
         query['loja_id'] = loja
     
-    # Buscar todos os pedidos
-    pedidos = await db.pedidos_manufatura.find(query).to_list(None)
+    hoje = datetime.now(timezone.utc)
+    primeiro_dia_mes = hoje.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    
+    aberto = {"$eq": [{"$in": ["$status", ["Entregue", "Cancelado"]]}, False]}
+    entregue = {"$eq": ["$status", "Entregue"]}
+    # Perda técnica do mês: sobra entre 0 e 100cm em pedidos criados no mês
+    perda_mes = {"$and": [
+        {"$ne": ["$created_at", None]},
+        {"$gte": ["$created_at", primeiro_dia_mes]},
+        {"$gt": ["$sobra", 0]},
+        {"$lt": ["$sobra", 100]}
+    ]}
+    
+    pipeline = [
+        {"$match": query},
+        {"$project": {
+            "_id": 0,
+            "status": 1,
+            "sobra": 1,
+            "custo_perda": {"$ifNull": ["$custo_perda", 0]},
+            "preco_venda": {"$ifNull": ["$preco_venda", 0]},
+            "custo_total": {"$ifNull": ["$custo_total", 0]},
+            "margem_percentual": {"$ifNull": ["$margem_percentual", 0]},
+            "prazo_entrega": converter_data_agg("prazo_entrega"),
+            "created_at": converter_data_agg("created_at")
+        }},
+        {"$facet": {
+            "por_status": [
+                {"$group": {"_id": "$status", "total": {"$sum": 1}}}
+            ],
+            "cards": [
+                {"$group": {
+                    "_id": None,
+                    "total_pedidos": {"$sum": 1},
+                    # Pedidos em produção (todos exceto Entregue e Cancelado)
+                    "em_producao": {"$sum": {"$cond": [aberto, 1, 0]}},
+                    # Pedidos em atraso (prazo vencido e não entregue)
+                    "em_atraso": {"$sum": {"$cond": [
+                        {"$and": [aberto, {"$ne": ["$prazo_entrega", None]}, {"$lt": ["$prazo_entrega", hoje]}]}, 1, 0
+                    ]}},
+                    "perdas_tecnicas_cm": {"$sum": {"$cond": [perda_mes, "$sobra", 0]}},
+                    "perdas_tecnicas_valor": {"$sum": {"$cond": [perda_mes, "$custo_perda", 0]}},
+                    "finalizados": {"$sum": {"$cond": [{"$in": ["$status", ["Pronto", "Entregue"]]}, 1, 0]}},
+                    "lucro_total": {"$sum": {"$cond": [entregue, {"$subtract": ["$preco_venda", "$custo_total"]}, 0]}},
+                    "margem_total": {"$sum": {"$cond": [entregue, "$margem_percentual", 0]}}
+                }}
+            ]
+        }}
+    ]
+    
+    resultado = (await db.pedidos_manufatura.aggregate(pipeline).to_list(1))[0]
+    cards = resultado['cards'][0] if resultado['cards'] else {}
+    por_status_total = {grupo['_id']: grupo['total'] for grupo in resultado['por_status']}
     
     # Contadores por status
     status_count = {}
     for status in ["Criado", "Em Análise", "Corte", "Montagem", "Acabamento", "Pronto", "Entregue", "Cancelado"]:
-        status_count[status] = len([p for p in pedidos if p.get('status') == status])
-    
-    # Pedidos em produção (todos exceto Entregue e Cancelado)
-    em_producao = len([p for p in pedidos if p.get('status') not in ['Entregue', 'Cancelado']])
+        status_count[status] = por_status_total.get(status, 0)
     
-    # Pedidos em atraso (prazo vencido e não entregue)
-    hoje = datetime.now(timezone.utc)
-    em_atraso = 0
-    for p in pedidos:
-        if p.get('status') not in ['Entregue', 'Cancelado'] and p.get('prazo_entrega'):
-            prazo = p['prazo_entrega']
-            if isinstance(prazo, str):
-                prazo = datetime.fromisoformat(prazo.replace('Z', '+00:00'))
-            if prazo < hoje:
-                em_atraso += 1
-    
-    # Calcular perdas técnicas do mês
-    primeiro_dia_mes = hoje.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    pedidos_mes = [p for p in pedidos if p.get('created_at')]
-    
-    perda_total_cm = 0
-    perda_total_valor = 0
-    for p in pedidos_mes:
-        created = p.get('created_at')
-        if isinstance(created, str):
-            created = datetime.fromisoformat(created.replace('Z', '+00:00'))
-        if created >= primeiro_dia_mes:
-            sobra = p.get('sobra', 0)
-            if sobra > 0 and sobra < 100:
-                perda_total_cm += sobra
-                perda_total_valor += p.get('custo_perda', 0)
-    
-    # Total de pedidos finalizados
-    finalizados = len([p for p in pedidos if p.get('status') in ['Pronto', 'Entregue']])
-    
-    # Lucro médio
-    lucro_total = sum(p.get('preco_venda', 0) - p.get('custo_total', 0) for p in pedidos if p.get('status') == 'Entregue')
-    lucro_medio = (lucro_total / finalizados) if finalizados > 0 else 0
-    
-    # Margem média
-    margem_total = sum(p.get('margem_percentual', 0) for p in pedidos if p.get('status') == 'Entregue')
-    margem_media = (margem_total / finalizados) if finalizados > 0 else 0
+    # Lucro e margem médios (sobre os finalizados)
+    finalizados = cards.get('finalizados', 0)
+    lucro_medio = (cards['lucro_total'] / finalizados) if finalizados > 0 else 0
+    margem_media = (cards['margem_total'] / finalizados) if finalizados > 0 else 0
     
     return {
         'cards': {
-            'em_producao': em_producao,
-            'em_atraso': em_atraso,
-            'perdas_tecnicas_cm': round(perda_total_cm, 2),
-            'perdas_tecnicas_valor': round(perda_total_valor, 2),
+            'em_producao': cards.get('em_producao', 0),
+            'em_atraso': cards.get('em_atraso', 0),
+            'perdas_tecnicas_cm': round(cards.get('perdas_tecnicas_cm', 0), 2),
+            'perdas_tecnicas_valor': round(cards.get('perdas_tecnicas_valor', 0), 2),
             'finalizados': finalizados,
             'lucro_medio': round(lucro_medio, 2),
             'margem_media': round(margem_media, 2)
         },
         'por_status': status_count,
-        'total_pedidos': len(pedidos)
+        'total_pedidos': cards.get('total_pedidos', 0)
     }
 
+# ============= LEDGER DE CONSUMO DE INSUMOS =============
+# consumo_insumos: uma linha por item de pedido Pronto/Entregue (chave pedido_id:índice do item),
+# mantida pelo OutboxWorker a cada mudança de status; relatórios agregam só o período pedido.
+
+STATUS_CONSUMO_INSUMOS = {"Pronto", "Entregue"}
+
+def parse_data_pedido(valor) -> Optional[datetime]:
+    """Converte datas gravadas como datetime ou string ISO; inválidas viram None"""
+    if isinstance(valor, datetime):
+        return valor if valor.tzinfo else valor.replace(tzinfo=timezone.utc)
+    if isinstance(valor, str) and valor:
+        try:
+            data = datetime.fromisoformat(valor.replace('Z', '+00:00'))
+            return data if data.tzinfo else data.replace(tzinfo=timezone.utc)
+        except ValueError:
+            return None
+    return None
+
+def data_conclusao_pedido(pedido: dict) -> datetime:
+    """Quando o pedido chegou a Pronto/Entregue (histórico), para o backfill do ledger"""
+    for entrada in reversed(pedido.get('historico_status') or []):
+        if entrada.get('status') in STATUS_CONSUMO_INSUMOS:
+            data = parse_data_pedido(entrada.get('data'))
+            if data:
+                return data
+    return (
+        parse_data_pedido(pedido.get('updated_at'))
+        or parse_data_pedido(pedido.get('created_at'))
+        or datetime.now(timezone.utc)
+    )
+
+def linhas_consumo_pedido(pedido: dict) -> list:
+    """Linhas do ledger para os itens do pedido"""
+    return [
+        {
+            'chave': f"{pedido['id']}:{indice}",
+            'pedido_id': pedido['id'],
+            'numero_pedido': pedido.get('numero_pedido'),
+            'loja_id': pedido.get('loja_id'),
+            'insumo_id': item.get('insumo_id', ''),
+            'tipo_insumo': item.get('tipo_insumo', ''),
+            'quantidade': item.get('quantidade', 0),
+            'unidade': item.get('unidade', ''),
+            'custo': item.get('subtotal', 0)
+        }
+        for indice, item in enumerate(pedido.get('itens') or [])
+    ]
+
+def upsert_consumo(linha: dict, data: datetime):
+    """Upsert de uma linha do ledger (a data fica a da primeira gravação)"""
+    from pymongo import UpdateOne
+    
+    return UpdateOne(
+        {'chave': linha['chave']},
+        {
+            '$set': linha,
+            '$setOnInsert': {'id': str(uuid.uuid4()), 'data': data, 'created_at': datetime.now(timezone.utc)}
+        },
+        upsert=True
+    )
+
+async def sincronizar_consumo_pedido(pedido: dict, data: datetime, session=None):
+    """Alinha o ledger ao status atual do pedido: grava os itens se Pronto/Entregue, senão estorna"""
+    linhas = linhas_consumo_pedido(pedido) if pedido.get('status') in STATUS_CONSUMO_INSUMOS else []
+    
+    await db.consumo_insumos.delete_many(
+        {"pedido_id": pedido['id'], "chave": {"$nin": [linha['chave'] for linha in linhas]}},
+        session=session
+    )
+    if linhas:
+        await db.consumo_insumos.bulk_write([upsert_consumo(linha, data) for linha in linhas], ordered=False, session=session)
+
+async def backfill_consumo_insumos(lote: int = 500) -> dict:
+    """Gera o ledger para os pedidos já Prontos/Entregues (idempotente: upsert por chave)"""
+    pedidos = 0
+    linhas = 0
+    operacoes = []
+    cursor = db.pedidos_manufatura.find(
+        {"status": {"$in": list(STATUS_CONSUMO_INSUMOS)}},
+        {"_id": 0, "id": 1, "numero_pedido": 1, "loja_id": 1, "itens": 1, "historico_status": 1, "updated_at": 1, "created_at": 1}
+    )
+    async for pedido in cursor:
+        pedidos += 1
+        data = data_conclusao_pedido(pedido)
+        operacoes.extend(upsert_consumo(linha, data) for linha in linhas_consumo_pedido(pedido))
+        if len(operacoes) >= lote:
+            await db.consumo_insumos.bulk_write(operacoes, ordered=False)
+            linhas += len(operacoes)
+            operacoes = []
+    if operacoes:
+        await db.consumo_insumos.bulk_write(operacoes, ordered=False)
+        linhas += len(operacoes)
+    
+    print(f"📦 Ledger de consumo: {linhas} linha(s) de {pedidos} pedido(s) Prontos/Entregues")
+    return {"pedidos": pedidos, "linhas": linhas}
+
+async def inicializar_consumo_insumos():
+    """Índices do ledger; na primeira subida (ledger vazio) gera o histórico em segundo plano"""
+    await db.consumo_insumos.create_index('chave', unique=True)
+    await db.consumo_insumos.create_index('pedido_id')
+    await db.consumo_insumos.create_index('data')
+    await db.consumo_insumos.create_index([('loja_id', 1), ('data', 1)])
+    
+    if not await db.consumo_insumos.find_one({}, {"_id": 1}):
+        asyncio.create_task(backfill_consumo_insumos())
+
 @api_router.get("/gestao/pedidos/consumo-insumos")
-async def get_consumo_insumos(loja: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    """Retorna consumo consolidado de insumos por tipo"""
+async def get_consumo_insumos(
+    loja: Optional[str] = None,
+    data_inicio: Optional[str] = None,
+    data_fim: Optional[str] = None,
+    mes: Optional[int] = Query(None, ge=1, le=12),
+    ano: Optional[int] = Query(None, ge=1, le=9998),
+    current_user: dict = Depends(get_current_user)
+):
+    """Retorna consumo consolidado de insumos por tipo (ledger consumo_insumos, por loja e período)"""
     query = {}
     if loja and loja != 'fabrica':
         query['loja_id'] = loja
     
-    pedidos = await db.pedidos_manufatura.find(query).to_list(None)
+    # Período: mês/ano ou intervalo de datas (data_fim inclusiva)
+    if mes:
+        ano = ano or datetime.now(timezone.utc).year
+        inicio_mes = datetime(ano, mes, 1, tzinfo=timezone.utc)
+        if mes == 12:
+            fim_mes = datetime(ano + 1, 1, 1, tzinfo=timezone.utc)
+        else:
+            fim_mes = datetime(ano, mes + 1, 1, tzinfo=timezone.utc)
+        query['data'] = {'$gte': inicio_mes, '$lt': fim_mes}
+    elif data_inicio or data_fim:
+        query['data'] = {}
+        try:
+            inicio = datetime.fromisoformat(data_inicio) if data_inicio else None
+            fim = datetime.fromisoformat(data_fim) if data_fim else None
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Datas inválidas: use o formato AAAA-MM-DD")
+        if inicio:
+            query['data']['$gte'] = inicio
+        if fim:
+            if len(data_fim) == 10:
+                query['data']['$lt'] = fim + timedelta(days=1)
+            else:
+                query['data']['$lte'] = fim
     
     consumo = {
         'Moldura': {'quantidade': 0, 'unidade': 'cm', 'custo': 0},
@@ -4480,52 +5797,103 @@ async def get_consumo_insumos(loja: Optional[str] = None, current_user: dict = D
         'Acessório': {'quantidade': 0, 'unidade': 'unidade', 'custo': 0}
     }
     
-    for pedido in pedidos:
-        if pedido.get('status') in ['Entregue', 'Pronto']:
-            for item in pedido.get('itens', []):
-                tipo = item.get('tipo_insumo', '')
-                if tipo in consumo:
-                    consumo[tipo]['quantidade'] += item.get('quantidade', 0)
-                    consumo[tipo]['custo'] += item.get('subtotal', 0)
+    grupos = await db.consumo_insumos.aggregate([
+        {"$match": query},
+        {"$group": {"_id": "$tipo_insumo", "quantidade": {"$sum": "$quantidade"}, "custo": {"$sum": "$custo"}}}
+    ]).to_list(None)
+    
+    for grupo in grupos:
+        if grupo['_id'] in consumo:
+            consumo[grupo['_id']]['quantidade'] = grupo['quantidade']
+            consumo[grupo['_id']]['custo'] = grupo['custo']
     
     return consumo
 
+@api_router.post("/gestao/pedidos/consumo-insumos/backfill")
+async def reprocessar_consumo_insumos(current_user: dict = Depends(get_current_user)):
+    """Regera o ledger de consumo a partir dos pedidos Prontos/Entregues existentes"""
+    return await backfill_consumo_insumos()
+
+# ========================================
+# EVOLUÇÃO DIÁRIA DE PEDIDOS
+# ========================================
+# created_at é gravado como data BSON (model_dump do PedidoManufatura); pedidos antigos
+# com created_at em texto ISO são convertidos na subida. A série é agrupada no MongoDB
+# por dia no fuso da operação e só os dias sem pedidos são completados em Python.
+
+FUSO_EVOLUCAO = 'America/Sao_Paulo'
+
+async def inicializar_evolucao_diaria():
+    """Índices do período de criação e conversão de created_at legado (texto) para data"""
+    await db.pedidos_manufatura.create_index([('loja_id', 1), ('created_at', 1)])
+    await db.pedidos_manufatura.create_index('created_at')
+    
+    try:
+        resultado = await db.pedidos_manufatura.update_many(
+            {"created_at": {"$type": "string"}},
+            [{"$set": {"created_at": {"$convert": {
+                "input": "$created_at", "to": "date", "onError": "$created_at", "onNull": None
+            }}}}]
+        )
+        if resultado.modified_count:
+            print(f"🗓️ created_at convertido para data em {resultado.modified_count} pedido(s)")
+    except Exception as e:
+        logger.warning(f"Não foi possível converter created_at dos pedidos: {e}")
+
 @api_router.get("/gestao/pedidos/evolucao-diaria")
 async def get_evolucao_diaria(dias: int = 30, loja: Optional[str] = None, current_user: dict = Depends(get_current_user)):
-    """Retorna evolução de pedidos criados por dia"""
-    from datetime import timedelta
+    """Retorna evolução de pedidos criados por dia (últimos `dias` dias, até hoje)"""
+    from datetime import time as dt_time
+    from zoneinfo import ZoneInfo
     
-    query = {}
+    fuso = ZoneInfo(FUSO_EVOLUCAO)
+    dias = max(dias, 1)
+    hoje = datetime.now(fuso).date()
+    primeiro_dia = hoje - timedelta(days=dias - 1)
+    inicio = datetime.combine(primeiro_dia, dt_time.min, tzinfo=fuso).astimezone(timezone.utc)
+    
+    query = {'created_at': {'$gte': inicio}}
     if loja and loja != 'fabrica':
         query['loja_id'] = loja
     
-    hoje = datetime.now(timezone.utc)
-    inicio = hoje - timedelta(days=dias)
-    
-    pedidos = await db.pedidos_manufatura.find(query).to_list(None)
+    grupos = await db.pedidos_manufatura.aggregate([
+        {"$match": query},
+        {"$group": {
+            "_id": {"$dateTrunc": {"date": "$created_at", "unit": "day", "timezone": FUSO_EVOLUCAO}},
+            "total": {"$sum": 1}
+        }}
+    ]).to_list(None)
     
-    # Agrupar por data
+    # Agrupar por data (dias sem pedidos ficam com zero)
     evolucao = {}
     for i in range(dias):
-        data = inicio + timedelta(days=i)
-        data_str = data.strftime('%Y-%m-%d')
+        data_str = (primeiro_dia + timedelta(days=i)).strftime('%Y-%m-%d')
         evolucao[data_str] = 0
     
-    for pedido in pedidos:
-        created = pedido.get('created_at')
-        if created:
-            if isinstance(created, str):
-                created = datetime.fromisoformat(created.replace('Z', '+00:00'))
-            if created >= inicio:
-                data_str = created.strftime('%Y-%m-%d')
-                if data_str in evolucao:
-                    evolucao[data_str] += 1
+    for grupo in grupos:
+        dia = grupo['_id']
+        if dia.tzinfo is None:
+            dia = dia.replace(tzinfo=timezone.utc)
+        data_str = dia.astimezone(fuso).strftime('%Y-%m-%d')
+        if data_str in evolucao:
+            evolucao[data_str] += grupo['total']
     
     return {
         'labels': list(evolucao.keys()),
         'valores': list(evolucao.values())
     }
 
+# Detalhe do pedido: registrado depois das rotas fixas /gestao/pedidos/<nome> para não capturá-las
+@api_router.get("/gestao/pedidos/{pedido_id}")
+async def get_pedido(pedido_id: str, current_user: dict = Depends(get_current_user)):
+    """Retorna um pedido específico"""
+    pedido = await db.pedidos_manufatura.find_one({"id": pedido_id})
+    if not pedido:
+        raise HTTPException(status_code=404, detail="Pedido não encontrado")
+    if '_id' in pedido:
+        del pedido['_id']
+    return pedido
+
 # ========================================
 # ENDPOINTS MARKETPLACES
 # ========================================
@@ -5785,10 +7153,11 @@ async def registrar_feedback_sku(
 from marketplace_integrator import (
     MercadoLivreIntegrator,
     ShopeeIntegrator,
-    save_or_update_order,
-    save_or_update_order_items,
-    save_or_update_payments,
-    save_or_update_shipments
+    TikTokShopIntegrator,
+    ingest_ml_orders,
+    ensure_marketplace_indexes,
+    build_connectors,
+    replay_failed_orders
 )
 
 @api_router.get("/integrator/mercadolivre/authorize")
@@ -5856,39 +7225,11 @@ async def ml_sync(
         print(f"🔄 Buscando pedidos Mercado Livre desde {date_from}")
         ml_orders = await integrator.fetch_orders_since(date_from)
         
-        orders_processed = 0
-        orders_updated = 0
-        orders_created = 0
-        
-        for ml_order in ml_orders:
-            try:
-                # Mapear para formato interno
-                internal_order = integrator.map_to_internal_order(ml_order)
-                
-                # Verificar se já existe
-                existing = await db.orders.find_one({
-                    'marketplace_order_id': internal_order['marketplace_order_id']
-                })
-                
-                # Salvar/atualizar pedido
-                internal_order_id = await save_or_update_order(internal_order)
-                
-                if existing:
-                    orders_updated += 1
-                else:
-                    orders_created += 1
-                
-                # Mapear e salvar itens
-                items = integrator.map_to_internal_items(ml_order, internal_order_id)
-                await save_or_update_order_items(items)
-                
-                # TODO: Mapear e salvar payments e shipments
-                
-                orders_processed += 1
-                
-            except Exception as e:
-                print(f"❌ Erro ao processar pedido {ml_order.get('id')}: {e}")
-                continue
+        # Mapear e salvar em lote (contagem de criados/atualizados vem do bulk_write)
+        result = await ingest_ml_orders(integrator, ml_orders)
+        orders_processed = result['processed']
+        orders_created = result['created']
+        orders_updated = result['updated']
         
         return {
             "success": True,
@@ -5898,7 +7239,66 @@ async def ml_sync(
             "orders_created": orders_created,
             "orders_updated": orders_updated
         }
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Erro na sincronização: {str(e)}")
+
+@api_router.get("/integrator/tiktok/authorize")
+async def tiktok_authorize(current_user: dict = Depends(get_current_user)):
+    """Inicia autorização do app no TikTok Shop"""
+    try:
+        auth_data = await TikTokShopIntegrator().authorize()
+        return {
+            "authorization_url": auth_data['url'],
+            "message": "Redirecione o usuário para authorization_url para autorizar"
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Erro ao gerar URL de autorização: {str(e)}")
+
+@api_router.get("/integrator/tiktok/callback")
+async def tiktok_callback(code: str, state: str = ""):
+    """Callback de autorização TikTok Shop - troca o auth_code pelo token"""
+    try:
+        integrator = TikTokShopIntegrator()
+        await integrator.get_access_token(code)
+        creds = await integrator.get_credentials()
+        
+        return {
+            "success": True,
+            "message": "✅ Autorização concluída com sucesso!",
+            "shop_id": creds.get('shop_id') if creds else None,
+            "shop_name": creds.get('shop_name') if creds else None
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Erro no callback: {str(e)}")
+
+@api_router.post("/integrator/tiktok/sync")
+async def tiktok_sync(
+    days_back: int = 7,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Sincroniza pedidos do TikTok Shop (ingestão em lote, página a página)
+    
+    Args:
+        days_back: Quantos dias para trás buscar (padrão: 7)
+    """
+    try:
+        integrator = TikTokShopIntegrator()
+        date_from = datetime.now(timezone.utc) - timedelta(days=days_back)
+        
+        print(f"🔄 Buscando pedidos TikTok Shop desde {date_from}")
+        result = await integrator.sync_since(date_from)
         
+        return {
+            "success": True,
+            "message": f"✅ Sincronização concluída",
+            "total_orders": result['fetched'],
+            "orders_processed": result['processed'],
+            "orders_created": result['created'],
+            "orders_updated": result['updated'],
+            "orders_failed": result['failed']
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro na sincronização: {str(e)}")
 
@@ -5950,18 +7350,30 @@ async def integrator_status(current_user: dict = Depends(get_current_user)):
             'shop_id': shopee_creds.get('shop_id') if shopee_creds else None
         }
         
+        # TikTok Shop
+        tiktok_creds = await db.marketplace_credentials.find_one({'marketplace': 'TIKTOK_SHOP'})
+        tiktok_status = {
+            'authenticated': bool(tiktok_creds and tiktok_creds.get('access_token')),
+            'shop_id': tiktok_creds.get('shop_id') if tiktok_creds else None,
+            'shop_name': tiktok_creds.get('shop_name') if tiktok_creds else None,
+            'token_expires_at': tiktok_creds.get('token_expires_at') if tiktok_creds else None
+        }
+        
         # Estatísticas
         total_orders = await db.orders.count_documents({})
         ml_orders = await db.orders.count_documents({'marketplace': 'MERCADO_LIVRE'})
         shopee_orders = await db.orders.count_documents({'marketplace': 'SHOPEE'})
+        tiktok_orders = await db.orders.count_documents({'marketplace': 'TIKTOK_SHOP'})
         
         return {
             "mercado_livre": ml_status,
             "shopee": shopee_status,
+            "tiktok_shop": tiktok_status,
             "statistics": {
                 "total_orders": total_orders,
                 "mercado_livre_orders": ml_orders,
-                "shopee_orders": shopee_orders
+                "shopee_orders": shopee_orders,
+                "tiktok_shop_orders": tiktok_orders
             }
         }
     except Exception as e:
@@ -6400,6 +7812,7 @@ async def get_dashboard_marketplaces(current_user: dict = Depends(get_current_us
 
 from marketplace_integrator import MercadoLivreIntegrator
 from fastapi.responses import RedirectResponse
+from pymongo.errors import BulkWriteError
 
 ml_integrator = MercadoLivreIntegrator()
 
@@ -6475,22 +7888,9 @@ async def ml_sync_orders(
         # Buscar pedidos
         orders = await ml_integrator.fetch_orders_since(date_from)
         
-        # Processar e salvar
-        from marketplace_integrator import save_or_update_order, save_or_update_order_items
-        
-        orders_saved = 0
-        for ml_order in orders:
-            # Mapear para formato interno
-            internal_order = ml_integrator.map_to_internal_order(ml_order)
-            
-            # Salvar pedido
-            internal_order_id = await save_or_update_order(internal_order)
-            
-            # Mapear e salvar itens
-            internal_items = ml_integrator.map_to_internal_items(ml_order, internal_order_id)
-            await save_or_update_order_items(internal_items)
-            
-            orders_saved += 1
+        # Processar e salvar em lote
+        result = await ingest_ml_orders(ml_integrator, orders)
+        orders_saved = result['processed']
         
         return {
             "success": True,
@@ -6501,26 +7901,116 @@ async def ml_sync_orders(
         logger.error(f"Erro ao sincronizar pedidos ML: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Tamanho da página do importador ML → sistema
+ML_IMPORT_BATCH_SIZE = 500
+
+def mapear_order_ml_para_pedido(ml_order: dict, ml_items: list, projeto_id: str) -> dict:
+    """Mapeia um pedido sincronizado do ML (collection orders) para pedidos_marketplace"""
+    ml_order_id_str = str(ml_order.get('marketplace_order_id', ''))
+    
+    # Converter datetime se necessário
+    created_at = ml_order.get('created_at_marketplace')
+    if isinstance(created_at, str):
+        try:
+            created_at = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
+        except:
+            created_at = datetime.now(timezone.utc)
+    elif not isinstance(created_at, datetime):
+        created_at = datetime.now(timezone.utc)
+    
+    # Mapear pedido ML para formato do sistema
+    pedido_sistema = {
+        'id': str(uuid.uuid4()),
+        'projeto_id': projeto_id,
+        'plataforma': 'mercadolivre',
+        
+        # Dados básicos
+        'numero_pedido': ml_order_id_str,
+        'numero_referencia_sku': '',
+        'sku': '',
+        'cliente_nome': str(ml_order.get('buyer_full_name', '') or ml_order.get('buyer_username', '')),
+        'cliente_contato': str(ml_order.get('buyer_phone', '')),
+        
+        # Endereço
+        'endereco': f"{ml_order.get('ship_to_street', '')} {ml_order.get('ship_to_number', '')} {ml_order.get('ship_to_complement', '')}",
+        'cidade': str(ml_order.get('ship_to_city', '')),
+        'estado_endereco': str(ml_order.get('ship_to_state', '')),
+        'uf': str(ml_order.get('ship_to_state', ''))[:2] if ml_order.get('ship_to_state') else '',
+        'endereco_entrega': f"{ml_order.get('ship_to_street', '')} {ml_order.get('ship_to_number', '')}, {ml_order.get('ship_to_district', '')} - {ml_order.get('ship_to_city', '')}/{ml_order.get('ship_to_state', '')} - CEP: {ml_order.get('ship_to_zipcode', '')}",
+        
+        # Valores
+        'quantidade': 1,  # Será somado dos itens
+        'valor_unitario': float(ml_order.get('subtotal_items', 0)),
+        'valor_total': float(ml_order.get('total_amount_buyer', 0)),
+        'preco_acordado': float(ml_order.get('subtotal_items', 0)),
+        
+        # Taxas e comissões
+        'tarifas_envio': float(ml_order.get('shipping_cost_charged', 0)),
+        'valor_liquido': float(ml_order.get('subtotal_items', 0)),  # Será calculado
+        
+        # Envio
+        'opcao_envio': str(ml_order.get('shipping_method', '')),
+        'tipo_envio': str(ml_order.get('shipping_status', '')),
+        
+        # Status
+        'status': 'Aguardando Produção',
+        'status_cor': '#94A3B8',
+        'status_producao': 'Espelho',  # Definido pelo SKU abaixo
+        'status_logistica': 'Aguardando',
+        'status_montagem': 'Aguardando Montagem',
+        'descricao_status': str(ml_order.get('status_general', '')),
+        
+        # Datas - garantir que são datetime e depois converter para ISO string
+        'data_pedido': created_at.isoformat(),
+        'data_venda': created_at.strftime('%d/%m/%Y'),
+        'prazo_entrega': (created_at + timedelta(days=7)).isoformat(),
+        
+        # Mercado Livre específico
+        'receita_produtos': float(ml_order.get('subtotal_items', 0)),
+        'numero_anuncio': '',  # Será preenchido dos itens
+        'preco_unitario_venda': float(ml_order.get('subtotal_items', 0)),
+        
+        # Controle
+        'responsavel': '',
+        'prioridade': 'Normal',
+        'observacoes': f"Importado do Mercado Livre - ID: {ml_order_id_str}",
+        'atrasado': False,
+        
+        # Metadata
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'updated_at': datetime.now(timezone.utc).isoformat(),
+        'ml_order_id': ml_order_id_str  # Referência
+    }
+    
+    if ml_items:
+        # Pegar dados do primeiro item (ou somar se houver múltiplos)
+        first_item = ml_items[0]
+        pedido_sistema['produto_nome'] = str(first_item.get('product_title', ''))
+        pedido_sistema['nome_variacao'] = str(first_item.get('variation_name', ''))
+        pedido_sistema['sku'] = str(first_item.get('seller_sku', ''))
+        pedido_sistema['numero_referencia_sku'] = str(first_item.get('seller_sku', ''))
+        pedido_sistema['numero_anuncio'] = str(first_item.get('marketplace_item_id', ''))  # ID do anúncio
+        
+        # Somar quantidades
+        total_qty = sum(int(item.get('quantity', 0)) for item in ml_items)
+        pedido_sistema['quantidade'] = total_qty
+    
+    # Setor detectado automaticamente pelo SKU (mesma regra das planilhas)
+    pedido_sistema['status_producao'] = detectar_setor_por_sku(pedido_sistema['sku'])
+    
+    return pedido_sistema
+
 @api_router.post("/integrator/mercadolivre/import-to-system")
 async def ml_import_to_system(
     projeto_id: str = None,
     current_user: dict = Depends(get_current_user)
 ):
-    """Importa pedidos sincronizados do ML para o sistema de gestão"""
+    """Importa pedidos sincronizados do ML para o sistema de gestão (em lotes)"""
     try:
-        # Buscar pedidos do ML que ainda não foram importados
-        ml_orders_cursor = db.orders.find({
+        base_query = {
             'marketplace': 'MERCADO_LIVRE',
             'imported_to_system': {'$ne': True}
-        })
-        ml_orders = await ml_orders_cursor.to_list(length=1000)
-        
-        if not ml_orders:
-            return {
-                "success": True,
-                "message": "Nenhum pedido novo para importar",
-                "imported_count": 0
-            }
+        }
         
         # Se não tem projeto_id, criar/buscar projeto Mercado Livre
         if not projeto_id:
@@ -6539,129 +8029,83 @@ async def ml_import_to_system(
                 await db.projetos.insert_one(projeto)
             projeto_id = projeto['id']
         
-        # Mapear e importar cada pedido
         imported_count = 0
-        for ml_order in ml_orders:
-            try:
-                # Guardar o _id para atualização posterior e converter para string
-                ml_order_id_obj = ml_order.get('_id')
-                ml_order_id_str = str(ml_order.get('marketplace_order_id', ''))
-                
-                # Converter datetime se necessário
-                created_at = ml_order.get('created_at_marketplace')
-                if isinstance(created_at, str):
-                    try:
-                        created_at = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                    except:
-                        created_at = datetime.now(timezone.utc)
-                elif not isinstance(created_at, datetime):
-                    created_at = datetime.now(timezone.utc)
-                
-                # Mapear pedido ML para formato do sistema
-                pedido_sistema = {
-                    'id': str(uuid.uuid4()),
-                    'projeto_id': projeto_id,
-                    'plataforma': 'mercadolivre',
-                    
-                    # Dados básicos
-                    'numero_pedido': ml_order_id_str,
-                    'numero_referencia_sku': '',
-                    'sku': '',
-                    'cliente_nome': str(ml_order.get('buyer_full_name', '') or ml_order.get('buyer_username', '')),
-                    'cliente_contato': str(ml_order.get('buyer_phone', '')),
-                    
-                    # Endereço
-                    'endereco': f"{ml_order.get('ship_to_street', '')} {ml_order.get('ship_to_number', '')} {ml_order.get('ship_to_complement', '')}",
-                    'cidade': str(ml_order.get('ship_to_city', '')),
-                    'estado_endereco': str(ml_order.get('ship_to_state', '')),
-                    'uf': str(ml_order.get('ship_to_state', ''))[:2] if ml_order.get('ship_to_state') else '',
-                    'endereco_entrega': f"{ml_order.get('ship_to_street', '')} {ml_order.get('ship_to_number', '')}, {ml_order.get('ship_to_district', '')} - {ml_order.get('ship_to_city', '')}/{ml_order.get('ship_to_state', '')} - CEP: {ml_order.get('ship_to_zipcode', '')}",
-                    
-                    # Valores
-                    'quantidade': 1,  # Será somado dos itens
-                    'valor_unitario': float(ml_order.get('subtotal_items', 0)),
-                    'valor_total': float(ml_order.get('total_amount_buyer', 0)),
-                    'preco_acordado': float(ml_order.get('subtotal_items', 0)),
-                    
-                    # Taxas e comissões
-                    'tarifas_envio': float(ml_order.get('shipping_cost_charged', 0)),
-                    'valor_liquido': float(ml_order.get('subtotal_items', 0)),  # Será calculado
-                    
-                    # Envio
-                    'opcao_envio': str(ml_order.get('shipping_method', '')),
-                    'tipo_envio': str(ml_order.get('shipping_status', '')),
-                    
-                    # Status
-                    'status': 'Aguardando Produção',
-                    'status_cor': '#94A3B8',
-                    'status_producao': 'Impressão',  # Setor padrão
-                    'status_logistica': 'Aguardando',
-                    'status_montagem': 'Aguardando Montagem',
-                    'descricao_status': str(ml_order.get('status_general', '')),
-                    
-                    # Datas - garantir que são datetime e depois converter para ISO string
-                    'data_pedido': created_at.isoformat(),
-                    'data_venda': created_at.strftime('%d/%m/%Y'),
-                    'prazo_entrega': (created_at + timedelta(days=7)).isoformat(),
-                    
-                    # Mercado Livre específico
-                    'receita_produtos': float(ml_order.get('subtotal_items', 0)),
-                    'numero_anuncio': '',  # Será preenchido dos itens
-                    'preco_unitario_venda': float(ml_order.get('subtotal_items', 0)),
-                    
-                    # Controle
-                    'responsavel': '',
-                    'prioridade': 'Normal',
-                    'observacoes': f"Importado do Mercado Livre - ID: {ml_order_id_str}",
-                    'atrasado': False,
-                    
-                    # Metadata
-                    'created_at': datetime.now(timezone.utc).isoformat(),
-                    'updated_at': datetime.now(timezone.utc).isoformat(),
-                    'ml_order_id': ml_order_id_str  # Referência
-                }
-                
-                # Buscar itens do pedido
-                ml_items = await db.order_items.find({
-                    'marketplace_order_id': ml_order_id_str
-                }).to_list(length=100)
-                
-                if ml_items:
-                    # Pegar dados do primeiro item (ou somar se houver múltiplos)
-                    first_item = ml_items[0]
-                    pedido_sistema['produto_nome'] = str(first_item.get('product_title', ''))
-                    pedido_sistema['nome_variacao'] = str(first_item.get('variation_name', ''))
-                    pedido_sistema['sku'] = str(first_item.get('seller_sku', ''))
-                    pedido_sistema['numero_referencia_sku'] = str(first_item.get('seller_sku', ''))
-                    pedido_sistema['numero_anuncio'] = str(first_item.get('marketplace_item_id', ''))  # ID do anúncio
-                    
-                    # Somar quantidades
-                    total_qty = sum(int(item.get('quantity', 0)) for item in ml_items)
-                    pedido_sistema['quantidade'] = total_qty
-                
-                # Inserir no sistema
-                await db.pedidos_marketplace.insert_one(pedido_sistema)
-                
-                # Marcar como importado (usar o ObjectId original)
-                if ml_order_id_obj:
-                    await db.orders.update_one(
-                        {'_id': ml_order_id_obj},
-                        {'$set': {'imported_to_system': True, 'imported_at': datetime.now(timezone.utc).isoformat()}}
-                    )
-                
-                imported_count += 1
-                print(f"✅ Pedido {ml_order_id_str} importado com sucesso")
-                
-            except Exception as item_error:
-                logger.error(f"Erro ao importar pedido {ml_order.get('marketplace_order_id', 'UNKNOWN')}: {item_error}")
-                import traceback
-                traceback.print_exc()
+        setores_corrigidos = 0
+        last_id = None
+        
+        # Paginação por _id: cada página é processada com um número fixo de queries
+        while True:
+            page_query = dict(base_query)
+            if last_id is not None:
+                page_query['_id'] = {'$gt': last_id}
+            
+            ml_orders = await db.orders.find(page_query).sort('_id', 1).limit(ML_IMPORT_BATCH_SIZE).to_list(None)
+            if not ml_orders:
+                break
+            last_id = ml_orders[-1]['_id']
+            
+            # Itens de todos os pedidos da página em uma única query
+            order_ids = [str(o.get('marketplace_order_id', '')) for o in ml_orders]
+            itens_por_pedido = {}
+            async for item in db.order_items.find({'marketplace': 'MERCADO_LIVRE', 'marketplace_order_id': {'$in': order_ids}}):
+                itens_por_pedido.setdefault(item.get('marketplace_order_id'), []).append(item)
+            
+            pedidos = []
+            source_ids = []
+            for ml_order in ml_orders:
+                try:
+                    ml_order_id_str = str(ml_order.get('marketplace_order_id', ''))
+                    pedidos.append(mapear_order_ml_para_pedido(ml_order, itens_por_pedido.get(ml_order_id_str, []), projeto_id))
+                    source_ids.append(ml_order['_id'])
+                except Exception as item_error:
+                    logger.error(f"Erro ao importar pedido {ml_order.get('marketplace_order_id', 'UNKNOWN')}: {item_error}")
+                    continue
+            
+            if not pedidos:
                 continue
+            
+            # 🎓 APRENDIZADO AUTOMÁTICO: feedback mais recente de cada SKU sobrescreve o setor
+            skus = list({p['sku'] for p in pedidos if p['sku']})
+            if skus:
+                setor_por_sku = {}
+                async for feedback in db.sku_feedback.find({'sku': {'$in': skus}}).sort('created_at', 1):
+                    setor_por_sku[feedback['sku']] = feedback['setor_correto']
+                for pedido in pedidos:
+                    setor_aprendido = setor_por_sku.get(pedido['sku'])
+                    if setor_aprendido and setor_aprendido != pedido['status_producao']:
+                        pedido['status_producao'] = setor_aprendido
+                        setores_corrigidos += 1
+            
+            # Inserir a página inteira e marcar os pedidos de origem como importados
+            try:
+                await db.pedidos_marketplace.insert_many(pedidos, ordered=False)
+            except BulkWriteError as bwe:
+                # Só marca como importados os pedidos efetivamente inseridos
+                falhas = {err['index'] for err in bwe.details.get('writeErrors', [])}
+                logger.error(f"Erro ao importar {len(falhas)} pedidos ML: {bwe.details.get('writeErrors', [])[:3]}")
+                pedidos = [p for i, p in enumerate(pedidos) if i not in falhas]
+                source_ids = [sid for i, sid in enumerate(source_ids) if i not in falhas]
+            
+            await db.orders.update_many(
+                {'_id': {'$in': source_ids}},
+                {'$set': {'imported_to_system': True, 'imported_at': datetime.now(timezone.utc).isoformat()}}
+            )
+            
+            imported_count += len(pedidos)
+            print(f"✅ {len(pedidos)} pedidos importados (total: {imported_count})")
+        
+        if imported_count == 0:
+            return {
+                "success": True,
+                "message": "Nenhum pedido novo para importar",
+                "imported_count": 0
+            }
         
         return {
             "success": True,
             "message": f"{imported_count} pedidos importados com sucesso!",
             "imported_count": imported_count,
+            "setores_corrigidos_ia": setores_corrigidos,
             "projeto_id": projeto_id
         }
         
@@ -6689,20 +8133,69 @@ async def ml_webhook(request: Request):
             order_detail = await ml_integrator.fetch_order_detail(order_id)
             
             if order_detail:
-                # Mapear e salvar
-                internal_order = ml_integrator.map_to_internal_order(order_detail)
-                internal_order_id = await save_or_update_order(internal_order)
-                
-                internal_items = ml_integrator.map_to_internal_items(order_detail, internal_order_id)
-                await save_or_update_order_items(internal_items)
+                # Mapear e salvar (falhas vão para a fila de reprocessamento com o payload)
+                result = await ingest_ml_orders(ml_integrator, [order_detail])
                 
-                logger.info(f"✅ Pedido {order_id} atualizado via webhook")
+                if result['failed']:
+                    logger.warning(f"⚠️ Pedido {order_id} enviado para reprocessamento")
+                else:
+                    logger.info(f"✅ Pedido {order_id} atualizado via webhook")
         
         return {"success": True}
     except Exception as e:
         logger.error(f"Erro ao processar webhook ML: {e}")
         return {"success": False, "error": str(e)}
 
+@api_router.get("/integrator/retries")
+async def list_order_retries(
+    status: str = "pending",
+    marketplace: str = None,
+    limit: int = 50,
+    current_user: dict = Depends(get_current_user)
+):
+    """Lista pedidos na fila de reprocessamento (sem o payload) e a contagem por status"""
+    query = {'status': status}
+    if marketplace:
+        query['marketplace'] = marketplace.upper()
+    
+    retries = await db.marketplace_order_retries.find(
+        query, {'_id': 0, 'payload': 0}
+    ).sort("last_failed_at", -1).limit(limit).to_list(None)
+    
+    contagem = await db.marketplace_order_retries.aggregate([
+        {"$group": {"_id": "$status", "total": {"$sum": 1}}}
+    ]).to_list(None)
+    
+    return {
+        "success": True,
+        "por_status": {c['_id']: c['total'] for c in contagem},
+        "retries": retries
+    }
+
+@api_router.post("/integrator/retries/reprocess")
+async def reprocess_order_retries(
+    filtros: Optional[dict] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Reprocessa pedidos da fila imediatamente a partir do payload salvo (sem rebuscar a janela)
+    
+    Body (opcional): {"ids": [...], "marketplace": "MERCADO_LIVRE", "include_dead": true, "limit": 500}
+    """
+    try:
+        filtros = filtros or {}
+        stats = await replay_failed_orders(
+            build_connectors(),
+            limit=int(filtros.get('limit', 500)),
+            force=True,
+            ids=filtros.get('ids') or None,
+            marketplace=(filtros.get('marketplace') or '').upper() or None,
+            include_dead=bool(filtros.get('include_dead', False))
+        )
+        return {"success": True, **stats}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Erro ao reprocessar pedidos: {str(e)}")
+
 
 
 # ============= ENDPOINTS PRODUÇÃO LOJAS FÍSICAS =============
@@ -6722,20 +8215,8 @@ async def create_pedido_loja(pedido_data: dict, credentials: HTTPAuthorizationCr
             "Fábrica": "FAB"
         }.get(loja, "LJ")
         
-        # Buscar último número
-        last_pedido = await db.pedidos_lojas.find_one(
-            {"loja": loja},
-            sort=[("created_at", -1)]
-        )
-        
-        if last_pedido and last_pedido.get('numero_pedido'):
-            try:
-                last_num = int(last_pedido['numero_pedido'].split('-')[-1])
-                new_num = last_num + 1
-            except:
-                new_num = 1
-        else:
-            new_num = 1
+        # Próximo número da sequência da loja (contador atômico por prefixo)
+        new_num = await proximo_numero(f"pedidos_lojas:{loja_prefix}")
         
         # Create pedido document
         pedido_dict = {
@@ -6793,9 +8274,10 @@ async def create_pedido_loja(pedido_data: dict, credentials: HTTPAuthorizationCr
 async def get_pedidos_loja(
     loja: Optional[str] = None,
     status: Optional[str] = None,
+    view: str = "summary",
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
-    """Listar pedidos de lojas físicas com filtros"""
+    """Listar pedidos de lojas físicas com filtros (resumo; fotos no detalhe ou com view=full)"""
     try:
         user = decode_token(credentials.credentials)
         
@@ -6805,13 +8287,31 @@ async def get_pedidos_loja(
         if status:
             query['status'] = status
         
-        pedidos = await db.pedidos_lojas.find(query, {"_id": 0}).sort('created_at', -1).to_list(length=1000)
+        projecao = projecao_listagem('pedidos_lojas', view)
+        pedidos = await db.pedidos_lojas.find(query, projecao).sort('created_at', -1).to_list(length=1000)
         
         return {"success": True, "pedidos": pedidos}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@api_router.get("/gestao/lojas/pedidos/{pedido_id}")
+async def get_pedido_loja(
+    pedido_id: str,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Buscar pedido de loja completo"""
+    user = decode_token(credentials.credentials)
+    
+    pedido = await db.pedidos_lojas.find_one({'id': pedido_id}, {"_id": 0})
+    if not pedido:
+        raise HTTPException(status_code=404, detail="Pedido não encontrado")
+    
+    return {"success": True, "pedido": pedido}
+
+
 @api_router.put("/gestao/lojas/pedidos/{pedido_id}")
 async def update_pedido_loja(
     pedido_id: str,
@@ -7541,6 +9041,31 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    await ensure_marketplace_indexes()
+    await inicializar_contadores()
+    await ensure_outbox_indexes()
+    await ensure_producao_indexes()
+    await ensure_fila_aprovacao_indexes()
+    await inicializar_eventos_producao()
+    await inicializar_consumo_insumos()
+    await inicializar_evolucao_diaria()
+    await inicializar_arquivos()
+
+@app.on_event("startup")
+async def iniciar_catalogo_precos():
+    await catalogo_precos.recarregar()
+    catalogo_precos.iniciar_polling()
+
+@app.on_event("startup")
+async def iniciar_outbox_worker():
+    outbox_worker.iniciar_polling()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await catalogo_precos.parar_polling()
+    await outbox_worker.parar_polling()
+    from marketplace_integrator import close_http_clients
+    await close_http_clients()
     client.close()
\ No newline at end of file
@@ -2,12 +2,21 @@
 """
 Cron Job para Sincronização Automática de Marketplaces
 Executar a cada 30 minutos via supervisor
+
+Modo daemon (processo contínuo, um agendamento por marketplace):
+    python sync_marketplaces_cron.py --daemon
 """
+import argparse
 import asyncio
+import random
+import signal
 import sys
 import os
+import time
+import uuid
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional
 
 # Adicionar diretório backend ao path
 sys.path.insert(0, str(Path(__file__).parent))
@@ -15,60 +24,123 @@ sys.path.insert(0, str(Path(__file__).parent))
 from marketplace_integrator import (
     MercadoLivreIntegrator,
     ShopeeIntegrator,
-    save_or_update_order,
-    save_or_update_order_items,
-    save_or_update_payments,
-    save_or_update_shipments,
+    TikTokShopIntegrator,
+    MarketplaceConnector,
+    build_connectors,
+    replay_failed_orders,
+    ensure_marketplace_indexes,
+    close_http_clients,
     db
 )
 
-async def sync_mercado_livre():
-    """Sincroniza pedidos do Mercado Livre"""
-    try:
-        print("=" * 60)
-        print(f"🛍️  MERCADO LIVRE SYNC - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print("=" * 60)
+# Janela de sobreposição aplicada ao watermark (atrasos de indexação da busca do ML)
+SYNC_OVERLAP = timedelta(minutes=int(os.environ.get('ML_SYNC_OVERLAP_MINUTES', '10')))
+# Janela usada na primeira sincronização de um vendedor (sem watermark salvo)
+INITIAL_SYNC_WINDOW = timedelta(days=2)
+
+# Agendamento do modo daemon
+SYNC_ML_INTERVAL_SECONDS = float(os.environ.get('SYNC_ML_INTERVAL_SECONDS', '300'))
+SYNC_SHOPEE_INTERVAL_SECONDS = float(os.environ.get('SYNC_SHOPEE_INTERVAL_SECONDS', '600'))
+SYNC_TIKTOK_INTERVAL_SECONDS = float(os.environ.get('SYNC_TIKTOK_INTERVAL_SECONDS', '600'))
+SYNC_RETRY_INTERVAL_SECONDS = float(os.environ.get('SYNC_RETRY_INTERVAL_SECONDS', '120'))
+RETRY_BATCH_SIZE = int(os.environ.get('ORDER_RETRY_BATCH_SIZE', '200'))
+SYNC_JITTER_SECONDS = float(os.environ.get('SYNC_JITTER_SECONDS', '30'))
+SYNC_MAX_IN_FLIGHT = int(os.environ.get('SYNC_MAX_IN_FLIGHT', '2'))
+SYNC_MAX_BACKOFF_SECONDS = float(os.environ.get('SYNC_MAX_BACKOFF_SECONDS', '1800'))
+SYNC_SHUTDOWN_TIMEOUT_SECONDS = float(os.environ.get('SYNC_SHUTDOWN_TIMEOUT_SECONDS', '60'))
+
+class ConnectorSync:
+    """
+    Sincronização incremental genérica de um MarketplaceConnector: janela a partir do
+    watermark da conta e ingestão em streaming (página a página) no bulk upsert.
+    """
+    
+    def __init__(self, connector: MarketplaceConnector):
+        self.connector = connector
+        self.marketplace = connector.marketplace
+        self.account_id: Optional[str] = None
+    
+    async def _resolve_account_id(self) -> Optional[str]:
+        """Lê as credenciais uma única vez (até a primeira autenticação encontrada)"""
+        if self.account_id is None:
+            creds = await self.connector.get_credentials()
+            if creds and creds.get('access_token'):
+                self.account_id = self.connector.account_id(creds)
+        return self.account_id
+    
+    async def run(self) -> Dict:
+        """Executa uma rodada de sincronização; erros gerais são propagados"""
+        account_id = await self._resolve_account_id()
+        if account_id is None:
+            print(f"⚠️  {self.marketplace} não autenticado - pulando sincronização")
+            return {'orders_fetched': 0, 'skipped': True}
         
-        integrator = MercadoLivreIntegrator()
+        watermark = await self.connector.get_watermark(account_id)
         
-        # Verificar se está autenticado
-        creds = await integrator.get_credentials()
-        if not creds or not creds.get('access_token'):
-            print("⚠️  Mercado Livre não autenticado - pulando sincronização")
-            return
+        if watermark:
+            date_from = watermark - SYNC_OVERLAP
+        else:
+            date_from = datetime.now(timezone.utc) - INITIAL_SYNC_WINDOW
         
-        # Buscar pedidos dos últimos 2 dias (para garantir updates)
-        date_from = datetime.now(timezone.utc) - timedelta(days=2)
+        print(f"🔖 Buscando pedidos {self.marketplace} alterados desde {date_from.isoformat()}")
+        result = await self.connector.sync_since(date_from, skip_unchanged=True)
+        fetch_stats = self.connector.last_fetch_stats
         
-        ml_orders = await integrator.fetch_orders_since(date_from)
+        # Pedidos sem alteração já estão persistidos e também contam para o watermark
+        candidates = [w for w in (watermark, result['max_last_updated'], fetch_stats.get('unchanged_max_updated')) if w]
+        new_watermark = max(candidates) if candidates else None
         
-        orders_created = 0
-        orders_updated = 0
+        # Watermark só avança quando toda a janela foi buscada e persistida (ou enfileirada)
+        unrecovered = result['failed'] - result['queued']
+        if unrecovered:
+            print(f"⚠️  {unrecovered} pedidos com erro - watermark mantido para nova tentativa")
+        elif new_watermark:
+            await self.connector.advance_watermark(account_id, new_watermark, result['fetched'])
         
-        for ml_order in ml_orders:
-            try:
-                internal_order = integrator.map_to_internal_order(ml_order)
-                
-                existing = await db.orders.find_one({
-                    'marketplace_order_id': internal_order['marketplace_order_id']
-                })
-                
-                internal_order_id = await save_or_update_order(internal_order)
-                
-                if existing:
-                    orders_updated += 1
-                else:
-                    orders_created += 1
-                
-                items = integrator.map_to_internal_items(ml_order, internal_order_id)
-                await save_or_update_order_items(items)
-                
-            except Exception as e:
-                print(f"❌ Erro ao processar pedido: {e}")
-                continue
-        
-        print(f"✅ Mercado Livre: {orders_created} novos, {orders_updated} atualizados")
+        return {
+            'orders_fetched': result['fetched'],
+            'orders_created': result['created'],
+            'orders_updated': result['updated'],
+            'orders_failed': result['failed']
+        }
+
+class MercadoLivreSync(ConnectorSync):
+    """Sincronização incremental do Mercado Livre (relatório inclui o cache de envios)"""
+    
+    def __init__(self, integrator: Optional[MercadoLivreIntegrator] = None):
+        super().__init__(integrator or MercadoLivreIntegrator())
+    
+    async def run(self) -> Dict:
+        stats = await super().run()
+        if not stats.get('skipped'):
+            stats['shipment_cache'] = self.connector.last_fetch_stats.get('shipment_cache')
+        return stats
+
+class RetryWorker:
+    """Reprocessa a fila marketplace_order_retries a partir dos payloads salvos"""
+    
+    marketplace = 'RETRY_QUEUE'
+    
+    def __init__(self, connectors: Optional[Dict[str, MarketplaceConnector]] = None):
+        self.connectors = connectors or build_connectors()
+    
+    async def run(self) -> Dict:
+        stats = await replay_failed_orders(self.connectors, limit=RETRY_BATCH_SIZE)
+        return {
+            'orders_fetched': stats['replayed'],
+            'orders_updated': stats['resolved'],
+            'orders_failed': stats['failed'] + stats['dead']
+        }
+
+async def sync_mercado_livre():
+    """Sincroniza pedidos do Mercado Livre"""
+    try:
+        print("=" * 60)
+        print(f"🛍️  MERCADO LIVRE SYNC - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        print("=" * 60)
         
+        await MercadoLivreSync().run()
+    
     except Exception as e:
         print(f"❌ Erro na sincronização Mercado Livre: {e}")
 
@@ -79,12 +151,180 @@ async def sync_shopee():
         print(f"🛒 SHOPEE SYNC - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         print("=" * 60)
         
-        # TODO: Implementar quando Shopee estiver completo
-        print("⚠️  Shopee sync ainda não implementado")
-        
+        await ConnectorSync(ShopeeIntegrator()).run()
+    
     except Exception as e:
         print(f"❌ Erro na sincronização Shopee: {e}")
 
+async def sync_tiktok():
+    """Sincroniza pedidos do TikTok Shop"""
+    try:
+        print("=" * 60)
+        print(f"🎵 TIKTOK SHOP SYNC - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        print("=" * 60)
+        
+        await ConnectorSync(TikTokShopIntegrator()).run()
+    
+    except Exception as e:
+        print(f"❌ Erro na sincronização TikTok Shop: {e}")
+
+# ============= MODO DAEMON =============
+
+class ConnectorSchedule:
+    """Agendamento de um conector: intervalo, jitter e backoff após falhas"""
+    
+    def __init__(self, marketplace: str, run: Callable[[], Awaitable[Dict]], interval: float, jitter: float = SYNC_JITTER_SECONDS):
+        self.marketplace = marketplace
+        self.run = run
+        self.interval = interval
+        self.jitter = jitter
+        self.consecutive_failures = 0
+    
+    def next_delay(self) -> float:
+        """Próxima espera: intervalo normal ou backoff exponencial após falhas"""
+        if self.consecutive_failures:
+            base = min(SYNC_MAX_BACKOFF_SECONDS, self.interval * (2 ** (self.consecutive_failures - 1)))
+            # Backoff nunca é menor que o intervalo configurado
+            return max(self.interval, base) + random.uniform(0, self.jitter)
+        return self.interval + random.uniform(0, self.jitter)
+
+class SyncDaemon:
+    """
+    Scheduler asyncio de longa duração: cada conector roda em seu próprio loop,
+    com no máximo `max_in_flight` sincronizações simultâneas.
+    Cada execução é registrada na collection sync_runs.
+    """
+    
+    def __init__(self, schedules, max_in_flight: int = SYNC_MAX_IN_FLIGHT):
+        self.schedules = list(schedules)
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._stop = asyncio.Event()
+    
+    def stop(self):
+        """Solicita encerramento gracioso (execuções em andamento terminam)"""
+        if not self._stop.is_set():
+            print("🛑 Encerramento solicitado - aguardando sincronizações em andamento")
+            self._stop.set()
+    
+    async def _sleep(self, seconds: float) -> bool:
+        """Dorme até `seconds` ou até o stop; retorna True se deve encerrar"""
+        try:
+            await asyncio.wait_for(self._stop.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+        return self._stop.is_set()
+    
+    async def _execute(self, schedule: ConnectorSchedule):
+        """Executa uma rodada do conector e registra métricas em sync_runs"""
+        started_at = datetime.now(timezone.utc)
+        started = time.monotonic()
+        stats: Dict = {}
+        error = None
+        
+        try:
+            stats = await schedule.run() or {}
+            schedule.consecutive_failures = 0
+        except Exception as e:
+            error = str(e)
+            schedule.consecutive_failures += 1
+            print(f"❌ Erro na sincronização {schedule.marketplace}: {e}")
+        
+        duration_ms = int((time.monotonic() - started) * 1000)
+        
+        if error:
+            status = 'error'
+        elif stats.get('skipped'):
+            status = 'skipped'
+        elif stats.get('orders_failed'):
+            status = 'partial'
+        else:
+            status = 'success'
+        
+        run = {
+            'id': str(uuid.uuid4()),
+            'marketplace': schedule.marketplace,
+            'status': status,
+            'started_at': started_at,
+            'finished_at': datetime.now(timezone.utc),
+            'duration_ms': duration_ms,
+            'orders_fetched': stats.get('orders_fetched', 0),
+            'orders_created': stats.get('orders_created', 0),
+            'orders_updated': stats.get('orders_updated', 0),
+            'orders_failed': stats.get('orders_failed', 0),
+            'error': error,
+            'consecutive_failures': schedule.consecutive_failures
+        }
+        if stats.get('shipment_cache'):
+            run['shipment_cache'] = stats['shipment_cache']
+        
+        try:
+            await db.sync_runs.insert_one(run)
+        except Exception as e:
+            print(f"⚠️  Não foi possível registrar execução em sync_runs: {e}")
+        
+        print(f"📊 {schedule.marketplace}: {status} em {duration_ms} ms ({run['orders_fetched']} pedidos)")
+    
+    async def _loop(self, schedule: ConnectorSchedule):
+        """Loop de um conector; o primeiro disparo é espalhado pelo jitter"""
+        delay = random.uniform(0, schedule.jitter)
+        while not await self._sleep(delay):
+            async with self._in_flight:
+                if self._stop.is_set():
+                    break
+                await self._execute(schedule)
+            delay = schedule.next_delay()
+            if schedule.consecutive_failures:
+                print(f"⏳ {schedule.marketplace}: {schedule.consecutive_failures} falha(s) seguidas, próxima tentativa em {delay:.0f}s")
+    
+    async def run(self):
+        """Roda até receber SIGINT/SIGTERM"""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except NotImplementedError:
+                pass  # Windows
+        
+        tasks = [asyncio.create_task(self._loop(schedule)) for schedule in self.schedules]
+        
+        await self._stop.wait()
+        
+        done, pending = await asyncio.wait(tasks, timeout=SYNC_SHUTDOWN_TIMEOUT_SECONDS)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+def build_schedules():
+    """Conectores do daemon (instanciados uma única vez por processo)"""
+    connectors = build_connectors()
+    ml_sync = MercadoLivreSync(connectors['MERCADO_LIVRE'])
+    shopee_sync = ConnectorSync(connectors['SHOPEE'])
+    tiktok_sync = ConnectorSync(connectors['TIKTOK_SHOP'])
+    retry_worker = RetryWorker(connectors)
+    return [
+        ConnectorSchedule('MERCADO_LIVRE', ml_sync.run, SYNC_ML_INTERVAL_SECONDS),
+        ConnectorSchedule('SHOPEE', shopee_sync.run, SYNC_SHOPEE_INTERVAL_SECONDS),
+        ConnectorSchedule('TIKTOK_SHOP', tiktok_sync.run, SYNC_TIKTOK_INTERVAL_SECONDS),
+        ConnectorSchedule('RETRY_QUEUE', retry_worker.run, SYNC_RETRY_INTERVAL_SECONDS),
+    ]
+
+async def run_daemon():
+    """Processo contínuo de sincronização"""
+    print("\n" + "=" * 60)
+    print("🔄 DAEMON DE SINCRONIZAÇÃO DE MARKETPLACES")
+    print("=" * 60)
+    
+    try:
+        await ensure_marketplace_indexes()
+        await db.sync_runs.create_index([('marketplace', 1), ('started_at', -1)])
+        
+        daemon = SyncDaemon(build_schedules())
+        await daemon.run()
+        
+        print("✅ Daemon encerrado")
+    finally:
+        await close_http_clients()
+
 async def main():
     """Função principal do cron"""
     print("\n" + "=" * 60)
@@ -92,19 +332,33 @@ async def main():
     print("=" * 60)
     
     try:
+        await ensure_marketplace_indexes()
+        
         # Sincronizar Mercado Livre
         await sync_mercado_livre()
         
         # Sincronizar Shopee
         await sync_shopee()
         
+        # Sincronizar TikTok Shop
+        await sync_tiktok()
+        
+        # Reprocessar pedidos com falha vencidos
+        await replay_failed_orders(build_connectors(), limit=RETRY_BATCH_SIZE)
+        
         print("\n" + "=" * 60)
         print("✅ SINCRONIZAÇÃO CONCLUÍDA")
         print("=" * 60 + "\n")
-        
+    
     except Exception as e:
         print(f"\n❌ Erro geral na sincronização: {e}\n")
         sys.exit(1)
+    finally:
+        await close_http_clients()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Sincronização de pedidos dos marketplaces")
+    parser.add_argument('--daemon', action='store_true', help="Roda continuamente com agendamento por marketplace")
+    args = parser.parse_args()
+    
+    asyncio.run(run_daemon() if args.daemon else main())
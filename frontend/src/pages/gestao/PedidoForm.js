@@ -1462,7 +1462,7 @@ export default function PedidoForm({ pedido, lojaAtual, onClose, onSave }) {
             {formData.imagem_anexada && (
               <div className="image-preview-box">
                 <div className="preview-title">Imagem Anexada:</div>
-                <img src={formData.imagem_anexada} alt="Objeto do cliente" className="preview-image" />
+                <img src={formData.imagem_anexada.startsWith('/api/') ? `${BACKEND_URL}${formData.imagem_anexada}` : formData.imagem_anexada} alt="Objeto do cliente" className="preview-image" />
               </div>
             )}
 
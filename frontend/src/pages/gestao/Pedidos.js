@@ -97,15 +97,34 @@ export default function Pedidos() {
     setShowForm(true);
   };
 
-  const handleEditPedido = (pedido) => {
-    setSelectedPedido(pedido);
-    setShowForm(true);
+  // A listagem traz só o resumo; edição e orçamento usam o pedido completo
+  const fetchPedidoCompleto = async (id) => {
+    const token = localStorage.getItem('token');
+    const response = await axios.get(`${API}/pedidos/${id}`, {
+      headers: { Authorization: `Bearer ${token}` }
+    });
+    return response.data;
+  };
+
+  const handleEditPedido = async (pedido) => {
+    try {
+      setSelectedPedido(await fetchPedidoCompleto(pedido.id));
+      setShowForm(true);
+    } catch (error) {
+      console.error('Erro ao carregar pedido:', error);
+      toast.error('Erro ao carregar pedido');
+    }
   };
   
   // NOVA: Visualizar orçamento
-  const handleViewOrcamento = (pedido) => {
-    setPedidoOrcamento(pedido);
-    setShowOrcamento(true);
+  const handleViewOrcamento = async (pedido) => {
+    try {
+      setPedidoOrcamento(await fetchPedidoCompleto(pedido.id));
+      setShowOrcamento(true);
+    } catch (error) {
+      console.error('Erro ao carregar pedido:', error);
+      toast.error('Erro ao carregar pedido');
+    }
   };
 
   const handleDeletePedido = async (id) => {
@@ -120,7 +120,7 @@ export default function Producao() {
       const token = localStorage.getItem('token');
       await axios.post(
         `${API}/producao/${ordem.id}/aprovar`,
-        { observacao },
+        { observacao, versao: ordem.versao || 0 },
         { headers: { Authorization: `Bearer ${token}` } }
       );
       
@@ -145,7 +145,7 @@ export default function Producao() {
       const token = localStorage.getItem('token');
       await axios.post(
         `${API}/producao/${ordem.id}/rejeitar`,
-        { motivo },
+        { motivo, versao: ordem.versao || 0 },
         { headers: { Authorization: `Bearer ${token}` } }
       );
       
@@ -272,9 +272,19 @@ export default function Producao() {
     setShowForm(true);
   };
 
-  const handleEditOrdem = (ordem) => {
-    setSelectedOrdem(ordem);
-    setShowForm(true);
+  // A listagem traz só o resumo; o formulário usa a ordem completa
+  const handleEditOrdem = async (ordem) => {
+    try {
+      const token = localStorage.getItem('token');
+      const response = await axios.get(`${API}/producao/${ordem.id}`, {
+        headers: { Authorization: `Bearer ${token}` }
+      });
+      setSelectedOrdem(response.data);
+      setShowForm(true);
+    } catch (error) {
+      console.error('Erro ao carregar ordem:', error);
+      toast.error('Erro ao carregar ordem');
+    }
   };
 
   const handleDeleteOrdem = async (id) => {
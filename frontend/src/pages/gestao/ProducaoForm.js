@@ -47,6 +47,8 @@ export default function ProducaoForm({ ordem, onClose, onSave }) {
   const [fotosTrabalhoPronto, setFotosTrabalhoPronto] = useState(ordem?.fotos_trabalho_pronto || []);
   const [comprovantePagamento, setComprovantePagamento] = useState(ordem?.comprovante_pagamento || []);
   const [uploadingFoto, setUploadingFoto] = useState(false);
+  // Versão da ordem no servidor: o upload de foto também a incrementa
+  const [versao, setVersao] = useState(ordem?.versao || 0);
   
   const [formData, setFormData] = useState({
     pedido_id: ordem?.pedido_id || '',
@@ -107,24 +109,36 @@ export default function ProducaoForm({ ordem, onClose, onSave }) {
 
     try {
       setUploadingFoto(true);
+      const token = localStorage.getItem('token');
+      const dados = new FormData();
+      dados.append('file', file);
       
-      // Converter para base64
-      const reader = new FileReader();
-      reader.onloadend = () => {
-        const base64 = reader.result;
-        
-        if (tipoFoto === 'entrada_material') {
-          setFotosEntradaMaterial(prev => [...prev, base64]);
-          toast.success('Foto de entrada adicionada!');
-        } else if (tipoFoto === 'trabalho_pronto') {
-          setFotosTrabalhoPronto(prev => [...prev, base64]);
-          toast.success('Foto do trabalho pronto adicionada!');
-        } else if (tipoFoto === 'comprovante_pagamento') {
-          setComprovantePagamento(prev => [...prev, base64]);
-          toast.success('Comprovante de pagamento adicionado!');
+      // Arquivo vai para o servidor (GridFS); a ordem guarda só a URL.
+      // Ordem existente já recebe a foto; ordem nova grava a URL ao salvar.
+      const url = ordem?.id
+        ? `${API}/producao/${ordem.id}/fotos?tipo_foto=${tipoFoto}`
+        : `${API}/pedidos/upload-imagem`;
+      const response = await axios.post(url, dados, {
+        headers: {
+          Authorization: `Bearer ${token}`,
+          'Content-Type': 'multipart/form-data'
         }
-      };
-      reader.readAsDataURL(file);
+      });
+      const fotoUrl = response.data.url;
+      if (response.data.versao !== undefined) {
+        setVersao(response.data.versao);
+      }
+      
+      if (tipoFoto === 'entrada_material') {
+        setFotosEntradaMaterial(prev => [...prev, fotoUrl]);
+        toast.success('Foto de entrada adicionada!');
+      } else if (tipoFoto === 'trabalho_pronto') {
+        setFotosTrabalhoPronto(prev => [...prev, fotoUrl]);
+        toast.success('Foto do trabalho pronto adicionada!');
+      } else if (tipoFoto === 'comprovante_pagamento') {
+        setComprovantePagamento(prev => [...prev, fotoUrl]);
+        toast.success('Comprovante de pagamento adicionado!');
+      }
     } catch (error) {
       console.error('Erro ao fazer upload:', error);
       toast.error('Erro ao adicionar foto');
@@ -134,6 +148,9 @@ export default function ProducaoForm({ ordem, onClose, onSave }) {
     }
   };
 
+  // Fotos no GridFS vêm como /api/gestao/arquivos/<id>; data: URLs antigas são usadas como estão
+  const srcFoto = (foto) => (foto.startsWith('/api/') ? `${BACKEND_URL}${foto}` : foto);
+
   const handleRemoveFoto = (index, tipoFoto) => {
     if (tipoFoto === 'entrada_material') {
       setFotosEntradaMaterial(prev => prev.filter((_, i) => i !== index));
@@ -164,7 +181,17 @@ export default function ProducaoForm({ ordem, onClose, onSave }) {
       };
 
       if (ordem?.id) {
-        await axios.put(`${API}/producao/${ordem.id}`, dadosEnvio, {
+        // Envia só os campos alterados; 'versao' detecta edição concorrente (409)
+        const { timeline, ...editaveis } = dadosEnvio;
+        const alteracoes = Object.fromEntries(
+          Object.entries(editaveis).filter(([campo, valor]) => JSON.stringify(valor) !== JSON.stringify(ordem[campo]))
+        );
+        if (Object.keys(alteracoes).length === 0) {
+          toast.info('Nenhuma alteração para salvar');
+          onSave();
+          return;
+        }
+        await axios.patch(`${API}/producao/${ordem.id}`, { ...alteracoes, versao }, {
           headers: { Authorization: `Bearer ${token}` }
         });
         toast.success('Ordem atualizada!');
@@ -178,6 +205,10 @@ export default function ProducaoForm({ ordem, onClose, onSave }) {
       onSave();
     } catch (error) {
       console.error('Erro ao salvar ordem:', error);
+      if (error.response?.status === 409) {
+        toast.error(error.response.data.detail);
+        return;
+      }
       toast.error('Erro ao salvar ordem: ' + (error.response?.data?.detail || error.message));
     } finally {
       setLoading(false);
@@ -411,7 +442,7 @@ export default function ProducaoForm({ ordem, onClose, onSave }) {
                           overflow: 'hidden'
                         }}>
                           <img 
-                            src={foto} 
+                            src={srcFoto(foto)} 
                             alt={`Entrada ${index + 1}`}
                             style={{
                               width: '100%',
@@ -507,7 +538,7 @@ export default function ProducaoForm({ ordem, onClose, onSave }) {
                           overflow: 'hidden'
                         }}>
                           <img 
-                            src={foto} 
+                            src={srcFoto(foto)} 
                             alt={`Trabalho Pronto ${index + 1}`}
                             style={{
                               width: '100%',
@@ -604,7 +635,7 @@ export default function ProducaoForm({ ordem, onClose, onSave }) {
                           overflow: 'hidden'
                         }}>
                           <img 
-                            src={foto} 
+                            src={srcFoto(foto)} 
                             alt={`Comprovante ${index + 1}`}
                             style={{
                               width: '100%',
@@ -0,0 +1,21 @@
+"""
+Fixtures compartilhadas: backend no sys.path e banco em memória (mongomock-motor)
+no lugar do MongoDB, para testar as regras de persistência sem servidor.
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / 'backend'
+sys.path.insert(0, str(BACKEND_DIR))
+
+# server.py exige as variáveis na importação; a conexão real nunca é usada
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'testes')
+
+@pytest.fixture
+def mock_db():
+    return AsyncMongoMockClient(tz_aware=True)['testes']
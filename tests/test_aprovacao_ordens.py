@@ -0,0 +1,68 @@
+"""Transições de aprovação condicionais: só um aprovador vence a corrida"""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+@pytest.fixture
+def db(mock_db, monkeypatch):
+    monkeypatch.setattr(server, 'db', mock_db)
+    asyncio.run(mock_db.ordens_producao.insert_one({
+        'id': 'o1',
+        'numero_ordem': 1,
+        'aguardando_aprovacao': True,
+        'responsavel_pendente': '',
+        'responsavel_atual': 'Vendedor',
+        'versao': 2,
+        'eventos_migrados': True
+    }))
+    return mock_db
+
+def aprovar(nome, dados):
+    return server.aprovar_ordem('o1', dados, current_user={'nome': nome, 'username': nome.lower()})
+
+def test_second_concurrent_approval_gets_409(db):
+    async def corrida():
+        return await asyncio.gather(
+            aprovar('Ana', {'versao': 2}),
+            aprovar('Bruno', {'versao': 2}),
+            return_exceptions=True
+        )
+    
+    primeiro, segundo = asyncio.run(corrida())
+    
+    assert primeiro['success'] is True
+    assert isinstance(segundo, HTTPException)
+    assert segundo.status_code == 409
+    ordem = asyncio.run(db.ordens_producao.find_one({'id': 'o1'}))
+    assert ordem['responsavel_atual'] == 'Ana'
+    assert ordem['aguardando_aprovacao'] is False
+    assert ordem['versao'] == 3
+    assert len(ordem['historico_aprovacoes']) == 1
+
+def test_approval_without_version_after_winner_gets_400(db):
+    asyncio.run(aprovar('Ana', {}))
+    
+    with pytest.raises(HTTPException) as erro:
+        asyncio.run(aprovar('Bruno', {}))
+    
+    assert erro.value.status_code == 400
+
+def test_only_pending_responsible_can_approve(db):
+    asyncio.run(db.ordens_producao.update_one({'id': 'o1'}, {'$set': {'responsavel_pendente': 'Ana'}}))
+    
+    with pytest.raises(HTTPException) as erro:
+        asyncio.run(aprovar('Bruno', {'versao': 2}))
+    
+    assert erro.value.status_code == 403
+    assert asyncio.run(db.ordens_producao.find_one({'id': 'o1'}))['aguardando_aprovacao'] is True
+
+def test_reject_with_stale_version_gets_409(db):
+    asyncio.run(aprovar('Ana', {'versao': 2}))
+    
+    with pytest.raises(HTTPException) as erro:
+        asyncio.run(server.rejeitar_ordem('o1', {'motivo': 'medidas erradas', 'versao': 2}, current_user={'nome': 'Bruno'}))
+    
+    assert erro.value.status_code == 409
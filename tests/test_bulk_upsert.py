@@ -0,0 +1,67 @@
+"""Upsert em lote dos pedidos: guarda de versão com e sem o índice único"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import marketplace_integrator as mi
+
+T0 = datetime(2026, 1, 10, 12, 0, tzinfo=timezone.utc)
+
+def order(order_id, updated_at, status='paid'):
+    return {
+        'marketplace': 'MERCADO_LIVRE',
+        'marketplace_order_id': order_id,
+        'last_updated_at': updated_at,
+        'status': status
+    }
+
+@pytest.fixture
+def db(mock_db, monkeypatch):
+    monkeypatch.setattr(mi, 'db', mock_db)
+    monkeypatch.setattr(mi, '_unique_indexes_verified', set())
+    return mock_db
+
+def with_index(db):
+    asyncio.run(db.orders.create_index([('marketplace', 1), ('marketplace_order_id', 1)], unique=True))
+
+def test_stale_payload_with_unique_index_is_reported_and_not_written(db):
+    with_index(db)
+    asyncio.run(mi.bulk_upsert_orders([order('1', T0, 'shipped')]))
+    
+    result = asyncio.run(mi.bulk_upsert_orders([order('1', T0 - timedelta(hours=1), 'paid'), order('2', T0)]))
+    
+    assert result['stale'] == [('MERCADO_LIVRE', '1')]
+    assert result['created'] == 1
+    assert ('MERCADO_LIVRE', '1') not in result['internal_ids']
+    stored = asyncio.run(db.orders.find({'marketplace_order_id': '1'}).to_list(None))
+    assert len(stored) == 1
+    assert stored[0]['status'] == 'shipped'
+
+def test_stale_payload_without_unique_index_does_not_duplicate(db):
+    asyncio.run(mi.bulk_upsert_orders([order('1', T0, 'shipped')]))
+    
+    result = asyncio.run(mi.bulk_upsert_orders([order('1', T0 - timedelta(hours=1), 'paid')]))
+    
+    assert result['stale'] == [('MERCADO_LIVRE', '1')]
+    stored = asyncio.run(db.orders.find({'marketplace_order_id': '1'}).to_list(None))
+    assert len(stored) == 1
+    assert stored[0]['status'] == 'shipped'
+
+def test_newer_payload_updates_without_unique_index(db):
+    asyncio.run(mi.bulk_upsert_orders([order('1', T0, 'paid')]))
+    
+    result = asyncio.run(mi.bulk_upsert_orders([order('1', T0 + timedelta(hours=1), 'shipped')]))
+    
+    assert result['stale'] == []
+    assert result['updated'] == 1
+    assert asyncio.run(db.orders.count_documents({})) == 1
+
+def test_duplicate_key_without_version_field_is_raised(db):
+    asyncio.run(db.payments.create_index([('marketplace_payment_id', 1)], unique=True))
+    asyncio.run(db.payments.insert_one({'marketplace_payment_id': 'P1', 'internal_payment_id': 'a'}))
+    # Registro antigo com outra chave de upsert mas o mesmo ID único: erro real, não stale
+    keyed = {'x': ({'marketplace_payment_id': 'P2'}, {'marketplace_payment_id': 'P1'})}
+    
+    with pytest.raises(mi.BulkWriteError):
+        asyncio.run(mi._bulk_upsert(db.payments, keyed, 'internal_payment_id'))
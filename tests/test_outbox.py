@@ -0,0 +1,163 @@
+"""Outbox das automações de status: idempotência, lease/retentativas e fallback sem transação"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pymongo.errors import OperationFailure
+
+import server
+
+class ClienteStandalone:
+    """MongoDB sem replica set: start_session falha como no servidor standalone"""
+    
+    def __init__(self):
+        self.sessoes = 0
+    
+    async def start_session(self):
+        self.sessoes += 1
+        raise OperationFailure("Transaction numbers are only allowed on a replica set member or mongos", code=20)
+
+@pytest.fixture
+def cliente(mock_db, monkeypatch):
+    cliente = ClienteStandalone()
+    monkeypatch.setattr(server, 'db', mock_db)
+    monkeypatch.setattr(server, 'client', cliente)
+    monkeypatch.setattr(server, '_transacoes_suportadas', None)
+    asyncio.run(server.ensure_outbox_indexes())
+    asyncio.run(mock_db.formas_pagamento_banco.insert_one({'id': 'fp3', 'numero_parcelas': 3, 'espaco_parcelas_dias': 30}))
+    asyncio.run(mock_db.pedidos_manufatura.insert_one({
+        'id': 'p1',
+        'numero_pedido': 10,
+        'status': 'Montagem',
+        'cliente_nome': 'Cliente',
+        'forma_pagamento_id': 'fp3',
+        'valor_final': 300.0,
+        'preco_venda': 300.0,
+        'itens': []
+    }))
+    return cliente
+
+def evento(status_pedido='Montagem', **campos):
+    return {
+        'id': f'ev-{status_pedido}',
+        'tipo': 'pedido_status',
+        'pedido_id': 'p1',
+        'status_pedido': status_pedido,
+        'usuario': 'ana',
+        'status': 'pendente',
+        'tentativas': 0,
+        'proxima_tentativa': datetime.now(timezone.utc),
+        'created_at': datetime.now(timezone.utc),
+        **campos
+    }
+
+def chaves_contas(db):
+    contas = asyncio.run(db.contas_receber.find({'pedido_id': 'p1'}).to_list(None))
+    return sorted(conta['chave_idempotencia'] for conta in contas)
+
+def test_standalone_runs_without_session_and_remembers_it(cliente):
+    sessoes_recebidas = []
+    
+    async def operacao(session):
+        sessoes_recebidas.append(session)
+        return 'ok'
+    
+    assert asyncio.run(server.executar_em_transacao(operacao)) == 'ok'
+    assert asyncio.run(server.executar_em_transacao(operacao)) == 'ok'
+    
+    assert sessoes_recebidas == [None, None]
+    assert cliente.sessoes == 1
+    assert server._transacoes_suportadas is False
+
+def test_other_operation_failures_are_raised(cliente, monkeypatch):
+    async def start_session():
+        raise OperationFailure("not authorized", code=13)
+    monkeypatch.setattr(cliente, 'start_session', start_session)
+    
+    async def operacao(session):
+        return 'ok'
+    
+    with pytest.raises(OperationFailure):
+        asyncio.run(server.executar_em_transacao(operacao))
+
+def test_montagem_replayed_twice_creates_one_order_and_one_set_of_installments(cliente):
+    db = server.db
+    asyncio.run(server.aplicar_automacoes_status(evento()))
+    asyncio.run(server.aplicar_automacoes_status(evento()))
+    
+    assert chaves_contas(db) == ['montagem:p1:1/3', 'montagem:p1:2/3', 'montagem:p1:3/3']
+    assert asyncio.run(db.ordens_producao.count_documents({'id_pedido_origem': 'p1'})) == 1
+
+def test_montagem_replay_fills_only_missing_installments(cliente):
+    db = server.db
+    asyncio.run(server.aplicar_automacoes_status(evento()))
+    asyncio.run(db.contas_receber.delete_one({'chave_idempotencia': 'montagem:p1:2/3'}))
+    
+    asyncio.run(server.aplicar_automacoes_status(evento()))
+    
+    assert chaves_contas(db) == ['montagem:p1:1/3', 'montagem:p1:2/3', 'montagem:p1:3/3']
+
+def test_lancamento_is_keyed_by_order_and_status(cliente):
+    db = server.db
+    for status in ('Pronto', 'Pronto', 'Entregue', 'Entregue'):
+        asyncio.run(server.aplicar_automacoes_status(evento(status)))
+    
+    lancamentos = asyncio.run(db.lancamentos_financeiros.find({'pedido_id': 'p1'}).to_list(None))
+    assert sorted(l['chave_idempotencia'] for l in lancamentos) == ['lancamento:p1:Entregue', 'lancamento:p1:Pronto']
+
+def test_worker_processes_event_once(cliente):
+    db = server.db
+    asyncio.run(db.outbox_eventos.insert_one(evento()))
+    worker = server.OutboxWorker()
+    
+    assert asyncio.run(worker.processar('ev-Montagem')) is True
+    # Evento concluído não é reivindicado de novo (disparo duplicado ou polling)
+    assert asyncio.run(worker.processar('ev-Montagem')) is False
+    assert asyncio.run(worker.processar()) is False
+    
+    registro = asyncio.run(db.outbox_eventos.find_one({'id': 'ev-Montagem'}))
+    assert registro['status'] == 'concluido'
+    assert registro['tentativas'] == 1
+    assert 'bloqueado_ate' not in registro
+    assert len(chaves_contas(db)) == 3
+
+def test_active_lease_blocks_and_expired_lease_is_reclaimed(cliente):
+    db = server.db
+    agora = datetime.now(timezone.utc)
+    asyncio.run(db.outbox_eventos.insert_one(evento(status='processando', tentativas=1, bloqueado_ate=agora + timedelta(minutes=1))))
+    worker = server.OutboxWorker()
+    
+    assert asyncio.run(worker.processar()) is False
+    
+    asyncio.run(db.outbox_eventos.update_one({'id': 'ev-Montagem'}, {'$set': {'bloqueado_ate': agora - timedelta(seconds=1)}}))
+    assert asyncio.run(worker.processar()) is True
+    
+    registro = asyncio.run(db.outbox_eventos.find_one({'id': 'ev-Montagem'}))
+    assert registro['status'] == 'concluido'
+    assert registro['tentativas'] == 2
+
+def test_failure_schedules_retry_with_backoff_until_exhausted(cliente, monkeypatch):
+    db = server.db
+    
+    async def falha(evento, session=None):
+        raise RuntimeError("banco indisponível")
+    monkeypatch.setattr(server, 'aplicar_automacoes_status', falha)
+    asyncio.run(db.outbox_eventos.insert_one(evento()))
+    worker = server.OutboxWorker()
+    
+    # BSON guarda milissegundos
+    antes = datetime.now(timezone.utc).replace(microsecond=0)
+    assert asyncio.run(worker.processar()) is True
+    registro = asyncio.run(db.outbox_eventos.find_one({'id': 'ev-Montagem'}))
+    assert registro['status'] == 'pendente'
+    assert registro['ultimo_erro'] == 'banco indisponível'
+    assert registro['proxima_tentativa'] >= antes + timedelta(seconds=30)
+    # Retentativa ainda não venceu
+    assert asyncio.run(worker.processar()) is False
+    
+    asyncio.run(db.outbox_eventos.update_one(
+        {'id': 'ev-Montagem'},
+        {'$set': {'tentativas': server.OUTBOX_MAX_TENTATIVAS - 1, 'proxima_tentativa': antes}}
+    ))
+    assert asyncio.run(worker.processar()) is True
+    assert asyncio.run(db.outbox_eventos.find_one({'id': 'ev-Montagem'}))['status'] == 'erro'